@@ -0,0 +1,108 @@
+import sys
+import importlib
+
+from poseyctrl import VERSION
+
+
+# Subcommand: (module, entry point, description). A module is only imported
+# when its subcommand runs, so offline tools don't pay for BLE and the rest.
+COMMANDS = {
+    "sniffer": (
+        "poseyctrl.apps.posey_sniffer",
+        "posey_sniffer",
+        "Scan for Posey sensors.",
+    ),
+    "listen": (
+        "poseyctrl.apps.posey_listen",
+        "posey_listen",
+        "Collect data from a single sensor.",
+    ),
+    "cmd": (
+        "poseyctrl.apps.posey_cmd",
+        "posey_cmd",
+        "Send commands to one or more sensors.",
+    ),
+    "daemon": (
+        "poseyctrl.apps.posey_daemon",
+        "posey_daemon",
+        "Keep sensor connections open for posey cmd/listen.",
+    ),
+    "extract": (
+        "poseyctrl.apps.posey_extract",
+        "posey_extract",
+        "Extract per-slot binary dumps from a download.",
+    ),
+    "decode-bin": (
+        "poseyctrl.apps.posey_decode_bin",
+        "posey_decode_bin",
+        "Decode binary serial dumps to CSV.",
+    ),
+    "merge": (
+        "poseyctrl.apps.posey_merge",
+        "posey_merge",
+        "Merge per-sensor outputs into one time ordered table.",
+    ),
+    "imu": (
+        "poseyctrl.apps.posey_imu",
+        "posey_imu",
+        "Resample IMU data and derive orientation.",
+    ),
+    "batch": (
+        "poseyctrl.apps.posey_batch",
+        "posey_batch",
+        "Extract and decode every capture under a directory.",
+    ),
+    "catalog": (
+        "poseyctrl.apps.posey_catalog",
+        "posey_catalog",
+        "Index captures and downloads in SQLite and query them.",
+    ),
+    "bench": (
+        "poseyctrl.apps.posey_bench",
+        "posey_bench",
+        "Benchmark the decoders and tool start up.",
+    ),
+}
+
+
+def usage():
+    lines = [
+        "usage: posey [-h] [--version] <command> [args...]",
+        "",
+        "Talk to Posey sensors and process their data. Run posey <command> -h for",
+        "help on a command.",
+        "",
+        "commands:",
+    ]
+    for name, (_, _, description) in COMMANDS.items():
+        lines.append(f"  {name:<12} {description}")
+    return "\n".join(lines)
+
+
+def load(command):
+    """:param return: The entry point for ``command``, importing its module."""
+    module, function, _ = COMMANDS[command]
+    return getattr(importlib.import_module(module), function)
+
+
+def posey(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if (len(argv) == 0) or (argv[0] in ["-h", "--help", "help"]):
+        print(usage())
+        return
+    if argv[0] == "--version":
+        print(f"poseyctrl {VERSION}")
+        return
+    command = argv[0]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        sys.exit(f"posey: unknown command {command}")
+
+    # The tools parse sys.argv themselves.
+    main = load(command)
+    sys.argv = [f"posey {command}"] + argv[1:]
+    return main()
+
+
+if __name__ == "__main__":
+    posey()
@@ -0,0 +1,129 @@
+from logging import getLogger
+
+import os
+import time
+import argparse
+import logging
+import datetime as dt
+
+from poseyctrl import batch
+from poseyctrl import profiling
+
+
+def posey_batch():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-batch",
+        description="Extract and decode every capture under a directory, skipping anything already up to date.",
+    )
+    parser.add_argument("directory", type=str, help="Directory tree to process.")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        type=str,
+        default=None,
+        help=f"Manifest file (default <directory>/{batch.MANIFEST}).",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        default=False,
+        help="Reprocess every input, even if it is up to date.",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only report what would be processed.",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
+    # Configure logger.
+    handlers = [logging.StreamHandler()]
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-batch"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    profiling.start(args.profile, nowstamp)
+
+    root = os.path.abspath(args.directory)
+    manifest = batch.Manifest(root, args.manifest)
+    log.info(f"Processing {root} with {args.jobs} workers")
+
+    # Extraction produces the per-slot bins that are then decoded, so the
+    # stages run one after the other.
+    failed = 0
+    t0 = time.time()
+    for task in ["extract", "decode"]:
+        todo = []
+        inputs = batch.find_inputs(root, task)
+        for fn in inputs:
+            sha256 = manifest.fingerprint(fn)
+            if args.force or not manifest.up_to_date(fn, task, sha256):
+                todo.append((fn, sha256))
+            else:
+                manifest.refresh(fn)
+        log.info(
+            f"{task}: {len(inputs)} inputs, {len(inputs) - len(todo)} up to date, {len(todo)} to process"
+        )
+        if args.dry_run:
+            for fn, _ in todo:
+                log.info(f" - {manifest.key(fn)}")
+            continue
+        manifest.save()
+        if len(todo) == 0:
+            continue
+
+        # Imported late so up to date trees and dry runs start quickly.
+        from multiprocess import Pool
+
+        hashes = dict(todo)
+        with Pool(max(1, min(args.jobs, len(todo)))) as pool:
+            results = pool.imap_unordered(
+                lambda fn: batch.run_task(task, fn), [fn for fn, _ in todo]
+            )
+            for i, (_, fn, outputs, error) in enumerate(results):
+                if error is not None:
+                    failed += 1
+                    log.error(f"[{i + 1}/{len(todo)}] {manifest.key(fn)} failed:")
+                    log.error(error)
+                    continue
+                log.info(
+                    f"[{i + 1}/{len(todo)}] {manifest.key(fn)} -> {len(outputs)} outputs"
+                )
+                manifest.update(fn, task, hashes[fn], outputs)
+                manifest.save()
+
+    log.info(f"Finished in {time.time() - t0:.1f} s, {failed} failed.")
+
+
+if __name__ == "__main__":
+    posey_batch()
@@ -0,0 +1,460 @@
+import os
+import csv
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import resource
+import argparse
+import subprocess
+import datetime as dt
+
+import multiprocess
+
+from poseyctrl import csvw
+from poseyctrl import decode
+from poseyctrl import hil
+from poseyctrl import imu
+from poseyctrl import profiling
+from poseyctrl import synth
+from poseyctrl.benchmark import environment
+from poseyctrl.metrics import StageTimers
+from poseyctrl.apps.posey_extract import extract
+
+
+CAPTURE = "capture.in.bin"
+DOWNLOAD = "download"
+IMU_CSV = "capture.data.imu.csv"
+
+# Regressions are judged on these, and on which direction is worse.
+CHECKS = [
+    ("mb_per_s", -1),
+    ("messages_per_s", -1),
+    ("peak_rss_mb", 1),
+    ("startup_ms", 1),
+]
+
+# Tools whose cold start the startup path times, as posey subcommands.
+STARTUP = ["extract", "decode-bin", "batch", "listen", "cmd"]
+
+
+class NullQueue:
+    """Drops decoded messages so only decoding is timed."""
+
+    def put(self, item):
+        pass
+
+    def qsize(self):
+        return 0
+
+
+def bench_feed(fixtures, timers):
+    sensor = hil.PoseyHIL("bench", None, NullQueue(), None, None, None, None)
+    decoded = 0
+    for block in decode.read_blocks(fixtures[CAPTURE]):
+        decoded += sensor.feed(block)
+    timers.merge(sensor.timers.stages)
+    return decoded, os.path.getsize(fixtures[CAPTURE])
+
+
+def bench_decode(fixtures, timers):
+    decoded = decode.decode_file(fixtures[CAPTURE], "bench", "decode.", timers)
+    return decoded, os.path.getsize(fixtures[CAPTURE])
+
+
+def bench_sqlite(fixtures, timers):
+    # As bench_decode, writing a SQLite database instead of CSVs.
+    writer = csvw.SQLiteWriter(None, prefix="sqlite.", types=hil.FIELD_TYPES)
+    sensor = hil.PoseyHIL("bench", None, writer, None, None, None, None)
+    decoded = 0
+    for block in decode.read_blocks(fixtures[CAPTURE]):
+        decoded += sensor.feed(block)
+    writer.close()
+    timers.merge(sensor.timers.stages)
+    timers.merge(writer.timers.stages)
+    return decoded, os.path.getsize(fixtures[CAPTURE])
+
+
+def bench_parallel(fixtures, timers, jobs=4):
+    size = os.path.getsize(fixtures[CAPTURE])
+    chunk_bytes = max(size // jobs, 64 * 1024)
+    decoded = decode.decode_parallel(
+        fixtures[CAPTURE],
+        "bench",
+        "parallel.",
+        jobs,
+        chunk_bytes,
+        log=lambda s: None,
+        timers=timers,
+    )
+    return decoded, size
+
+
+def bench_extract(fixtures, timers):
+    log = logging.getLogger("bench.extract")
+    log.setLevel(logging.WARNING)
+    extract(fixtures[DOWNLOAD], prefix="extract.", log=log)
+    return None, os.path.getsize(fixtures[DOWNLOAD])
+
+
+def bench_imu(fixtures, timers):
+    rows = imu.process_file(fixtures[IMU_CSV], "imu.csv", timers=timers)
+    return rows, os.path.getsize(fixtures[IMU_CSV])
+
+
+def derive_row(row):
+    # The same derivation as imu.ImuProcessor, a sample at a time.
+    ax, ay, az = (float(row[c]) for c in imu.ACCEL)
+    x, y, z, w = (float(row[c]) for c in imu.QUAT)
+    norm = math.sqrt(x * x + y * y + z * z + w * w) or 1.0
+    x, y, z, w = x / norm, y / norm, z / norm, w / norm
+    roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x))))
+    yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    lx = (1 - 2 * (y * y + z * z)) * ax + 2 * (x * y - z * w) * ay
+    lx += 2 * (x * z + y * w) * az
+    ly = 2 * (x * y + z * w) * ax + (1 - 2 * (x * x + z * z)) * ay
+    ly += 2 * (y * z - x * w) * az
+    lz = 2 * (x * z - y * w) * ax + 2 * (y * z + x * w) * ay
+    lz += (1 - 2 * (x * x + y * y)) * az - imu.GRAVITY
+    return [
+        row["time"],
+        ax,
+        ay,
+        az,
+        x,
+        y,
+        z,
+        w,
+        math.degrees(roll),
+        math.degrees(pitch),
+        math.degrees(yaw),
+        lx,
+        ly,
+        lz,
+        math.sqrt(ax * ax + ay * ay + az * az),
+        math.sqrt(lx * lx + ly * ly + lz * lz),
+    ]
+
+
+def bench_imu_rows(fixtures, timers):
+    # Row at a time baseline for bench_imu, without resampling.
+    rows = 0
+    with open(fixtures[IMU_CSV], "r", newline="") as f:
+        with open("imu-rows.csv", "w", newline="") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(imu.COLUMNS)
+            for row in csv.DictReader(f):
+                writer.writerow(derive_row(row))
+                rows += 1
+    return rows, os.path.getsize(fixtures[IMU_CSV])
+
+
+PATHS = {
+    "feed": bench_feed,
+    "decode": bench_decode,
+    "sqlite": bench_sqlite,
+    "parallel": bench_parallel,
+    "extract": bench_extract,
+    "imu": bench_imu,
+    "imu-rows": bench_imu_rows,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS. Children covers the
+    # workers of the parallel decode.
+    scale = 1.0 / 1024 / 1024 if sys.platform == "darwin" else 1.0 / 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_path(path, fixtures, output, results):
+    # Runs in a fresh process so the peak RSS is this path's alone.
+    os.chdir(output)
+    rss0 = peak_rss_mb()
+    timers = StageTimers()
+    t0 = time.perf_counter()
+    with profiling.worker(f"bench-{path}"):
+        messages, nbytes = PATHS[path](fixtures, timers)
+    elapsed = time.perf_counter() - t0
+    results.put(
+        dict(
+            path=path,
+            elapsed=elapsed,
+            messages=messages,
+            bytes=nbytes,
+            messages_per_s=messages / elapsed if messages is not None else None,
+            mb_per_s=nbytes / 1024.0 / 1024.0 / elapsed,
+            peak_rss_mb=peak_rss_mb(),
+            start_rss_mb=rss0,
+            stages=timers.snapshot(),
+        )
+    )
+
+
+def measure(path, fixtures, output, repeat=1):
+    """
+    Time a decode path, keeping the fastest of ``repeat`` runs.
+
+    :param return: Result dict.
+    """
+    ctx = multiprocess.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        os.makedirs(output, exist_ok=True)
+        # Not a pool, its workers can't start the parallel decode's own pool.
+        results = ctx.Queue()
+        process = ctx.Process(target=run_path, args=(path, fixtures, output, results))
+        process.start()
+        process.join()
+        shutil.rmtree(output)
+        if process.exitcode != 0:
+            raise RuntimeError(f"Benchmarking {path} failed")
+        result = results.get()
+        if (best is None) or (result["elapsed"] < best["elapsed"]):
+            best = result
+    return best
+
+
+def startup_ms(argv, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return 1e3 * best
+
+
+def measure_startup(repeat=5):
+    """
+    Time ``posey <tool> --help`` for each tool in STARTUP, which is dominated
+    by imports, keeping the fastest of ``repeat`` runs.
+
+    :param return: Dict of result dicts keyed by ``startup.<tool>``.
+    """
+    python = startup_ms([sys.executable, "-c", "pass"], repeat)
+    results = {}
+    for tool in STARTUP:
+        ms = startup_ms(
+            [sys.executable, "-m", "poseyctrl.apps.posey", tool, "--help"], repeat
+        )
+        results[f"startup.{tool}"] = dict(
+            path=f"startup.{tool}",
+            elapsed=1e-3 * ms,
+            startup_ms=ms,
+            import_ms=ms - python,
+        )
+    return results
+
+
+def write_fixtures(directory, duration, imu_rate, corrupt, slots, seed):
+    os.makedirs(directory, exist_ok=True)
+    fixtures = {
+        CAPTURE: os.path.join(directory, CAPTURE),
+        DOWNLOAD: os.path.join(directory, f"{DOWNLOAD}.bin"),
+    }
+    corruptor = synth.write_capture(
+        fixtures[CAPTURE], duration, corrupt, seed, imu_rate=imu_rate
+    )
+    synth.write_download(
+        os.path.join(directory, DOWNLOAD),
+        slots,
+        duration,
+        corrupt,
+        seed,
+        imu_rate=imu_rate,
+    )
+    return fixtures, corruptor
+
+
+def write_imu_fixture(directory, fixtures):
+    """Decode the capture for the IMU paths' input."""
+    fixtures[IMU_CSV] = os.path.join(directory, IMU_CSV)
+    prefix = os.path.join(directory, "capture.")
+    decode.decode_file(fixtures[CAPTURE], "capture", prefix)
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Compare results against a stored baseline.
+
+    :param return: List of messages describing each regression.
+    """
+    found = []
+    for path, result in results.items():
+        if path not in baseline:
+            continue
+        for key, sign in CHECKS:
+            new, old = result.get(key), baseline[path].get(key)
+            if (new is None) or (old is None) or (old == 0):
+                continue
+            change = (new - old) / old
+            if sign * change > tolerance:
+                found.append(
+                    f"{path} {key}: {old:.2f} -> {new:.2f} ({100 * change:+.1f}%)"
+                )
+    return found
+
+
+def posey_bench():
+    parser = argparse.ArgumentParser(
+        "posey-bench",
+        description="Benchmark the decode paths on synthetic Posey data.",
+    )
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="*",
+        default=list(PATHS) + ["startup"],
+        help=f"Decode paths to benchmark ({', '.join(PATHS)}), and startup for the time tools take to start.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        type=str,
+        default="posey-bench",
+        help="Directory for fixtures and decoder output.",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        default=False,
+        help="Only write the fixtures, don't benchmark.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=600,
+        help="Seconds of synthetic data to generate.",
+    )
+    parser.add_argument(
+        "--imu-rate", type=float, default=100, help="Synthetic IMU rate (Hz)."
+    )
+    parser.add_argument(
+        "--corrupt",
+        type=float,
+        default=0.001,
+        help="Fraction of synthetic frames to corrupt.",
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=4,
+        help="Peripherals in the synthetic download.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per path, the fastest is kept.",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="Write results to JSON file."
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        default=None,
+        help="Compare against a stored baseline and fail on regressions.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        type=str,
+        default=None,
+        help="Store the results as a baseline.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Fractional change from the baseline counted as a regression.",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if (path not in PATHS) and (path != "startup"):
+            parser.error(f"Unknown path {path}, choose from {', '.join(PATHS)}")
+
+    workdir = os.path.abspath(args.workdir)
+    print(f"Writing fixtures to {workdir}...")
+    fixtures, corruptor = write_fixtures(
+        workdir, args.duration, args.imu_rate, args.corrupt, args.slots, args.seed
+    )
+    if any(path.startswith("imu") for path in args.paths):
+        write_imu_fixture(workdir, fixtures)
+    for name, fn in fixtures.items():
+        print(f" - {fn}: {os.path.getsize(fn) / 1024.0 / 1024.0:.2f} MB")
+    if corruptor is not None:
+        print(f" - Corrupted frames: {corruptor.counts}")
+    if args.write:
+        return
+    if args.profile is not None:
+        logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+        profiling.start(args.profile, os.path.join(workdir, "posey-bench"))
+
+    results = {}
+    for path in args.paths:
+        if path == "startup":
+            print("Timing tool start up...")
+            for key, result in measure_startup(max(args.repeat, 5)).items():
+                results[key] = result
+                print(
+                    f" - {key}: {result['startup_ms']:.0f} ms ({result['import_ms']:.0f} ms over bare Python)"
+                )
+            continue
+        print(f"Benchmarking {path}...")
+        result = measure(path, fixtures, os.path.join(workdir, "out"), args.repeat)
+        results[path] = result
+        messages = result["messages_per_s"]
+        print(
+            f" - {result['elapsed']:.3f} s, {result['mb_per_s']:.2f} MB/s, {f'{messages:.0f}' if messages is not None else '-'} msgs/s, peak RSS {result['peak_rss_mb']:.1f} MB"
+        )
+        if len(result["stages"]) > 0:
+            for line in StageTimers.load(result["stages"]).summary():
+                print(f"   {line}")
+
+    report = dict(
+        environment=environment(),
+        fixtures=dict(
+            duration=args.duration,
+            imu_rate=args.imu_rate,
+            corrupt=args.corrupt,
+            slots=args.slots,
+            seed=args.seed,
+        ),
+        results=results,
+    )
+    fn = args.output
+    if fn is None:
+        fn = f"{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}-posey-bench.json"
+    with open(fn, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {fn}")
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {100 * args.tolerance:.0f}% of {args.baseline}.")
+
+
+if __name__ == "__main__":
+    posey_bench()
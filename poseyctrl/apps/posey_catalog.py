@@ -0,0 +1,257 @@
+from logging import getLogger
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import logging
+import datetime as dt
+
+from poseyctrl import catalog
+from poseyctrl import profiling
+
+
+# Columns shown by default by the query command.
+SHOWN = [
+    "path",
+    "kind",
+    "sensor",
+    "signal",
+    "datetime",
+    "duration",
+    "slots",
+    "messages",
+    "rows",
+    "gaps",
+    "checksum_failures",
+]
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+def print_table(rows, columns, f=sys.stdout):
+    cells = [[format_value(row[c]) for c in columns] for row in rows]
+    widths = [
+        max([len(c)] + [len(line[i]) for line in cells]) for i, c in enumerate(columns)
+    ]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip(), file=f)
+    for line in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(line, widths)).rstrip(), file=f)
+
+
+def index(args, db, log):
+    t0 = time.time()
+    for root in args.directories:
+        if not os.path.isdir(root):
+            log.error(f"Not a directory: {root}")
+            continue
+        fns = catalog.find_artifacts(root)
+        todo = fns if args.force else db.stale(fns)
+        log.info(
+            f"{root}: {len(fns)} artifacts, {len(fns) - len(todo)} up to date, {len(todo)} to index"
+        )
+        if not args.keep:
+            pruned = db.prune(root, fns)
+            if pruned > 0:
+                log.info(f"{root}: forgot {pruned} artifacts that are gone")
+        if len(todo) == 0:
+            db.commit()
+            continue
+
+        deep = not args.shallow
+        if (args.jobs > 1) and (len(todo) > 1):
+            # Imported late so up to date trees start quickly.
+            from multiprocess import Pool
+
+            pool = Pool(min(args.jobs, len(todo)))
+            results = pool.imap_unordered(lambda fn: catalog.describe(fn, deep), todo)
+        else:
+            pool = None
+            results = (catalog.describe(fn, deep) for fn in todo)
+        try:
+            for i, (fn, info) in enumerate(results):
+                db.add(fn, info)
+                if info.get("error") is not None:
+                    log.warning(f"[{i + 1}/{len(todo)}] {fn}: {info['error']}")
+                else:
+                    log.debug(f"[{i + 1}/{len(todo)}] {fn}: {info['kind']}")
+                # Commit as we go, so an interrupted run keeps its progress.
+                if (i % 100) == 99:
+                    db.commit()
+        finally:
+            db.commit()
+            if pool is not None:
+                pool.terminate()
+    log.info(f"Indexed in {time.time() - t0:.1f} s.")
+
+
+def query(args, db, log):
+    columns = catalog.COLUMNS if args.all else SHOWN
+    if args.columns is not None:
+        columns = args.columns.split(",")
+        unknown = [c for c in columns if c not in catalog.COLUMNS]
+        if unknown:
+            sys.exit(f"Unknown columns {', '.join(unknown)}")
+
+    import sqlite3
+
+    try:
+        rows = db.query(
+            sensor=args.sensor,
+            kind=args.kind,
+            signal=args.signal,
+            since=args.since,
+            until=args.until,
+            where=args.where,
+        )
+    except sqlite3.Error as e:
+        sys.exit(f"Query failed: {e}")
+
+    if args.format == "json":
+        json.dump([{c: row[c] for c in columns} for row in rows], sys.stdout, indent=4)
+        print()
+    elif args.format == "csv":
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row[c] for c in columns])
+    else:
+        print_table(rows, columns)
+    log.info(f"{len(rows)} artifacts.")
+
+
+def posey_catalog():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-catalog",
+        description="Index downloads, captures and decoded CSVs into a SQLite catalog, and query it.",
+    )
+    parser.add_argument(
+        "-c",
+        "--catalog",
+        type=str,
+        default=catalog.CATALOG,
+        help=f"Catalog database (default {catalog.CATALOG}).",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    profiling.add_argument(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser(
+        "index", help="Index new and changed artifacts under directories."
+    )
+    p.add_argument("directories", type=str, nargs="+", help="Directory trees.")
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    p.add_argument(
+        "--shallow",
+        action="store_true",
+        default=False,
+        help="Only read headers and names, skipping the block, message and quality counts that need reading whole downloads and captures.",
+    )
+    p.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        default=False,
+        help="Index every artifact, even if it is up to date.",
+    )
+    p.add_argument(
+        "--keep",
+        action="store_true",
+        default=False,
+        help="Keep entries for artifacts that no longer exist.",
+    )
+
+    p = commands.add_parser("query", help="List artifacts matching filters.")
+    p.add_argument(
+        "-s", "--sensor", type=str, default=None, help="Sensor name, * wildcards."
+    )
+    p.add_argument("-k", "--kind", type=str, default=None, choices=catalog.KINDS)
+    p.add_argument("--signal", type=str, default=None, help="Decoded signal.")
+    p.add_argument(
+        "--since",
+        type=str,
+        default=None,
+        help="Recorded at or after this ISO date/time (e.g. 2024-03).",
+    )
+    p.add_argument(
+        "--until", type=str, default=None, help="Recorded before this ISO date/time."
+    )
+    p.add_argument(
+        "-w",
+        "--where",
+        type=str,
+        default=None,
+        help="Extra SQL condition, e.g. 'gaps > 0 AND duration > 3600'.",
+    )
+    p.add_argument(
+        "--columns", type=str, default=None, help="Comma-separated columns to show."
+    )
+    p.add_argument(
+        "-a", "--all", action="store_true", default=False, help="Show all columns."
+    )
+    p.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        default="table",
+        choices=["table", "csv", "json"],
+        help="Output format.",
+    )
+    args = parser.parse_args()
+
+    # Configure logger, on stderr so query results can go to stdout.
+    handlers = [logging.StreamHandler()]
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-catalog"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    profiling.start(args.profile, nowstamp)
+
+    if (args.command == "query") and not os.path.isfile(args.catalog):
+        parser.error(f"No catalog at {args.catalog}, run posey-catalog index first.")
+    db = catalog.Catalog(args.catalog)
+    try:
+        if args.command == "index":
+            index(args, db, log)
+        else:
+            query(args, db, log)
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt, stopping.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    posey_catalog()
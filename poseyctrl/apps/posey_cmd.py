@@ -11,15 +11,28 @@ import datetime as dt
 from enum import Enum
 import numpy as np
 import json
+import os
 
 from adafruit_ble import BLERadio
 from adafruit_ble.advertising.standard import Advertisement
 
+from poseyctrl import benchmark
+from poseyctrl import daemon
+from poseyctrl import profiling
+from poseyctrl import sim
+from poseyctrl.patch.nordic import DEFAULT_BUFFER_SIZE, UARTService
+from poseyctrl.benchmark import LinkBenchmark
+from poseyctrl.control import (
+    COMMANDS,
+    Fleet,
+    PoseyController,
+    is_pattern,
+    matches,
+    parse_script,
+    scan,
+)
 from poseyctrl.sensor import PoseySensor
 
-from pyposey import MessageAck
-from pyposey.control import CommandType, CommandMessage
-
 
 def posey_cmd():
     def confirm() -> bool:
@@ -37,20 +50,24 @@ def posey_cmd():
     parser = argparse.ArgumentParser(
         "posey-cmd", description="Send a command to a posey hub device."
     )
-    parser.add_argument("sensor", type=str, help="Sensor to connect to.")
+    parser.add_argument(
+        "sensor",
+        type=str,
+        help="Sensor to connect to. A comma-separated list or a glob pattern (e.g. 'posey waist*') runs the command on every matching sensor.",
+    )
     parser.add_argument(
         "command",
         type=str,
-        help="Command to issue.",
-        choices=[
-            "noop",
-            "reboot",
-            "startrecording",
-            "stoprecording",
-            "datasummary",
-            "download",
-            "flasherase",
-        ],
+        nargs="?",
+        help="Command to issue, or benchmark to measure the BLE link.",
+        choices=COMMANDS + ["benchmark"],
+    )
+    parser.add_argument(
+        "-s",
+        "--script",
+        type=str,
+        default=None,
+        help="Run the commands in this file in order on one connection instead, stopping at the first failure. One command per line, optionally followed by timeout=<s>, long_timeout=<s>, validate or extract.",
     )
     parser.add_argument(
         "-t",
@@ -76,11 +93,111 @@ def posey_cmd():
         default=False,
         help="Force command without confirmation.",
     )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        default=False,
+        help="Check flash block headers while downloading and report per-slot stats.",
+    )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        default=False,
+        help="Write per-slot binary files while downloading (implies --validate).",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum number of sensors to run the command on at once.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Times to retry a sensor that failed before acknowledging the command.",
+    )
+    parser.add_argument(
+        "--results",
+        type=str,
+        default=None,
+        help="JSON file to write per-sensor results to when running on several sensors.",
+    )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        nargs="?",
+        const=daemon.DEFAULT_SOCKET,
+        default=None,
+        metavar="SOCKET",
+        help="Run the command through a running posey-daemon, reusing its connections.",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=100,
+        help="Benchmark: number of NoOp commands to time.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1,
+        help="Benchmark: NoOp commands allowed in flight at once.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10,
+        help="Benchmark: seconds to measure receive throughput for (0 to skip).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Benchmark: JSON file to write results to.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Benchmark: earlier result files to tabulate alongside this run.",
+    )
+    parser.add_argument(
+        "--rx-buffer",
+        type=int,
+        default=DEFAULT_BUFFER_SIZE // 1024,
+        help="UART receive buffer size (KiB). Raise it if it's reported full.",
+    )
+    sim.add_argument(parser)
+    profiling.add_argument(parser)
     args = parser.parse_args()
+    if (args.command is None) == (args.script is None):
+        parser.error("give either a command or --script")
+    if (args.command == "benchmark") and (args.daemon is not None):
+        parser.error("benchmark needs its own connection, not --daemon")
+
+    # A single command is just a one step script as far as confirmation goes.
+    steps = None
+    if args.script is not None:
+        with open(args.script, "r") as f:
+            try:
+                steps = parse_script(f)
+            except ValueError as e:
+                parser.error(f"{args.script}: {e}")
+        if len(steps) == 0:
+            parser.error(f"{args.script}: no commands")
+        args.command = "script"
+        commands = [step["command"] for step in steps]
+    else:
+        commands = [args.command]
 
     # Configure logger.
     dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    nowstamp = f"{dtnow}-posey-cmd-{args.sensor}-{args.command}"
+    sensor_tag = "".join(c if c.isalnum() else "_" for c in args.sensor)
+    nowstamp = f"{dtnow}-posey-cmd-{sensor_tag}-{args.command}"
     handlers = [logging.StreamHandler()]
     if args.log:
         handlers.append(logging.FileHandler(f"{nowstamp}.log"))
@@ -93,6 +210,10 @@ def posey_cmd():
     )
     log = getLogger("main")
     getLogger("asyncio").setLevel(logging.CRITICAL)
+    profiling.start(args.profile, nowstamp)
+
+    # Buffers are allocated on connect, so size them first.
+    UARTService.set_buffer_sizes(rx=args.rx_buffer * 1024)
 
     device_name = args.sensor
 
@@ -100,6 +221,8 @@ def posey_cmd():
         f"Start time: {dt.datetime.now().astimezone().replace(microsecond=0).isoformat()}"
     )
     log.info(f"Sensor: {device_name}")
+    if steps is not None:
+        log.info(f"Script: {' -> '.join(commands)}")
     log.info(f"Scan timeout: {args.timeout}")
 
     # Config.
@@ -108,57 +231,130 @@ def posey_cmd():
     pq = Queue()
 
     # Confirmation.
-    if not args.force:
-        if args.command == "flasherase":
+    def warn(command) -> bool:
+        """
+        Log what ``command`` is about to do.
+
+        :param return: True if it needs confirming.
+        """
+        if command == "flasherase":
             log.warning("This will erase all data on the device!")
-            if not confirm():
-                log.info("Aborting.")
-                return
-        elif args.command == "download":
+        elif command == "download":
             log.warning("This will stop recording to download data!")
             log.info("If you haven't already stopped recording, you should do")
             log.info("that instead, otherwise the end timestamp is sometimes invalid.")
-            if not confirm():
-                log.info("Aborting.")
-                return
-        elif args.command == "startrecording":
+        elif command == "startrecording":
             log.warning("Starting a new recording will delete any existing data!")
             log.info("You may want to download the existing data first.")
-            if not confirm():
-                log.info("Aborting.")
-                return
-        elif args.command == "stoprecording":
+        elif command == "stoprecording":
             log.warning("Are you sure you want to stop recording?")
-            if not confirm():
-                log.info("Aborting.")
-                return
-        elif args.command == "reboot":
+        elif command == "reboot":
             log.warning("This will stop recording and invalidate the end timestamp!")
             log.info("If the device is recording stop it first.")
+        else:
+            return False
+        return True
+
+    if not args.force:
+        # Warn about everything up front so a script runs unattended.
+        if any([warn(command) for command in dict.fromkeys(commands)]):
             if not confirm():
                 log.info("Aborting.")
                 return
 
+    names = [name.strip() for name in args.sensor.split(",") if name.strip()]
+
+    # The daemon already holds the connections, just hand it the command.
+    if args.daemon is not None:
+        client = daemon.DaemonClient(args.daemon)
+        results = []
+        for name in names:
+            log.info(f"Sending {args.command} for {name} to daemon at {args.daemon}")
+            try:
+                response = client.request(
+                    "command",
+                    sensor=name,
+                    command=args.command,
+                    steps=steps,
+                    directory=os.getcwd(),
+                    validate=args.validate,
+                    extract=args.extract,
+                )
+            except KeyboardInterrupt:
+                log.info("Keyboard interrupt, cancelling.")
+                client.request("cancel", sensor=name)
+                return
+            except (daemon.DaemonError, OSError) as e:
+                log.error(f"{name}: {e}")
+                results.append(dict(sensor=name, ok=False, error=str(e)))
+                continue
+            result = response["result"]
+            log.info(json.dumps(result, indent=4))
+            results.append(result)
+
+        if len(names) > 1:
+            fn = args.results or f"{dtnow}-posey-cmd-{args.command}-results.json"
+            log.info(f"Writing results to {fn}")
+            with open(fn, "w") as f:
+                json.dump(results, f, indent=4)
+        ok = sum(1 for result in results if result["ok"])
+        log.info(f"{ok}/{len(results)} sensors completed {args.command}.")
+        return
+
     # Find sensors.
+    if args.sim is not None:
+        ble = sim.SimRadio(**args.sim)
+    else:
+        ble = BLERadio()
+    if (len(names) > 1) or any(is_pattern(name) for name in names):
+        if args.command == "benchmark":
+            log.error("Benchmark one sensor at a time.")
+            return
+        log.info(f"Scanning for Posey sensors {', '.join(names)}...")
+        advs = scan(ble, names, args.timeout, log)
+        if len(advs) == 0:
+            log.error("No devices found!")
+            raise RuntimeError("Could not find any Posey sensors!")
+        missing = [
+            name
+            for name in names
+            if not (is_pattern(name) or any(matches(cn, name) for cn in advs))
+        ]
+        for name in missing:
+            log.warning(f"Device {name} not found!")
+
+        log.info(
+            f"Running {args.command} on {len(advs)} sensors, {args.jobs} at a time."
+        )
+        fleet = Fleet(
+            ble,
+            advs,
+            args.command,
+            jobs=args.jobs,
+            retries=args.retries,
+            log=log,
+            dtnow=dtnow,
+            steps=steps,
+            validate=args.validate,
+            extract=args.extract,
+        )
+        results = fleet.run()
+        results += [dict(sensor=name, state="not found", ok=False) for name in missing]
+
+        fn = args.results or f"{dtnow}-posey-cmd-{args.command}-results.json"
+        log.info(f"Writing results to {fn}")
+        with open(fn, "w") as f:
+            json.dump(results, f, indent=4)
+        ok = sum(1 for result in results if result["ok"])
+        log.info(f"{ok}/{len(results)} sensors completed {args.command}.")
+        return
+
     log.info(f"Scanning for Posey sensor {device_name}...")
-    ble = BLERadio()
-    device_adv = None
-    for adv in ble.start_scan(Advertisement, timeout=args.timeout):
-        if adv.complete_name is None:
-            continue
-        cn = adv.complete_name.lower()
-        if ("posey" in cn) and (device_name.lower() in cn):
-            name = adv.complete_name
-            log.info(f"Found Posey {name} (Address: {adv.address.string})")
-            device_adv = adv
-            ble.stop_scan()
-            break
-
-    if device_adv is None:
+    advs = scan(ble, names, args.timeout, log, first=True)
+    if len(advs) == 0:
         log.error("Device not found!")
         raise RuntimeError("Could not find Posey sensor!")
-
-    device_name = device_adv.complete_name
+    device_name, device_adv = next(iter(advs.items()))
 
     log.info(f"Connecting to {device_adv.complete_name}.")
     sensor = PoseySensor(device_name, ble, device_adv, qout, qin, pq, nowstamp)
@@ -169,182 +365,35 @@ def posey_cmd():
         log.error(" - Failed to connect to BLE device.")
         raise RuntimeError("Could not connect to Posey sensor!")
 
-    def wait_for_ack(timeout=60):
-        log.info("Waiting for ack...")
-
-        # Check for ack.
-        t0 = time.time()
-        while True:
-            try:
-                (sig, _, data) = pq.get_nowait()
-                if sig == "command":
-                    log.info(f"Found ack: 0x{data['ack']:02x}")
-                    return data
-                if (timeout != None) and ((time.time() - t0) > timeout):
-                    log.error("Timeout while waiting for ack!")
-                    raise Exception("Timeout")
-            except queue.Empty:
-                pass
-
-            sensor.hil.process_uart()
-            time.sleep(0.1)
-
-    def wait_for_datasummary(timeout=60):
-        log.info("Waiting for datasummary...")
-
-        # Check for ack.
-        t0 = time.time()
-        data_summary = None
-        while True:
-            try:
-                (sig, sig_time, data) = pq.get_nowait()
-                if sig == "datasummary":
-                    data_summary = data
-                    log.info("Got DataSummary message:")
-                    log.info(json.dumps(data_summary, indent=4))
-                    return data_summary
-                if (timeout != None) and ((time.time() - t0) > timeout):
-                    log.error("Timeout while waiting for ack!")
-                    raise Exception("Timeout")
-            except queue.Empty:
-                pass
-
-            sensor.hil.process_uart()
-            time.sleep(0.1)
-
-    def wait_for_download(buffer):
-        bytes = len(buffer)
-        log.info("Waiting for %.2f MB...", bytes / 1024.0 / 1024.0)
-        bytes_left = bytes
-        t0 = time.time()
-        tu = t0
-        bu = 0
-
-        di = 0
-        while bytes_left > 0:
-            data = sensor.hil.read_uart()
-            if data is not None:
-                data_len = len(data)
-                bytes_left -= data_len
-                de = di + data_len
-                if de > bytes:
-                    de = bytes
-                    data = data[: (de - di)]
-                buffer[di:de] = np.frombuffer(data, "u1")
-                di = de
-            else:
-                data_len = 0
-
-            dt = 1.0 * (time.time() - tu)
-            if (dt > 10) or (bytes_left <= 0):
-                bytes_read = bytes - bytes_left
-                log.info(
-                    "Waiting for %.2f/%.2f MB (%.2f%%, %.2f KBps)",
-                    bytes_left / 1024.0 / 1024.0,
-                    bytes / 1024.0 / 1024.0,
-                    100.0 * bytes_left / bytes,
-                    (bytes_read - bu) / 1024.0 / dt,
-                )
-                tu = time.time()
-                bu = bytes_read
-
-            if data_len == 0:
-                time.sleep(0.1)
-
-        return bytes_read
-
-    # Send command.
-    cmd = CommandMessage()
-    cmd.message.ack = MessageAck.Expected
-    expected_ack = MessageAck.OK
-    if args.command == "noop":
-        cmd.message.command = CommandType.NoOp
-    elif args.command == "reboot":
-        cmd.message.command = CommandType.Reboot
-    elif args.command == "startrecording":
-        cmd.message.command = CommandType.StartCollecting
-        cmd.message.payload = np.frombuffer(
-            dt.datetime.now()
-            .astimezone()
-            .strftime("%Y-%m-%d %H:%M:%S %z\0")
-            .encode("UTF-8"),
-            dtype="u1",
-        )
-        expected_ack = MessageAck.Working
-        log.info(
-            "Data recording will start after flash erase. This may take up to a few minutes."
-        )
-    elif args.command == "flasherase":
-        cmd.message.command = CommandType.FullFlashErase
-        expected_ack = MessageAck.Working
-        log.info("A full flash erase may take up to a few minutes (typical 2m30s).")
-    elif args.command == "stoprecording":
-        cmd.message.command = CommandType.StopCollecting
-    elif (args.command == "download") or (args.command == "datasummary"):
-        cmd.message.command = CommandType.GetDataSummary
-    cmd.serialize()
-    sensor.hil.send(cmd)
-    log.info(
-        f"Sent init command for {args.command}: 0x{cmd.message.command:02x} {cmd.message.command_str()}"
-    )
-
-    # Wait for ack.
-    data = wait_for_ack()
-
-    if data["ack"] != expected_ack:
-        log.error(f"Bad ack returned after init: 0x{data['ack']:02x}")
-    elif args.command == "flasherase":
-        log.info("Waiting for acknowledgement that flash erase completed...")
-        data = wait_for_ack()
-        if data["ack"] != MessageAck.OK:
-            log.error(f"Unexpected ack in response to flash erase: 0x{data['ack']:02x}")
-    elif args.command == "startrecording":
-        log.info("Waiting for acknowledgement that recording started...")
-        data = wait_for_ack()
-        if data["ack"] != MessageAck.OK:
-            log.error(
-                f"Unexpected ack in response to start recording: 0x{data['ack']:02x}"
+    controller = PoseyController(sensor, log=log, dtnow=dtnow)
+    try:
+        if args.command == "benchmark":
+            result = LinkBenchmark(sensor, log).run(
+                args.count, args.window, duration=args.duration
             )
-    elif args.command == "datasummary":
-        data_summary = wait_for_datasummary()
-        if data_summary is None:
-            log.error("No DataSummary returned!")
-    elif args.command == "download":
-        data_summary = wait_for_datasummary()
-        if data_summary is None:
-            log.error("No DataSummary returned!")
-        else:
-            bytes = data_summary["bytes"]
-            log.info(
-                "Allocating download buffer for %2f MB...", bytes / 1024.0 / 1024.0
-            )
-            download_buffer = np.empty(bytes, "u1")
-
-            cmd.message.command = CommandType.DownloadData
-            cmd.serialize()
-            sensor.hil.send(cmd)
-            log.info(
-                f"Sent download command: 0x{cmd.message.command:02x} {cmd.message.command_str()}"
+            fn = args.output or f"{nowstamp}.json"
+            log.info(f"Writing results to {fn}")
+            with open(fn, "w") as f:
+                json.dump(result, f, indent=4)
+            results = [benchmark.load(fn) for fn in args.compare] + [result]
+            for line in benchmark.compare(results, args.compare + ["this run"]):
+                log.info(line)
+        elif steps is not None:
+            result = controller.run_script(
+                steps, validate=args.validate, extract=args.extract
             )
-
-            # Wait on data summary and ack.
-            data = wait_for_ack()
-            if data["ack"] != MessageAck.Working:
-                log.error(
-                    f"Unexpected ack in response to download: 0x{data['ack']:02x}"
-                )
+            if result["ok"]:
+                log.info(f"Script completed {len(steps)} steps.")
             else:
-                # Wait for download.
-                bytes_read = wait_for_download(download_buffer)
-                if bytes_read < bytes:
-                    log.error("Only read %d of %d bytes!", bytes_read, bytes)
-
-                fn = f"{dtnow}-{device_name.replace(' ', '')}-download.npz"
-                log.info("Dumping downloaded data to file: %s", fn)
-                np.savez(
-                    fn, summary=data_summary, data=download_buffer, allow_pickle=True
+                log.error(
+                    f"Script stopped after {len(result['steps'])}/{len(steps)} steps."
                 )
-                log.info("Done!")
+        else:
+            controller.run(args.command, validate=args.validate, extract=args.extract)
+        if args.command == "download":
+            log.info("Done!")
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt, stopping.")
 
     # elif args.command == 'record':
     #     # Wait for keyboard interrupt, then send stop.
@@ -396,6 +445,7 @@ def posey_cmd():
     #     if data['ack'] != MessageAck.OK:
     #         log.error(f"Bad ack returned from stop: 0x{data['ack']:02x}")
 
+    sensor.hil.timers.log_summary(log)
     log.info("Disconnecting sensor...")
     sensor.disconnect()
     sensor.hil.close()
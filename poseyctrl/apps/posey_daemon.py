@@ -0,0 +1,120 @@
+from logging import getLogger
+
+import argparse
+import logging
+import datetime as dt
+
+from adafruit_ble import BLERadio
+
+from poseyctrl import daemon
+from poseyctrl import profiling
+from poseyctrl import sim
+from poseyctrl.metrics import MetricsWriter
+from poseyctrl.patch.nordic import DEFAULT_BUFFER_SIZE, UARTService
+
+
+def posey_daemon():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-daemon",
+        description="Keep Posey connections open and serve posey-cmd/posey-listen clients over a local socket.",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        type=str,
+        default=daemon.DEFAULT_SOCKET,
+        help="Unix socket to listen on (or set POSEY_DAEMON_SOCKET).",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=10,
+        help="Timeout (seconds) to scan for BLE sensor devices.",
+    )
+    parser.add_argument(
+        "-r",
+        "--min-rssi",
+        type=float,
+        default=-100,
+        help="Minimum device RSSI to connect to.",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    parser.add_argument(
+        "--rx-buffer",
+        type=int,
+        default=DEFAULT_BUFFER_SIZE // 1024,
+        help="UART receive buffer size (KiB). Raise it if it's reported full.",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        type=str,
+        default=None,
+        help="File to keep rewriting with metrics for every connection, Prometheus text if it ends in .prom, otherwise JSON.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=5,
+        help="Seconds between metrics file updates.",
+    )
+    sim.add_argument(parser)
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
+    # Configure logger.
+    handlers = [logging.StreamHandler()]
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-daemon"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    getLogger("asyncio").setLevel(logging.CRITICAL)
+    profiling.start(args.profile, nowstamp)
+
+    # Buffers are allocated on connect, so size them first.
+    UARTService.set_buffer_sizes(rx=args.rx_buffer * 1024)
+
+    if args.sim is not None:
+        ble = sim.SimRadio(**args.sim)
+    else:
+        ble = BLERadio()
+    server = daemon.PoseyDaemon(
+        args.socket,
+        ble,
+        scan_timeout=args.timeout,
+        log=log,
+        minimum_rssi=args.min_rssi,
+    )
+    if args.metrics is not None:
+        server.metrics = MetricsWriter(args.metrics, args.metrics_interval)
+    log.info(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt, stopping.")
+    finally:
+        log.info("Disconnecting sensors...")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    posey_daemon()
@@ -1,71 +1,219 @@
 import os
 import datetime as dt
 import time
-
-from multiprocess import Queue
+import logging
 
 from poseyctrl import csvw
+from poseyctrl import decode
 from poseyctrl import hil
+from poseyctrl import profiling
+from poseyctrl.metrics import StageTimers
+from poseyctrl.quality import QualityMonitor
 
 import argparse
 
 
+def print_timers(*timers):
+    total = StageTimers()
+    for t in timers:
+        total.merge(t.stages)
+    if len(total.stages) > 0:
+        print("Time per stage:")
+        for line in total.summary():
+            print(f"  {line}")
+
+
+def print_quality(monitor):
+    lines = monitor.report()
+    if len(lines) > 0:
+        print("Data quality:")
+        for line in lines:
+            print(f"  {line}")
+
+
+def derive_imu(prefix, rate):
+    """Run the IMU stage on the decoded ``<prefix>.data.imu.csv``."""
+    # Imported here as it needs NumPy.
+    from poseyctrl import imu
+
+    fn = f"{prefix}.data.imu.csv"
+    if not os.path.isfile(fn):
+        print(f"No IMU data in {fn}, skipping the IMU stage.")
+        return
+    output = imu.derived_filename(f"{prefix}.")
+    resampled = f" resampled to {rate:g} Hz" if rate else ""
+    print(f"Deriving orientation from {fn}{resampled}...")
+    start = time.perf_counter()
+    rows = imu.process_file(fn, output, rate)
+    print(f"Wrote {rows} rows to {output} in {time.perf_counter() - start:.1f} s.")
+
+
 def posey_decode_bin():
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=str, help="Input bin.")
+    parser.add_argument(
+        "input",
+        type=str,
+        help="Input bin (- for stdin, or a glob of rotating segments with --follow).",
+    )
     parser.add_argument(
         "output", type=str, default=".", nargs="?", help="Output directory."
     )
     parser.add_argument("-p", "--prefix", type=str, default=None, help="Output prefix.")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes to decode chunks of the input in parallel.",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        type=float,
+        default=64,
+        help="Target chunk size (MB) when decoding in parallel.",
+    )
+    parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        default=False,
+        help="Keep decoding new data as the input grows, resuming from a checkpoint.",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=1.0,
+        help="Seconds between checks for new data in follow mode.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="Stop following after this many seconds without new data.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Follow mode checkpoint file (default <output>/<prefix>.checkpoint.json).",
+    )
+    parser.add_argument(
+        "--imu-rate",
+        type=float,
+        nargs="?",
+        const=0,
+        default=None,
+        metavar="HZ",
+        help="After decoding, also write <prefix>.data.imu_derived.csv with Euler angles, gravity removed acceleration and magnitudes, resampled to HZ if given.",
+    )
+    parser.add_argument(
+        "--sqlite",
+        action="store_true",
+        default=False,
+        help="Write <prefix>.data.sqlite, a table per signal, instead of CSVs. Decodes serially.",
+    )
+    profiling.add_argument(parser)
     args = parser.parse_args()
+    if args.follow and (args.imu_rate is not None):
+        parser.error("--imu-rate can't be used with --follow, run posey-imu after.")
+    if args.sqlite and (args.follow or (args.imu_rate is not None)):
+        parser.error("--sqlite can't be used with --follow or --imu-rate.")
 
-    if not os.path.isfile(args.input):
+    if (args.input != "-") and not (args.follow or os.path.isfile(args.input)):
         print(f"Error: input file does not exist! -> {args.input}")
     if not os.path.isdir(args.output):
         print(f"Error: output directory does not exist! -> {args.output}")
-    if args.prefix is None:
-        args.prefix = (
-            os.path.basename(args.input)
-            .replace(".raw", "")
-            .replace(".in", "")
-            .replace(".out", "")
-            .replace(".bin", "")
-        )
+    if (args.prefix is None) and (args.input == "-"):
+        args.prefix = "stdin"
+    elif args.prefix is None:
+        args.prefix = decode.default_prefix(args.input)
 
     print(f"Processing {args.input} -> {args.output}/{args.prefix}.*")
-    inp = open(args.input, "rb").read()
+    if args.profile is not None:
+        # Profiles are reported through logging, which is otherwise unused.
+        logging.basicConfig(format="{message}", style="{", level=logging.INFO)
+        dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        profiling.start(args.profile, f"{dtnow}-posey-decode-bin")
+    if args.follow:
+        pattern = os.path.abspath(args.input)
+        if args.checkpoint is None:
+            args.checkpoint = os.path.join(
+                args.output, f"{args.prefix}.checkpoint.json"
+            )
+        args.checkpoint = os.path.abspath(args.checkpoint)
+        os.chdir(args.output)
+        follower = decode.FollowDecoder(
+            pattern, args.prefix, f"{args.prefix}.", args.checkpoint, poll=args.poll
+        )
+        print(f"Following {args.input}, press Ctrl+C to stop...")
+        decoded = follower.follow(idle_timeout=args.idle_timeout)
+        print(f"Decoded {decoded} messages.")
+        print_timers(follower.sensor.timers, follower.writer.timers)
+        print_quality(follower.sensor.quality)
+        print("Done.")
+        return
+
+    chunk_bytes = int(args.chunk_size * 1024 * 1024)
+    if (
+        (args.jobs > 1)
+        and not args.sqlite
+        and (args.input != "-")
+        and (os.path.getsize(args.input) > chunk_bytes)
+    ):
+        input = os.path.abspath(args.input)
+        os.chdir(args.output)
+        timers = StageTimers()
+        quality = QualityMonitor(logging.getLogger(args.prefix))
+        try:
+            decoded = decode.decode_parallel(
+                input,
+                args.prefix,
+                f"{args.prefix}.",
+                args.jobs,
+                chunk_bytes,
+                timers=timers,
+                quality=quality,
+            )
+            print(f"Decoded {decoded} messages.")
+            print_timers(timers)
+            print_quality(quality)
+            if args.imu_rate is not None:
+                derive_imu(args.prefix, args.imu_rate)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt, stopping...")
+        print("Done.")
+        return
+
+    input = args.input if args.input == "-" else os.path.abspath(args.input)
     os.chdir(args.output)
 
+    # Only needed here, for the writer process.
+    from multiprocess import Queue
+
     qin = Queue()
     qout = Queue()
     pq = Queue()
 
-    csvwriter = csvw.CSVWriter(qin, prefix=f"{args.prefix}.")
+    if args.sqlite:
+        csvwriter = csvw.SQLiteWriter(
+            qin, prefix=f"{args.prefix}.", types=hil.FIELD_TYPES
+        )
+    else:
+        csvwriter = csvw.CSVWriter(qin, prefix=f"{args.prefix}.")
     sensor = hil.PoseyHIL(args.prefix, qout, qin, pq, None, None, None, output_raw=None)
 
+    interrupted = False
     try:
         print(f"Reading {args.input}...")
         csvwriter.start()
-        N = len(inp)
-        bytes_left = N
-        rows = {1: 0, 2: 0, 200: 0, 201: 0}
-        while bytes_left > 0:
-            to_read = min(bytes_left, sensor.ml.free)
-            if to_read > 0:
-                si = N - bytes_left
-                ei = si + to_read
-                data = bytes(inp[si:ei])
-                sensor.ml.write(data)
-                bytes_left -= to_read
-
-            while True:
-                mid = sensor.ml.process_next()
-                if mid >= 0:
-                    rows[mid] += 1
-                    sensor.process_message(dt.datetime.now(), mid)
-                else:
-                    break
-        print("Dumping to CSV, this may take a while...")
+        decoded = 0
+        for block in decode.read_blocks(input):
+            decoded += sensor.feed(block)
+        print(f"Decoded {decoded} messages.")
+        print_timers(sensor.timers)
+        print_quality(sensor.quality)
+        print(f"Writing {csvwriter.filename('*')}, this may take a while...")
         iter = 0
         while not qin.empty():
             iter += 1
@@ -74,8 +222,11 @@ def posey_decode_bin():
             time.sleep(1)
     except KeyboardInterrupt:
         print("Keyboard interrupt, stopping...")
-    print("Done.")
+        interrupted = True
     csvwriter.stop_gracefully()
+    if (args.imu_rate is not None) and not interrupted:
+        derive_imu(args.prefix, args.imu_rate)
+    print("Done.")
 
 
 if __name__ == "__main__":
@@ -1,79 +1,29 @@
 from logging import getLogger
 
 import os
-import time
+import csv
 import argparse
 import logging
-import traceback
-from multiprocess import Queue
 import datetime
 import numpy as np
-from hexdump import hexdump
 from dateutil.parser import parse
-import pandas as pd
 
-from adafruit_ble import BLERadio
-from adafruit_ble.advertising.standard import Advertisement
+from poseyctrl import download
+from poseyctrl import flash
+from poseyctrl import profiling
 
-import pyposey as pyp
-from pyposey import MessageAck
-from pyposey.control import CommandType, CommandMessage
 
+def extract(filename, prefix="", output=".", log=None):
+    """
+    Extract the per-slot binary dumps and RSSI from a downloaded data file.
 
-def posey_extract():
-    # Process arguments.
-    parser = argparse.ArgumentParser(
-        "posey-extract",
-        description="Extract and decode data downloaded from a Posey hub.",
-    )
-    parser.add_argument("filename", type=str, help="File (*.npz) to extract.")
-    parser.add_argument(
-        "-d",
-        "--debug",
-        action="store_true",
-        default=False,
-        help="Enable debug logging.",
-    )
-    parser.add_argument(
-        "-l", "--log", action="store_true", default=False, help="Output log to file."
-    )
-    parser.add_argument(
-        "-p",
-        "--prefix",
-        action="store_true",
-        default=False,
-        help="Use long prefix for bin files.",
-    )
-    args = parser.parse_args()
-
-    # Configure logger.
-    handlers = [logging.StreamHandler()]
-    dtnow = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    nowstamp = f"{dtnow}-posey-extract"
-    if args.log:
-        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
-    logging.basicConfig(
-        handlers=handlers,
-        datefmt="%H:%M:%S",
-        format="{name:.<15} {asctime}: [{levelname}] {message}",
-        style="{",
-        level=logging.DEBUG if args.debug else logging.INFO,
-    )
-    log = getLogger("main")
-    getLogger("asyncio").setLevel(logging.CRITICAL)
-
-    prefix = (
-        (os.path.basename(args.filename).replace(".npz", "") + "-")
-        if args.prefix
-        else ""
-    )
+    :param return: List of the files written.
+    """
+    if log is None:
+        log = getLogger("main")
 
     # Load the data.
-    f = np.load(args.filename, allow_pickle=True)
-    summary = f["summary"].item()
-    data = f["data"]
-    datab = data.tobytes()
-    f.close()
+    summary, data, datab = download.load(filename)
 
     # Extract the collection summary.
     sensor = summary["sensor"]
@@ -89,6 +39,12 @@ def posey_extract():
     log.info(f"Data  : {data_len} B ({data_len/1024.0:.2f} KB)")
     if data_len != len(data):
         log.warning(f" -> Warning: {data_len} != {len(data)}")
+    if len(data) < data_len:
+        log.warning(" -> Partial download, extracting what was received.")
+        data_len = len(data)
+    if data_len == 0:
+        log.warning(" -> No data was received, nothing to extract.")
+        return []
     log.info(f"Rate  : {rate/1024.0:.2f} KB/s")
 
     log.info(
@@ -99,68 +55,21 @@ def posey_extract():
     log.info("%.2f minutes of data, %d bytes", data_dt / 60.0, data_len)
 
     # Extract all the blocks.
-    def mac2str(mac):
-        return "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*mac)
-
-    def extract_fbm(fbm, print_fbm=True):
-        time = fbm.message.time - start_ms
-        slot = fbm.message.slot
-        mac = mac2str(fbm.message.mac)
-        rssi = fbm.message.rssi
-        block_bytes = fbm.message.block_bytes
-
-        if print_fbm:
-            log.debug(
-                f"Block of {block_bytes} bytes from MAC {mac}, slot {slot} at time {time}, RSSI {rssi}"
-            )
-
-        return dict(slot=slot, time=time, mac=mac, rssi=rssi, block_bytes=block_bytes)
-
     block_summaries = []
     blocks = {}
 
-    fbm = pyp.platform.sensors.FlashBlockMessage()
-    di = 0
-    skipped = 0
-    fbm_bytes = 0
-    data_bytes = 0
-    while di < data_len:
-        fbm.buffer.write(data[di : di + 18])
-        fbm.deserialize()
-        if (not fbm.valid_checksum) or (datab[di : di + 2] != b"\xca\xfe"):
-            next_sync = datab.find(b"\xCA\xFE", di + 1)
-            if next_sync < 0:
-                next_sync = data_len
-            skip = next_sync - di
-            skipped += skip
-            log.debug(f"Invalid FBM checksum! Skipping {skip} bytes!")
-            skip += 20
-            if skip > 100:
-                skip = 100
-            log.debug(hexdump(data[di : di + skip], result="return"))
-            di = next_sync
-            continue
-
-        block_summary = extract_fbm(fbm, print_fbm=False)
-        fbm_bytes += 18
-        data_bytes += block_summary["block_bytes"]
-        block_si = di + 18
-        block_ei = block_si + block_summary["block_bytes"]
-        block = data[block_si:block_ei]
+    def on_block(block_summary, block):
         block_summaries.append(block_summary)
-
         slot = block_summary["slot"]
         if slot not in blocks:
-            log.debug("-----------")
-            log.debug(hexdump(data[di : di + 18], result="return"))
-            log.debug(f"Added new slot: {slot} {block_summary['mac']}")
-            extract_fbm(fbm)
-            log.debug(hexdump(block, result="return"))
-            log.debug("-----------")
-
             blocks[slot] = []
         blocks[slot].append(block)
-        di = block_ei
+
+    parser = flash.FlashBlockParser(start_ms, log, on_block)
+    parser.feed(data, datab, data_len, final=True)
+    skipped = parser.skipped
+    fbm_bytes = parser.fbm_bytes
+    data_bytes = parser.data_bytes
 
     log.info(
         f"Total bytes  : {data_len:7} ({data_len/1024.0:7.2f} KB) {data_len*100.0/data_len:6.2f}%"
@@ -183,13 +92,80 @@ def posey_extract():
         )
 
     # Write binary files.
+    outputs = []
     for slot, data in flash_data.items():
-        log.info(f"Writing binary data to {prefix}{slot}.bin")
-        with open(f"{prefix}{slot}.bin", "wb") as f:
+        fn = os.path.join(output, f"{prefix}{slot}.bin")
+        log.info(f"Writing binary data to {fn}")
+        with open(fn, "wb") as f:
             f.write(flash_data[slot].tobytes())
+        outputs.append(fn)
 
     # Write RSSI.
-    log.info(f"Writing RSSI data to {prefix}rssi.csv")
-    fbdf = pd.DataFrame.from_dict(block_summaries)
-    fbdf.time *= 1.0e-3
-    fbdf.to_csv(f"{prefix}rssi.csv", index=False)
+    fn = os.path.join(output, f"{prefix}rssi.csv")
+    log.info(f"Writing RSSI data to {fn}")
+    with open(fn, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(flash.BLOCK_SUMMARY_FIELDS)
+        for block_summary in block_summaries:
+            block_summary["time"] *= 1.0e-3
+            writer.writerow(block_summary.values())
+    outputs.append(fn)
+
+    return outputs
+
+
+def posey_extract():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-extract",
+        description="Extract and decode data downloaded from a Posey hub.",
+    )
+    parser.add_argument(
+        "filename",
+        type=str,
+        help="File (*.npz, or the *.json/*.bin of a streamed download) to extract.",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        action="store_true",
+        default=False,
+        help="Use long prefix for bin files.",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
+    # Configure logger.
+    handlers = [logging.StreamHandler()]
+    dtnow = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-extract"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    getLogger("asyncio").setLevel(logging.CRITICAL)
+    profiling.start(args.profile, nowstamp)
+
+    prefix = (
+        (os.path.splitext(os.path.basename(args.filename))[0] + "-")
+        if args.prefix
+        else ""
+    )
+
+    extract(args.filename, prefix=prefix, log=log)
@@ -0,0 +1,118 @@
+from logging import getLogger
+
+import os
+import time
+import argparse
+import logging
+import datetime as dt
+
+from poseyctrl import decode
+from poseyctrl import imu
+from poseyctrl import merge
+from poseyctrl import profiling
+
+
+def output_prefix(fn, output):
+    # hub1.data.imu.csv -> <output>/hub1., capture.bin -> <output>/capture.
+    base = os.path.basename(fn)
+    if base.endswith(".csv"):
+        base = base.split(".data.", 1)[0]
+    else:
+        base = decode.default_prefix(fn)
+    return os.path.join(output, f"{base}.")
+
+
+def posey_imu():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-imu",
+        description="Resample IMU data to a uniform rate and derive Euler angles, gravity removed acceleration and magnitudes, writing <prefix>.data.imu_derived.csv per input.",
+    )
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="data.imu.csv files, or binary captures and extracted slots, which are decoded on the fly.",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=".", help="Output directory."
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=None,
+        metavar="HZ",
+        help="Resample to this rate (default keep the sensor's sample times).",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=None,
+        metavar="MS",
+        help="When resampling, don't interpolate across gaps longer than this.",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    if not os.path.isdir(args.output):
+        parser.error(f"Output directory does not exist: {args.output}")
+
+    # Configure logger.
+    handlers = [logging.StreamHandler()]
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-imu"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    profiling.start(args.profile, nowstamp)
+
+    max_gap = args.max_gap * 1000 if args.max_gap is not None else None
+    for spec in args.inputs:
+        try:
+            stream = merge.open_stream(spec, ["imu"])[0]
+        except (OSError, ValueError) as e:
+            log.error(f"{spec}: {e}")
+            continue
+        output = imu.derived_filename(output_prefix(stream.fn, args.output))
+        processor = imu.ImuProcessor(args.rate, max_gap)
+        start = time.perf_counter()
+        try:
+            rows = imu.process_stream(stream, output, processor=processor)
+        except KeyboardInterrupt:
+            log.info("Keyboard interrupt, stopping.")
+            break
+        except ValueError as e:
+            log.error(f"{spec}: {e}")
+            continue
+        finally:
+            stream.close()
+        elapsed = time.perf_counter() - start
+        log.info(f"{spec} -> {output}: {rows} rows in {elapsed:.2f} s")
+        if stream.malformed > 0:
+            log.warning(f"{spec}: skipped {stream.malformed} malformed rows.")
+        resampler = processor.resampler
+        if (resampler is not None) and (resampler.resets > 0):
+            log.warning(f"{spec}: {resampler.resets} clock resets, resampled apart.")
+        if (resampler is not None) and (resampler.dropped > 0):
+            log.warning(f"{spec}: dropped {resampler.dropped} out of order samples.")
+
+
+if __name__ == "__main__":
+    posey_imu()
@@ -1,5 +1,6 @@
 from logging import getLogger
 
+import time
 import argparse
 import logging
 import traceback
@@ -10,9 +11,46 @@ import datetime as dt
 from adafruit_ble import BLERadio
 from adafruit_ble.advertising.standard import Advertisement
 
+from poseyctrl import csvw
+from poseyctrl import daemon
+from poseyctrl import hil
+from poseyctrl import profiling
+from poseyctrl import replay
+from poseyctrl import sim
+from poseyctrl.patch.nordic import DEFAULT_BUFFER_SIZE, UARTService
+from poseyctrl.metrics import MetricsWriter
+from poseyctrl.poller import AdaptivePoller
 from poseyctrl.sensor import PoseySensor
 
 
+def listen_daemon(socket, device_name, log, delay=3, writer=None):
+    # Rates are tallied client side, the daemon logs the full stats itself.
+    log.info(f"Listening to {device_name} through daemon at {socket}")
+    counts = {}
+    t0 = time.time()
+    try:
+        for sig, t, data in daemon.DaemonClient(socket).listen(device_name):
+            if sig == "disconnected":
+                log.warning(f"Sensor {device_name} disconnected, daemon reconnecting.")
+                continue
+            if writer is not None:
+                writer.put((sig, t, data))
+            counts[sig] = counts.get(sig, 0) + 1
+            now = time.time()
+            if (now - t0) >= delay:
+                rates = " ".join(
+                    f"{sig}: {N / (now - t0):5.1f}Hz"
+                    for sig, N in sorted(counts.items())
+                )
+                log.info(f"Rates: [{rates}]")
+                counts = {}
+                t0 = now
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt, breaking.")
+    if writer is not None:
+        writer.close()
+
+
 def posey_listen():
     # Process arguments.
     parser = argparse.ArgumentParser(
@@ -43,6 +81,67 @@ def posey_listen():
         default=-100,
         help="Minimum device RSSI to connect to.",
     )
+    parser.add_argument(
+        "--max-sleep",
+        type=float,
+        default=50,
+        help="Longest time (ms) to sleep between reads when data is arriving slowly. 0 polls continuously.",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        type=str,
+        default=None,
+        help="File to keep rewriting with connection metrics, Prometheus text if it ends in .prom, otherwise JSON.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=5,
+        help="Seconds between metrics file updates.",
+    )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        nargs="?",
+        const=daemon.DEFAULT_SOCKET,
+        default=None,
+        metavar="SOCKET",
+        help="Listen through a running posey-daemon instead of connecting directly.",
+    )
+    parser.add_argument(
+        "--rx-buffer",
+        type=int,
+        default=DEFAULT_BUFFER_SIZE // 1024,
+        help="UART receive buffer size (KiB). Raise it if it's reported full.",
+    )
+    sim.add_argument(parser)
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="Play back a raw .in.bin capture through the live path instead of connecting.",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay speed, as a multiple of real time (0 for as fast as possible).",
+    )
+    parser.add_argument(
+        "--replay-rate",
+        type=float,
+        default=replay.DEFAULT_RATE / 1024,
+        help="Rate (KBps) to replay captures recorded without a .in.idx chunk index at.",
+    )
+    parser.add_argument(
+        "--sqlite",
+        action="store_true",
+        default=False,
+        help="Also write decoded messages to <capture>.data.sqlite, a table per signal, which can be queried while listening.",
+    )
+    profiling.add_argument(parser)
     args = parser.parse_args()
 
     # Configure logger.
@@ -61,6 +160,10 @@ def posey_listen():
     )
     log = getLogger("main")
     getLogger("asyncio").setLevel(logging.CRITICAL)
+    profiling.start(args.profile, nowstamp)
+
+    # Buffers are allocated on connect, so size them first.
+    UARTService.set_buffer_sizes(rx=args.rx_buffer * 1024)
 
     device_name = args.sensor
 
@@ -70,6 +173,16 @@ def posey_listen():
     log.info(f"Sensor: {device_name}")
     log.info(f"Scan timeout: {args.timeout}")
 
+    if args.daemon is not None:
+        writer = None
+        if args.sqlite:
+            writer = csvw.SQLiteWriter(
+                None, prefix=f"{nowstamp}.", types=hil.FIELD_TYPES
+            )
+            log.info(f"Writing messages to {writer.filename()}")
+        listen_daemon(args.daemon, device_name, log, writer=writer)
+        return
+
     # Config.
     qin = Queue()
     qout = Queue()
@@ -77,7 +190,17 @@ def posey_listen():
 
     # Find sensors.
     log.info(f"Scanning for Posey sensor {device_name}...")
-    ble = BLERadio()
+    if args.replay is not None:
+        ble = replay.ReplayRadio(
+            args.replay,
+            name=f"Posey Replay {device_name}",
+            speed=args.speed,
+            rate=args.replay_rate * 1024,
+        )
+    elif args.sim is not None:
+        ble = sim.SimRadio(**args.sim)
+    else:
+        ble = BLERadio()
     device_adv = None
     for adv in ble.start_scan(
         Advertisement, timeout=args.timeout, minimum_rssi=args.min_rssi
@@ -100,6 +223,7 @@ def posey_listen():
 
     log.info(f"Connecting to {device_adv.complete_name}.")
     sensor = PoseySensor(device_name, ble, device_adv, qout, qin, pq, nowstamp)
+    sensor.hil.quality.warn = True
     log.info(f"Connecting to device {sensor}")
     if sensor.connect():
         log.info(" - Connected.")
@@ -107,8 +231,23 @@ def posey_listen():
         log.error(" - Failed to connect to BLE device.")
         raise RuntimeError("Could not connect to Posey sensor!")
 
+    # Decoded messages are put on qin.
+    writer = None
+    if args.sqlite:
+        writer = csvw.SQLiteWriter(qin, prefix=f"{nowstamp}.", types=hil.FIELD_TYPES)
+        log.info(f"Writing messages to {writer.filename()}")
+        writer.start()
+
+    poller = AdaptivePoller(sensor.hil, max_sleep=args.max_sleep / 1000.0)
+    metrics = None
+    if args.metrics is not None:
+        metrics = MetricsWriter(args.metrics, args.metrics_interval)
     try:
         while True:
+            if (args.replay is not None) and ble.finished:
+                log.info(f"Finished replaying {args.replay}.")
+                break
+
             # Connected?
             if not sensor.connected:
                 log.warning(f"Sensor {sensor.name} disconnected. Reconnecting...")
@@ -130,10 +269,13 @@ def posey_listen():
                     continue
 
             # Collect data.
-            sensor.hil.process_uart()
+            poller.step()
 
             # If time, print statistics.
             sensor.hil.stats.log_stats()
+            poller.log_stats()
+            if metrics is not None:
+                metrics.maybe_write(lambda: [sensor.hil.metrics()])
 
     except KeyboardInterrupt:
         log.info("Keyboard interrupt, breaking.")
@@ -141,9 +283,20 @@ def posey_listen():
     except:
         traceback.print_exc()
 
+    if sensor.service is not None:
+        log.info(f"UART: {sensor.service.stats()}")
+    sensor.hil.timers.log_summary(log)
+    sensor.hil.quality.log_report(log)
     log.info("Disconnecting sensor...")
     sensor.disconnect()
     sensor.hil.close()
+    if writer is not None:
+        log.info("Writing the last messages...")
+        writer.stop_gracefully()
+
+    # Nothing here reads the queues, so don't wait to flush them on exit.
+    for q in [qin, qout, pq]:
+        q.cancel_join_thread()
 
 
 if __name__ == "__main__":
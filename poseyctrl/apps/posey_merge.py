@@ -0,0 +1,132 @@
+from logging import getLogger
+
+import sys
+import csv
+import argparse
+import logging
+import datetime as dt
+
+from poseyctrl import merge
+from poseyctrl import profiling
+
+
+def posey_merge():
+    # Process arguments.
+    parser = argparse.ArgumentParser(
+        "posey-merge",
+        description="Merge per-sensor, per-signal outputs into one time ordered table in a single pass.",
+    )
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="Sorted inputs as [LABEL=]PATH, either CSV (data.<sig>.csv, rssi.csv) or binary captures and extracted slots, which are decoded on the fly.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="-",
+        help="Output CSV (default stdout).",
+    )
+    parser.add_argument(
+        "--on",
+        type=str,
+        default=None,
+        metavar="LABEL",
+        help="Write one row per row of this input, joined with the latest row of every other input at or before it (as-of join). Without it every row of every input is interleaved.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="With --on, leave out rows older than this (in the inputs' time units, microseconds for device time).",
+    )
+    parser.add_argument(
+        "-t",
+        "--time",
+        type=str,
+        default=None,
+        metavar="COLUMN",
+        help=f"Column to merge on (default the first of {', '.join(merge.TIME_COLUMNS)}, pctime for host time).",
+    )
+    parser.add_argument(
+        "-s",
+        "--signal",
+        type=str,
+        action="append",
+        default=None,
+        help="Signal to take from binary inputs, may be repeated (default imu).",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        default=False,
+        help="Enable debug logging.",
+    )
+    parser.add_argument(
+        "-l", "--log", action="store_true", default=False, help="Output log to file."
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+
+    # Configure logger, on stderr so the table can go to stdout.
+    handlers = [logging.StreamHandler()]
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    nowstamp = f"{dtnow}-posey-merge"
+    if args.log:
+        handlers.append(logging.FileHandler(f"{nowstamp}.log"))
+    logging.basicConfig(
+        handlers=handlers,
+        datefmt="%H:%M:%S",
+        format="{name:.<15} {asctime}: [{levelname}] {message}",
+        style="{",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    log = getLogger("main")
+    profiling.start(args.profile, nowstamp)
+
+    signals = args.signal if args.signal is not None else ["imu"]
+    streams = []
+    try:
+        for spec in args.inputs:
+            streams += merge.open_stream(spec, signals, args.time)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    for stream in streams:
+        log.info(f"{stream.label}: {stream.fn} on {stream.time_column}")
+
+    labels = [stream.label for stream in streams]
+    if len(set(labels)) != len(labels):
+        parser.error(f"Input labels must be unique, got {', '.join(labels)}")
+    if (args.on is not None) and (args.on not in labels):
+        parser.error(f"--on {args.on} is not one of {', '.join(labels)}")
+
+    f = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    writer = csv.writer(f, lineterminator="\n")
+    try:
+        if args.on is not None:
+            rows = merge.asof(streams, labels.index(args.on), writer, args.tolerance)
+        else:
+            rows = merge.interleave(streams, writer)
+        log.info(f"Wrote {rows} rows.")
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt, stopping.")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+        for stream in streams:
+            stream.close()
+
+    for stream in streams:
+        if stream.out_of_order > 0:
+            log.warning(
+                f"{stream.label}: {stream.out_of_order} rows went back in time (clock reset?), the output isn't fully sorted around them."
+            )
+        if stream.malformed > 0:
+            log.warning(f"{stream.label}: skipped {stream.malformed} malformed rows.")
+
+
+if __name__ == "__main__":
+    posey_merge()
@@ -7,6 +7,8 @@ import datetime as dt
 from adafruit_ble import BLERadio
 from adafruit_ble.advertising.standard import Advertisement
 
+from poseyctrl import profiling
+
 
 def posey_sniffer():
     # Process arguments.
@@ -30,6 +32,7 @@ def posey_sniffer():
         default=False,
         help="Enable debug logging.",
     )
+    profiling.add_argument(parser)
     args = parser.parse_args()
 
     # Configure logger.
@@ -43,6 +46,8 @@ def posey_sniffer():
     )
     log = getLogger("main")
     getLogger("asyncio").setLevel(logging.CRITICAL)
+    dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    profiling.start(args.profile, f"{dtnow}-posey-sniffer")
 
     # Find sensors.
     log.info(f"Scanning for Posey sensors...")
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import logging
+import traceback
+import glob
+
+from poseyctrl import VERSION
+from poseyctrl import decode
+from poseyctrl import download
+from poseyctrl import profiling
+
+
+MANIFEST = ".posey-batch.json"
+
+
+def fingerprint(fn, block_size=1024 * 1024):
+    # A streamed download is described by its .json but its data is in the
+    # matching .bin, so both go into the hash.
+    fns = [fn]
+    if fn.endswith(".json") and download.is_container(fn):
+        fns = list(download.container_files(fn))
+
+    h = hashlib.sha256()
+    for fn in fns:
+        with open(fn, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Record of which inputs under ``root`` have been processed and into what.
+
+    Entries are keyed by path relative to ``root``. A content hash is only
+    recomputed when a file's size or modification time changes, and an input
+    is up to date when its hash, the tool version and the task all match and
+    every output it produced still exists.
+    """
+
+    def __init__(self, root, fn=None):
+        self.root = root
+        self.fn = fn if fn is not None else os.path.join(root, MANIFEST)
+        self.entries = {}
+        if os.path.isfile(self.fn):
+            with open(self.fn, "r") as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        tmp = f"{self.fn}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.fn)
+
+    def key(self, fn):
+        return os.path.relpath(fn, self.root)
+
+    def fingerprint(self, fn):
+        st = os.stat(fn)
+        entry = self.entries.get(self.key(fn), {})
+        if (entry.get("size") == st.st_size) and (
+            entry.get("mtime_ns") == st.st_mtime_ns
+        ):
+            return entry["sha256"]
+        return fingerprint(fn)
+
+    def up_to_date(self, fn, task, sha256):
+        entry = self.entries.get(self.key(fn))
+        if entry is None:
+            return False
+        return (
+            (entry["sha256"] == sha256)
+            and (entry["task"] == task)
+            and (entry["version"] == VERSION)
+            and all(
+                os.path.exists(os.path.join(self.root, out)) for out in entry["outputs"]
+            )
+        )
+
+    def refresh(self, fn):
+        # Content is unchanged but the file was touched, remember the new
+        # stat so we don't rehash it next time.
+        st = os.stat(fn)
+        entry = self.entries[self.key(fn)]
+        entry["size"] = st.st_size
+        entry["mtime_ns"] = st.st_mtime_ns
+
+    def update(self, fn, task, sha256, outputs):
+        st = os.stat(fn)
+        self.entries[self.key(fn)] = dict(
+            task=task,
+            version=VERSION,
+            sha256=sha256,
+            size=st.st_size,
+            mtime_ns=st.st_mtime_ns,
+            outputs=[self.key(out) for out in outputs],
+        )
+
+
+def find_inputs(root, task):
+    if task == "extract":
+        inputs = glob.glob(os.path.join(root, "**", "*.npz"), recursive=True)
+        inputs += [
+            fn
+            for fn in glob.glob(os.path.join(root, "**", "*.json"), recursive=True)
+            if download.is_container(fn)
+        ]
+    else:
+        # Streamed downloads keep their raw flash data in a .bin too, but
+        # that needs extracting rather than decoding.
+        inputs = [
+            fn
+            for fn in glob.glob(os.path.join(root, "**", "*.bin"), recursive=True)
+            if not (fn.endswith(".out.bin") or download.is_container(fn))
+        ]
+    return sorted(inputs)
+
+
+def run_task(task, fn):
+    """
+    Process one input, intended to run in a worker process.
+
+    :param return: Tuple of (task, input, outputs, error).
+    """
+    log = logging.getLogger(f"batch.{task}")
+    try:
+        with profiling.worker(f"batch-{task}", log):
+            output = os.path.dirname(fn)
+            if task == "extract":
+                # Imported here so the batch tool doesn't drag in the extract
+                # dependencies unless there is something to extract.
+                from poseyctrl.apps.posey_extract import extract
+
+                prefix = os.path.splitext(os.path.basename(fn))[0] + "-"
+                outputs = extract(fn, prefix=prefix, output=output, log=log)
+            else:
+                name = decode.default_prefix(fn)
+                prefix = os.path.join(output, f"{name}.")
+                decoded = decode.decode_file(fn, name, prefix)
+                log.info(f"Decoded {decoded} messages from {fn}")
+                outputs = sorted(glob.glob(f"{glob.escape(prefix)}data.*.csv"))
+        return task, fn, outputs, None
+    except Exception:
+        return task, fn, [], traceback.format_exc()
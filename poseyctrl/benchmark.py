@@ -0,0 +1,264 @@
+import sys
+import time
+import json
+import struct
+import socket
+import logging
+import platform
+import datetime as dt
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import numpy as np
+
+from pyposey import MessageAck
+from pyposey.control import CommandType, CommandMessage
+
+from poseyctrl.patch.nordic import UARTService
+
+
+PERCENTILES = [50, 90, 99]
+
+
+def noop(seq):
+    """NoOp command carrying ``seq`` in its payload so the ack can be matched."""
+    cmd = CommandMessage()
+    cmd.message.command = CommandType.NoOp
+    cmd.message.ack = MessageAck.Expected
+    cmd.message.payload = np.frombuffer(struct.pack("<I", seq), dtype="u1")
+    cmd.serialize()
+    return cmd
+
+
+def ack_seq(data):
+    try:
+        return struct.unpack("<I", bytes(np.asarray(data["payload"], "u1")[:4]))[0]
+    except (KeyError, TypeError, ValueError, struct.error):
+        return None
+
+
+def summarize(samples):
+    if len(samples) == 0:
+        return dict(n=0)
+    ms = 1e3 * np.asarray(samples)
+    summary = dict(n=len(ms), min=ms.min(), mean=ms.mean(), max=ms.max(), std=ms.std())
+    for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+        summary[f"p{p}"] = v
+    return {k: float(v) for k, v in summary.items()}
+
+
+def environment(sensor=None):
+    env = dict(
+        time=dt.datetime.now().astimezone().replace(microsecond=0).isoformat(),
+        host=socket.gethostname(),
+        platform=platform.platform(),
+        python=sys.version.split()[0],
+    )
+    for k, v in UARTService.buffer_sizes().items():
+        env[f"{k}_buffer"] = v
+    if sensor is not None:
+        env["sensor"] = sensor.name
+        env["address"] = sensor.advertisement.address.string
+        if sensor.service is not None:
+            env["uart"] = sensor.service.stats()
+    return env
+
+
+class LinkBenchmark:
+    """
+    Measures a connected sensor's BLE link.
+
+    ``latency`` sends NoOp commands, keeping up to ``window`` unacknowledged,
+    and times each round trip. Every NoOp carries a sequence number, which
+    acks are matched on, so acks arriving behind a later command's are
+    counted as out of order. Commands with no ack within ``timeout`` are
+    counted as lost, and their acks as late if they turn up afterwards,
+    without resolving any other command. ``receive`` measures the
+    sustained rate data arrives at, from whatever the sensor is streaming.
+    """
+
+    def __init__(self, sensor, log=None):
+        self.sensor = sensor
+        self.hil = sensor.hil
+        self.log = log if log is not None else logging.getLogger("benchmark")
+
+    def latency(self, count=100, window=1, timeout=5.0):
+        # Commands awaiting an ack, and those that timed out but whose acks
+        # may still turn up, by sequence number, with both in send order.
+        sent = {}
+        expired = {}
+        order = deque()
+        received = {}
+        rtts = []
+        lost = 0
+        late = 0
+        out_of_order = 0
+        bad_acks = 0
+        highest = -1
+
+        # Acks are taken from one stream and matched to commands by the
+        # sequence number they echo, so a late ack can't resolve a later
+        # command. Anything left over from before is stale.
+        self.hil.discard_unclaimed()
+        stream = None
+
+        t0 = time.perf_counter()
+        seq = 0
+        while (seq < count) or sent:
+            while (seq < count) and (len(sent) < window):
+                sent[seq] = time.perf_counter()
+                order.append(seq)
+                self.hil.send(noop(seq))
+                seq += 1
+
+            if stream is None:
+                # Stamped as soon as the ack is decoded.
+                stream = self.hil.expect_ack(CommandType.NoOp)
+                stream.add_done_callback(
+                    lambda f: received.setdefault(f, time.perf_counter())
+                )
+            oldest = min(sent)
+            left = timeout - (time.perf_counter() - sent[oldest])
+            try:
+                data = self.hil.wait(stream, timeout=max(left, 0))
+            except FutureTimeout:
+                received.pop(stream, None)
+                stream = None
+                now = time.perf_counter()
+                for s in [s for s, t in sent.items() if now - t >= timeout]:
+                    lost += 1
+                    expired[s] = now
+                    del sent[s]
+                    self.log.debug(f"No ack for NoOp {s}")
+                continue
+            stamp = received.pop(stream)
+            stream = None
+
+            # Commands that timed out long ago are given up on, so they can't
+            # soak up acks without a sequence number forever.
+            while order and (order[0] in expired):
+                if stamp - expired[order[0]] < timeout:
+                    break
+                del expired[order.popleft()]
+
+            got = ack_seq(data)
+            if got is None:
+                # Without the sequence echoed back, assume acks arrive in
+                # order, including those for commands that timed out.
+                got = order[0] if order else None
+            if got in expired:
+                late += 1
+                del expired[got]
+                order.remove(got)
+                self.log.debug(f"Ack for NoOp {got} arrived after timing out")
+                continue
+            if got not in sent:
+                late += 1
+                self.log.debug(f"Ack for NoOp {got} doesn't match a command")
+                continue
+            order.remove(got)
+            if got < highest:
+                out_of_order += 1
+                self.log.debug(f"Ack for NoOp {got} arrived after {highest}")
+            highest = max(highest, got)
+            if data["ack"] != MessageAck.OK:
+                bad_acks += 1
+            rtts.append(stamp - sent.pop(got))
+        if stream is not None:
+            stream.cancel()
+        elapsed = time.perf_counter() - t0
+
+        result = dict(
+            count=count,
+            window=window,
+            timeout=timeout,
+            acked=len(rtts),
+            lost=lost,
+            late=late,
+            out_of_order=out_of_order,
+            bad_acks=bad_acks,
+            elapsed=elapsed,
+            commands_per_second=count / elapsed if elapsed > 0 else None,
+            rtt_ms=summarize(rtts),
+        )
+        self.log.info(
+            f"Latency: {len(rtts)}/{count} acked, {lost} lost ({late} acked late), {out_of_order} out of order, RTT p50 {result['rtt_ms'].get('p50', float('nan')):.1f} ms p99 {result['rtt_ms'].get('p99', float('nan')):.1f} ms"
+        )
+        return result
+
+    def receive(self, duration=10.0, interval=1.0):
+        buffer = bytearray(64 * 1024)
+        total = 0
+        rates = []
+        t0 = time.perf_counter()
+        tu = t0
+        bu = 0
+        while True:
+            now = time.perf_counter()
+            if now - t0 >= duration:
+                break
+            if now - tu >= interval:
+                rates.append((total - bu) / 1024.0 / (now - tu))
+                tu = now
+                bu = total
+            n = self.hil.readinto_uart(buffer)
+            if n > 0:
+                self.hil.record_raw(memoryview(buffer)[:n])
+            total += n
+        elapsed = time.perf_counter() - t0
+
+        rates = np.asarray(rates) if len(rates) > 0 else np.zeros(1)
+        result = dict(
+            duration=elapsed,
+            bytes=total,
+            average_kbps=total / 1024.0 / elapsed,
+            min_kbps=float(rates.min()),
+            max_kbps=float(rates.max()),
+        )
+        self.log.info(
+            f"Receive: {total / 1024.0:.1f} KB in {elapsed:.1f} s, average {result['average_kbps']:.2f} KBps (min {result['min_kbps']:.2f}, max {result['max_kbps']:.2f})"
+        )
+        return result
+
+    def run(self, count=100, window=1, timeout=5.0, duration=10.0):
+        result = dict(environment=environment(self.sensor))
+        result["latency"] = self.latency(count, window, timeout)
+        if duration > 0:
+            result["receive"] = self.receive(duration)
+        return result
+
+
+COLUMNS = [
+    ("Host", lambda r: r["environment"]["host"]),
+    ("Sensor", lambda r: r["environment"].get("sensor", "")),
+    ("RX buf", lambda r: r["environment"]["rx_buffer"]),
+    ("Win", lambda r: r["latency"]["window"]),
+    ("Lost", lambda r: r["latency"]["lost"]),
+    ("OoO", lambda r: r["latency"]["out_of_order"]),
+    ("p50 ms", lambda r: f"{r['latency']['rtt_ms'].get('p50', float('nan')):.1f}"),
+    ("p99 ms", lambda r: f"{r['latency']['rtt_ms'].get('p99', float('nan')):.1f}"),
+    ("cmd/s", lambda r: f"{r['latency']['commands_per_second'] or 0:.1f}"),
+    (
+        "KBps",
+        lambda r: f"{r['receive']['average_kbps']:.2f}" if "receive" in r else "",
+    ),
+]
+
+
+def compare(results, names=None):
+    """
+    Tabulate benchmark results side by side.
+
+    :param return: List of lines.
+    """
+    names = names if names is not None else [str(i) for i in range(len(results))]
+    rows = [["Run"] + [name for name, _ in COLUMNS]]
+    for name, result in zip(names, results):
+        rows.append([name] + [str(column(result)) for _, column in COLUMNS])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ["  ".join(v.rjust(w) for v, w in zip(row, widths)) for row in rows]
+
+
+def load(fn):
+    with open(fn, "r") as f:
+        return json.load(f)
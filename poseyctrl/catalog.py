@@ -0,0 +1,403 @@
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+import logging
+import traceback
+import datetime as dt
+
+from poseyctrl import VERSION
+from poseyctrl import profiling
+from poseyctrl.quality import PERIODIC, TIME_FIELDS
+
+
+CATALOG = ".posey-catalog.sqlite"
+
+# Columns of the artifacts table. Times are local ISO 8601 strings, so they
+# sort and compare as text.
+FIELDS = [
+    ("path", "TEXT PRIMARY KEY"),
+    ("kind", "TEXT"),
+    ("size", "INTEGER"),
+    ("mtime_ns", "INTEGER"),
+    ("version", "TEXT"),
+    ("indexed", "TEXT"),
+    ("sensor", "TEXT"),
+    # The signal of a CSV, or those seen in a capture (comma-separated).
+    ("signal", "TEXT"),
+    ("datetime", "TEXT"),
+    ("start_ms", "INTEGER"),
+    ("end_ms", "INTEGER"),
+    ("duration", "REAL"),
+    ("bytes", "INTEGER"),
+    ("received", "INTEGER"),
+    ("complete", "INTEGER"),
+    ("slots", "INTEGER"),
+    ("blocks", "INTEGER"),
+    ("messages", "INTEGER"),
+    ("rows", "INTEGER"),
+    ("checksum_failures", "INTEGER"),
+    ("skipped_bytes", "INTEGER"),
+    ("gaps", "INTEGER"),
+    ("missing", "INTEGER"),
+    ("resets", "INTEGER"),
+    ("missed_deadlines", "INTEGER"),
+    ("error", "TEXT"),
+]
+COLUMNS = [name for name, _ in FIELDS]
+
+# Kinds of artifact, by what produced them.
+KINDS = ["download", "capture", "commands", "slot", "csv"]
+
+# Time stamps in the file names the tools write, and the sensor names in
+# posey-listen and posey-daemon captures.
+STAMP = re.compile(r"(\d{8}_\d{6})")
+LISTEN = re.compile(r"posey-listen-(.+)-\d{8}_\d{6}")
+DAEMON = re.compile(r"\d{8}_\d{6}-posey-daemon-(.+?)(\.in|\.out)?\.bin$")
+
+# Device time units of CSV time columns, as in merge.TIME_COLUMNS.
+TIME_COLUMNS = ["time", "t_start"]
+
+# Longest step in device time (us) counted towards a capture's duration,
+# anything longer is a gap or a clock reset.
+MAX_STEP = 60e6
+
+
+def kind(fn):
+    """:param return: The kind of artifact ``fn`` is, None if it isn't one."""
+    base = os.path.basename(fn)
+    if base.endswith(".npz"):
+        return "download"
+    if base.endswith(".json") or base.endswith(".bin"):
+        # Local import, download pulls in NumPy.
+        from poseyctrl import download
+
+        if download.is_container(fn):
+            # The .bin of a streamed download is described with its .json.
+            return "download" if base.endswith(".json") else None
+        if base.endswith(".json"):
+            return None
+        if base.endswith(".out.bin"):
+            return "commands"
+        if base.endswith(".in.bin"):
+            return "capture"
+        return "slot"
+    if base.endswith(".csv") and (base.startswith("data.") or ".data." in base):
+        return "csv"
+    if base.endswith("rssi.csv"):
+        return "csv"
+    return None
+
+
+def find_artifacts(root):
+    """:param return: Sorted list of artifacts under ``root``."""
+    found = []
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for f in files:
+            fn = os.path.join(directory, f)
+            if (not f.startswith(".")) and (kind(fn) is not None):
+                found.append(fn)
+    return sorted(found)
+
+
+def local_iso(timestamp):
+    return dt.datetime.fromtimestamp(timestamp).replace(microsecond=0).isoformat()
+
+
+def from_filename(fn):
+    """:param return: Tuple of (sensor, datetime) from the tools' file names."""
+    base = os.path.basename(fn)
+    sensor = None
+    match = LISTEN.search(base)
+    if match is None:
+        match = DAEMON.search(base)
+    if match is not None:
+        sensor = match.group(1)
+    when = None
+    stamp = STAMP.search(base)
+    if stamp is not None:
+        when = dt.datetime.strptime(stamp.group(1), "%Y%m%d_%H%M%S").isoformat()
+    return sensor, when
+
+
+def describe_download(fn, deep=True):
+    # Imported here, these need NumPy and pyposey.
+    from dateutil.parser import parse
+
+    from poseyctrl import download
+    from poseyctrl import flash
+
+    summary, data, datab = download.load(fn)
+    info = dict(
+        sensor=summary["sensor"],
+        datetime=parse(summary["datetime"][:19]).isoformat(),
+        start_ms=summary["start_ms"],
+        end_ms=summary["end_ms"],
+        duration=(summary["end_ms"] - summary["start_ms"]) * 1e-3,
+        bytes=summary["bytes"],
+        received=len(data),
+        complete=int(len(data) >= summary["bytes"]),
+    )
+    if fn.endswith(".json"):
+        with open(fn, "r") as f:
+            info["complete"] = int(json.load(f).get("complete", info["complete"]))
+    if deep:
+        parser = flash.FlashBlockParser(
+            summary["start_ms"], logging.getLogger("catalog.flash")
+        )
+        parser.feed(data, datab, len(data), final=True)
+        info.update(
+            slots=len(parser.slot_blocks),
+            blocks=sum(parser.slot_blocks.values()),
+            checksum_failures=parser.checksum_failures,
+            skipped_bytes=parser.skipped,
+        )
+    return info
+
+
+class CaptureSummary:
+    """
+    Queue stand-in adding up how much device time each periodic signal's
+    messages cover, skipping gaps and clock resets.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.covered = {}
+        self.signals = set()
+
+    def put(self, item):
+        sig, _, data = item
+        if data is None:
+            return
+        self.signals.add(sig)
+        if sig not in PERIODIC:
+            return
+        t = data[TIME_FIELDS[sig]]
+        last = self.last.get(sig)
+        self.last[sig] = t
+        if (last is not None) and (0 < t - last < MAX_STEP):
+            self.covered[sig] = self.covered.get(sig, 0) + t - last
+
+    def duration(self):
+        """:param return: Seconds covered by the longest running signal."""
+        return max(self.covered.values(), default=0) * 1e-6
+
+    def qsize(self):
+        return 0
+
+
+def describe_capture(fn, deep=True):
+    sensor, when = from_filename(fn)
+    info = dict(sensor=sensor, datetime=when)
+    if not deep:
+        return info
+
+    from poseyctrl import decode
+    from poseyctrl import hil
+
+    summary = CaptureSummary()
+    name = sensor if sensor is not None else decode.default_prefix(fn)
+    sensor = hil.PoseyHIL(name, None, summary, None, None, None, None)
+    sensor.log.setLevel(logging.CRITICAL)
+    for block in decode.read_blocks(fn):
+        sensor.feed(block)
+    totals = sensor.quality.totals()
+    info.update(
+        signal=",".join(sorted(summary.signals)),
+        duration=summary.duration(),
+        messages=sensor.decoded,
+        checksum_failures=sum(sensor.stats.checksum_errors.values()),
+        skipped_bytes=sensor.metrics()["bytes_skipped"],
+        gaps=totals["gaps"],
+        missing=totals["missing"],
+        resets=totals["resets"],
+        missed_deadlines=totals["missed_deadline"],
+    )
+    return info
+
+
+def describe_csv(fn):
+    base = os.path.basename(fn)
+    signal = "rssi" if base.endswith("rssi.csv") else base.rsplit(".", 2)[-2]
+    sensor, when = from_filename(fn)
+    info = dict(sensor=sensor, signal=signal, datetime=when, rows=0)
+    quality = signal == "quality"
+    sums = dict(gaps=0, missing=0, resets=0, checksum_failures=0, missed_deadline=0)
+    first = last = None
+    with open(fn, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return info
+        ti = next((header.index(c) for c in TIME_COLUMNS if c in header), None)
+        si = header.index("sensor") if "sensor" in header else None
+        qi = {key: header.index(key) for key in sums} if quality else {}
+        for row in reader:
+            if len(row) != len(header):
+                continue
+            info["rows"] += 1
+            if (si is not None) and (info.get("sensor") is None):
+                info["sensor"] = row[si]
+            if ti is not None:
+                last = row[ti]
+                first = last if first is None else first
+            for key, i in qi.items():
+                sums[key] += int(row[i])
+    if (first is not None) and (last is not None):
+        # rssi.csv times are in seconds, device times in microseconds.
+        scale = 1 if signal == "rssi" else 1e-6
+        info["duration"] = (float(last) - float(first)) * scale
+    if quality:
+        sums["missed_deadlines"] = sums.pop("missed_deadline")
+        info.update(sums)
+    return info
+
+
+def describe(fn, deep=True):
+    """
+    Describe one artifact, intended to run in a worker process.
+
+    :param deep: Read downloads and captures through, for block, message and
+        quality counts, rather than only their headers and names.
+    :param return: Tuple of (file, info dict).
+    """
+    with profiling.worker("catalog"):
+        what = kind(fn)
+        st = os.stat(fn)
+        info = dict(kind=what, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        try:
+            if what == "download":
+                info.update(describe_download(fn, deep))
+            elif what in ["capture", "slot"]:
+                info.update(describe_capture(fn, deep))
+            elif what == "csv":
+                info.update(describe_csv(fn))
+            else:
+                info.update(zip(["sensor", "datetime"], from_filename(fn)))
+        except Exception:
+            info["error"] = traceback.format_exc().strip().splitlines()[-1]
+        if info.get("datetime") is None:
+            info["datetime"] = local_iso(st.st_mtime)
+    return fn, info
+
+
+class Catalog:
+    """
+    SQLite index of the artifacts under one or more directories.
+
+    Paths are stored relative to the database's directory. An artifact is
+    described again only when its size or modification time changes, or
+    the tool version does.
+    """
+
+    def __init__(self, fn=CATALOG):
+        self.fn = fn
+        self.root = os.path.dirname(os.path.abspath(fn))
+        self.db = sqlite3.connect(fn)
+        self.db.row_factory = sqlite3.Row
+        columns = ", ".join(f"{name} {kind}" for name, kind in FIELDS)
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS artifacts ({columns})")
+        for column in ["sensor", "datetime", "kind"]:
+            self.db.execute(
+                f"CREATE INDEX IF NOT EXISTS artifacts_{column} "
+                f"ON artifacts ({column})"
+            )
+        self.db.commit()
+
+    def key(self, fn):
+        return os.path.relpath(os.path.abspath(fn), self.root)
+
+    def stale(self, fns):
+        """:param return: Those of ``fns`` that need (re)describing."""
+        rows = self.db.execute("SELECT path, size, mtime_ns, version FROM artifacts")
+        known = {
+            row["path"]: (row["size"], row["mtime_ns"], row["version"]) for row in rows
+        }
+        todo = []
+        for fn in fns:
+            st = os.stat(fn)
+            if known.get(self.key(fn)) != (st.st_size, st.st_mtime_ns, VERSION):
+                todo.append(fn)
+        return todo
+
+    def add(self, fn, info):
+        row = dict(info, path=self.key(fn), version=VERSION)
+        row["indexed"] = local_iso(time.time())
+        values = [row.get(name) for name in COLUMNS]
+        self.db.execute(
+            f"INSERT OR REPLACE INTO artifacts ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})",
+            values,
+        )
+
+    def prune(self, root, fns):
+        """
+        Forget artifacts under ``root`` that are no longer in ``fns``.
+
+        :param return: Number forgotten.
+        """
+        prefix = self.key(root)
+        keep = {self.key(fn) for fn in fns}
+        gone = []
+        for (path,) in self.db.execute("SELECT path FROM artifacts"):
+            under = (prefix == ".") or path.startswith(prefix + os.sep)
+            if under and (path not in keep):
+                gone.append((path,))
+        self.db.executemany("DELETE FROM artifacts WHERE path = ?", gone)
+        return len(gone)
+
+    def commit(self):
+        self.db.commit()
+
+    def query(
+        self,
+        sensor=None,
+        kind=None,
+        signal=None,
+        since=None,
+        until=None,
+        where=None,
+        order="datetime, path",
+    ):
+        """
+        Find artifacts.
+
+        :param sensor: Sensor name, with ``*`` and ``?`` wildcards.
+        :param signal: A decoded signal, or one found in a capture.
+        :param since: Earliest datetime, as a prefix of ISO 8601 (2024-03).
+        :param until: Datetimes before this.
+        :param where: Extra SQL condition on the columns in FIELDS.
+        :param return: List of dicts.
+        """
+        clauses = []
+        params = []
+        if sensor is not None:
+            clauses.append("sensor GLOB ?")
+            params.append(sensor)
+        if kind is not None:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if signal is not None:
+            # Captures list every signal in them.
+            clauses.append("(',' || signal || ',') LIKE ?")
+            params.append(f"%,{signal},%")
+        if since is not None:
+            clauses.append("datetime >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("datetime < ?")
+            params.append(until)
+        if where is not None:
+            clauses.append(f"({where})")
+        sql = "SELECT * FROM artifacts"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY {order}"
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    def close(self):
+        self.db.close()
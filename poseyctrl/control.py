@@ -0,0 +1,597 @@
+import os
+import time
+import json
+import fnmatch
+import logging
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import numpy as np
+from multiprocess import Queue
+
+from adafruit_ble.advertising.standard import Advertisement
+
+from pyposey import MessageAck
+from pyposey.control import CommandType, CommandMessage
+
+from poseyctrl.download import DownloadFile
+from poseyctrl.flash import FlashBlockParser, SlotWriter
+from poseyctrl.sensor import PoseySensor
+
+
+COMMANDS = [
+    "noop",
+    "reboot",
+    "startrecording",
+    "stoprecording",
+    "datasummary",
+    "download",
+    "flasherase",
+]
+
+# Seconds to wait for the first ack to a command, and for the second ack of
+# commands that kick off something slow (a full flash erase is ~2m30s).
+ACK_TIMEOUT = 60
+LONG_ACK_TIMEOUT = 600
+
+
+def is_pattern(name):
+    return any(c in name for c in "*?[")
+
+
+def matches(complete_name, name):
+    """
+    Check a device name against a requested sensor name.
+
+    Plain names match as a case-insensitive substring, as posey-cmd always
+    has; names containing wildcards are matched as a glob.
+    """
+    cn = complete_name.lower()
+    if is_pattern(name):
+        return fnmatch.fnmatch(cn, name.lower())
+    return name.lower() in cn
+
+
+def scan(ble, names, timeout, log, first=False, **kwargs):
+    """
+    Scan for Posey sensors matching any of ``names``.
+
+    Scanning stops early once every plain name has been found (or on the
+    first match with ``first``), otherwise it runs until ``timeout``.
+
+    :param return: Dict of complete device name to advertisement.
+    """
+    found = {}
+    for adv in ble.start_scan(Advertisement, timeout=timeout, **kwargs):
+        if adv.complete_name is None:
+            continue
+        cn = adv.complete_name.lower()
+        if ("posey" not in cn) or (adv.complete_name in found):
+            continue
+        if any(matches(adv.complete_name, name) for name in names):
+            name = adv.complete_name
+            log.info(f"Found Posey {name} (Address: {adv.address.string})")
+            found[name] = adv
+            if first:
+                break
+            if not any(is_pattern(name) for name in names) and all(
+                any(matches(cn, name) for cn in found) for name in names
+            ):
+                break
+    ble.stop_scan()
+    return found
+
+
+def parse_script(lines):
+    """
+    Parse a posey-cmd script.
+
+    Each line holds a command followed by any of the options
+    ``timeout=<seconds>``, ``long_timeout=<seconds>``, ``validate`` and
+    ``extract``, which set the matching ``PoseyController.run`` arguments for
+    that step. Blank lines and anything after a ``#`` are ignored.
+
+    :param return: List of step dicts, each with a ``command``.
+    """
+    steps = []
+    for i, line in enumerate(lines):
+        words = line.split("#", 1)[0].split()
+        if len(words) == 0:
+            continue
+        step = dict(command=words[0].lower())
+        if step["command"] not in COMMANDS:
+            raise ValueError(f"Line {i + 1}: unknown command {words[0]}")
+        for word in words[1:]:
+            key, _, value = word.partition("=")
+            if (key in ["timeout", "long_timeout"]) and value:
+                step[key] = float(value)
+            elif (key in ["validate", "extract"]) and not value:
+                step[key] = True
+            else:
+                raise ValueError(f"Line {i + 1}: invalid option {word}")
+        steps.append(step)
+    return steps
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandCancelled(Exception):
+    pass
+
+
+class PoseyController:
+    """
+    Runs posey-cmd commands against a connected sensor.
+
+    ``state`` tracks where in a command the controller is so progress can be
+    reported from another thread.
+    """
+
+    def __init__(self, sensor, log=None, dtnow=None, directory="."):
+        self.sensor = sensor
+        self.log = log if log is not None else logging.getLogger(f"cmd.{sensor.name}")
+        self.dtnow = (
+            dtnow if dtnow is not None else dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        )
+        self.directory = directory
+
+        self.state = "idle"
+        self.acked = False
+        self.cancelled = False
+        self.download = None
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise CommandCancelled("Cancelled")
+
+    @property
+    def progress(self):
+        if (self.download is None) or (self.download.size == 0):
+            return None
+        return self.download.received / self.download.size
+
+    def wait(self, future, timeout, what):
+        try:
+            return self.sensor.hil.wait(
+                future, timeout=timeout, stop=self.check_cancelled
+            )
+        except FutureTimeout:
+            self.log.error(f"Timeout while waiting for {what}!")
+            raise CommandTimeout(f"Timeout while waiting for {what}")
+        finally:
+            future.cancel()
+
+    def wait_for_ack(self, future, timeout=ACK_TIMEOUT):
+        self.log.info("Waiting for ack...")
+        data = self.wait(future, timeout, "ack")
+        self.log.info(f"Found ack: 0x{data['ack']:02x}")
+        self.acked = True
+        return data
+
+    def wait_for_datasummary(self, future, timeout=ACK_TIMEOUT):
+        self.log.info("Waiting for datasummary...")
+        data = self.wait(future, timeout, "DataSummary")
+        self.log.info("Got DataSummary message:")
+        self.log.info(json.dumps(data, indent=4))
+        return data
+
+    def wait_for_download(self, download, parser=None):
+        bytes = download.size
+        self.log.info("Waiting for %.2f MB...", bytes / 1024.0 / 1024.0)
+        t0 = time.time()
+        tu = t0
+        bu = 0
+
+        while download.remaining > 0:
+            # Received bytes go directly into the memory-mapped download,
+            # blocking until data arrives rather than sleeping.
+            with download.view() as view:
+                data_len = self.sensor.hil.readinto_uart(view)
+            download.commit(data_len)
+            if (parser is not None) and (data_len > 0):
+                parser.feed(download.mmap, download.mmap, download.received)
+
+            now = time.time()
+            dt = now - tu
+            if (dt > 10) or (download.remaining <= 0):
+                bytes_read = download.received
+                self.log.info(
+                    "Waiting for %.2f/%.2f MB (%.2f%%, %.2f KBps, average %.2f KBps)",
+                    download.remaining / 1024.0 / 1024.0,
+                    bytes / 1024.0 / 1024.0,
+                    100.0 * download.remaining / bytes,
+                    (bytes_read - bu) / 1024.0 / dt,
+                    bytes_read / 1024.0 / (now - t0),
+                )
+                if parser is not None:
+                    self.log.info(parser.stats())
+                tu = now
+                bu = bytes_read
+
+            if not self.sensor.connected:
+                self.log.error("Sensor disconnected during download!")
+                break
+            self.check_cancelled()
+
+        return download.received
+
+    def command_message(self, command):
+        """
+        Build the message that starts ``command``.
+
+        :param return: Tuple of (CommandMessage, expected ack).
+        """
+        cmd = CommandMessage()
+        cmd.message.ack = MessageAck.Expected
+        expected_ack = MessageAck.OK
+        if command == "noop":
+            cmd.message.command = CommandType.NoOp
+        elif command == "reboot":
+            cmd.message.command = CommandType.Reboot
+        elif command == "startrecording":
+            cmd.message.command = CommandType.StartCollecting
+            cmd.message.payload = np.frombuffer(
+                dt.datetime.now()
+                .astimezone()
+                .strftime("%Y-%m-%d %H:%M:%S %z\0")
+                .encode("UTF-8"),
+                dtype="u1",
+            )
+            expected_ack = MessageAck.Working
+            self.log.info(
+                "Data recording will start after flash erase. This may take up to a few minutes."
+            )
+        elif command == "flasherase":
+            cmd.message.command = CommandType.FullFlashErase
+            expected_ack = MessageAck.Working
+            self.log.info(
+                "A full flash erase may take up to a few minutes (typical 2m30s)."
+            )
+        elif command == "stoprecording":
+            cmd.message.command = CommandType.StopCollecting
+        elif (command == "download") or (command == "datasummary"):
+            cmd.message.command = CommandType.GetDataSummary
+        else:
+            raise ValueError(f"Unknown command: {command}")
+        cmd.serialize()
+        return cmd, expected_ack
+
+    def run(
+        self,
+        command,
+        validate=False,
+        extract=False,
+        timeout=ACK_TIMEOUT,
+        long_timeout=LONG_ACK_TIMEOUT,
+    ):
+        """
+        Run ``command`` to completion.
+
+        :param timeout: Seconds to wait for the ack and DataSummary.
+        :param long_timeout: Seconds to wait for the second ack of a flash
+            erase or start recording.
+        :param return: Result dict; ``ok`` is False if the sensor responded
+            with an unexpected ack or didn't deliver everything.
+        """
+        result = dict(sensor=self.sensor.name, command=command, ok=True)
+        self.acked = False
+
+        cmd, expected_ack = self.command_message(command)
+        self.state = "sending"
+        # Responses are matched to what we asked for. Nothing is decoded until
+        # we wait, so registering for the summary right after sending still
+        # catches it if it arrives right behind the ack, but not one left over
+        # from before.
+        ack = self.sensor.hil.request(cmd)
+        summary = None
+        if cmd.message.command == CommandType.GetDataSummary:
+            summary = self.sensor.hil.expect_datasummary()
+        self.log.info(
+            f"Sent init command for {command}: 0x{cmd.message.command:02x} {cmd.message.command_str()}"
+        )
+
+        # Wait for ack.
+        self.state = "waiting for ack"
+        data = self.wait_for_ack(ack, timeout=timeout)
+        result["ack"] = data["ack"]
+
+        if data["ack"] != expected_ack:
+            self.log.error(f"Bad ack returned after init: 0x{data['ack']:02x}")
+            result["ok"] = False
+        elif command == "flasherase":
+            self.log.info("Waiting for acknowledgement that flash erase completed...")
+            self.state = "erasing"
+            data = self.wait_for_ack(
+                self.sensor.hil.expect_ack(cmd.message.command),
+                timeout=long_timeout,
+            )
+            result["ack"] = data["ack"]
+            if data["ack"] != MessageAck.OK:
+                self.log.error(
+                    f"Unexpected ack in response to flash erase: 0x{data['ack']:02x}"
+                )
+                result["ok"] = False
+        elif command == "startrecording":
+            self.log.info("Waiting for acknowledgement that recording started...")
+            self.state = "starting"
+            data = self.wait_for_ack(
+                self.sensor.hil.expect_ack(cmd.message.command),
+                timeout=long_timeout,
+            )
+            result["ack"] = data["ack"]
+            if data["ack"] != MessageAck.OK:
+                self.log.error(
+                    f"Unexpected ack in response to start recording: 0x{data['ack']:02x}"
+                )
+                result["ok"] = False
+        elif command == "datasummary":
+            self.state = "waiting for summary"
+            result["summary"] = self.wait_for_datasummary(summary, timeout=timeout)
+        elif command == "download":
+            self.state = "waiting for summary"
+            data_summary = self.wait_for_datasummary(summary, timeout=timeout)
+            result["summary"] = data_summary
+            result.update(
+                self.run_download(cmd, data_summary, validate, extract, timeout)
+            )
+
+        if summary is not None:
+            summary.cancel()
+        self.state = "done" if result["ok"] else "failed"
+        return result
+
+    def run_script(self, steps, **kwargs):
+        """
+        Run each step from ``parse_script`` in order on this connection,
+        stopping at the first one that fails.
+
+        :param kwargs: Defaults for ``run``, overridden by step options.
+        :param return: Result dict with the results of each step run.
+        """
+        result = dict(sensor=self.sensor.name, command="script", ok=True, steps=[])
+        for i, step in enumerate(steps):
+            command = step["command"]
+            options = dict(kwargs)
+            options.update({k: v for k, v in step.items() if k != "command"})
+            self.log.info(f"Step {i + 1}/{len(steps)}: {command}")
+            try:
+                step_result = self.run(command, **options)
+            except CommandTimeout as e:
+                # Nothing has happened yet if the very first command was never
+                # acked, so leave that to the caller to retry.
+                if (i == 0) and not self.acked:
+                    raise
+                step_result = dict(
+                    sensor=self.sensor.name, command=command, ok=False, error=str(e)
+                )
+            finally:
+                # Once a step has gone through, rerunning the script from the
+                # start isn't safe.
+                self.acked = self.acked or (i > 0)
+            result["steps"].append(step_result)
+            if not step_result["ok"]:
+                self.log.error(f"Step {i + 1} ({command}) failed, stopping.")
+                result["ok"] = False
+                break
+        return result
+
+    def run_download(
+        self, cmd, data_summary, validate=False, extract=False, timeout=ACK_TIMEOUT
+    ):
+        result = dict(ok=True)
+        bytes = data_summary["bytes"]
+        stem = os.path.join(
+            self.directory, f"{self.dtnow}-{self.sensor.name.replace(' ', '')}-download"
+        )
+        self.log.info(
+            "Streaming %.2f MB download to %s.bin", bytes / 1024.0 / 1024.0, stem
+        )
+        download = DownloadFile(stem, data_summary)
+        self.download = download
+        result["download"] = f"{stem}.json"
+
+        # Optionally parse the flash blocks as they arrive so bad transfers
+        # show up during the download rather than at extraction.
+        fbm_parser = None
+        slot_writer = None
+        if validate or extract:
+            if extract:
+                slot_writer = SlotWriter(f"{stem}-")
+            fbm_parser = FlashBlockParser(
+                data_summary["start_ms"], self.log, on_block=slot_writer
+            )
+
+        try:
+            cmd.message.command = CommandType.DownloadData
+            cmd.serialize()
+            ack = self.sensor.hil.request(cmd)
+            self.log.info(
+                f"Sent download command: 0x{cmd.message.command:02x} {cmd.message.command_str()}"
+            )
+
+            # Wait on data summary and ack.
+            data = self.wait_for_ack(ack, timeout=timeout)
+            result["ack"] = data["ack"]
+            if data["ack"] != MessageAck.Working:
+                self.log.error(
+                    f"Unexpected ack in response to download: 0x{data['ack']:02x}"
+                )
+                result["ok"] = False
+            else:
+                # Wait for download.
+                self.state = "downloading"
+                bytes_read = self.wait_for_download(download, fbm_parser)
+                if bytes_read < bytes:
+                    self.log.error("Only read %d of %d bytes!", bytes_read, bytes)
+                    result["ok"] = False
+                if (fbm_parser is not None) and (download.mmap is not None):
+                    fbm_parser.feed(
+                        download.mmap, download.mmap, download.received, final=True
+                    )
+                    self.log.info(fbm_parser.stats())
+                    result["checksum_failures"] = fbm_parser.checksum_failures
+                    result["slot_bytes"] = fbm_parser.slot_bytes
+        except (KeyboardInterrupt, CommandCancelled):
+            self.log.warning(
+                "Download interrupted, keeping the %d bytes downloaded so far.",
+                download.received,
+            )
+            raise
+        finally:
+            if slot_writer is not None:
+                slot_writer.close()
+            download.close()
+            result["received"] = download.received
+            self.log.info("Downloaded data written to %s.json / %s.bin", stem, stem)
+        return result
+
+
+class FleetDevice:
+    def __init__(self, name, adv):
+        self.name = name
+        self.adv = adv
+        self.state = "pending"
+        self.attempts = 0
+        self.controller = None
+        self.result = None
+        self.error = None
+        self.t0 = None
+        self.t1 = None
+
+    @property
+    def ok(self):
+        return (self.result is not None) and self.result["ok"]
+
+    def status(self):
+        # While a command is running, the controller knows which step it's on.
+        if self.state == "running":
+            return self.controller.state
+        return self.state
+
+    def progress(self):
+        if (self.controller is None) or (self.controller.progress is None):
+            return ""
+        return f"{100.0 * self.controller.progress:5.1f}%"
+
+    def summary(self):
+        return dict(
+            sensor=self.name,
+            address=self.adv.address.string,
+            state=self.state,
+            ok=self.ok,
+            attempts=self.attempts,
+            error=self.error,
+            duration=(self.t1 - self.t0) if self.t1 is not None else None,
+            result=self.result,
+        )
+
+
+class Fleet:
+    """
+    Runs one command, or the steps of a script, on many sensors concurrently.
+
+    Each device gets its own connection, PoseyHIL and controller in a worker
+    thread, with at most ``jobs`` running at once. Failures are retried up to
+    ``retries`` times, but only if the device never acknowledged the command,
+    so a command is never issued twice to a device that already accepted it.
+    """
+
+    def __init__(
+        self,
+        ble,
+        advs,
+        command,
+        jobs=4,
+        retries=2,
+        connect_timeout=10,
+        log=None,
+        dtnow=None,
+        steps=None,
+        **kwargs,
+    ):
+        self.ble = ble
+        self.command = command
+        self.steps = steps
+        self.jobs = jobs
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.log = log if log is not None else logging.getLogger("fleet")
+        self.dtnow = (
+            dtnow if dtnow is not None else dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        )
+        self.kwargs = kwargs
+        self.devices = [FleetDevice(name, adv) for name, adv in sorted(advs.items())]
+
+    def work(self, device):
+        device.t0 = time.time()
+        while True:
+            device.attempts += 1
+            nowstamp = (
+                f"{self.dtnow}-posey-cmd-{device.name.replace(' ', '')}-{self.command}"
+            )
+            sensor = PoseySensor(
+                device.name, self.ble, device.adv, Queue(), Queue(), Queue(), nowstamp
+            )
+            controller = PoseyController(sensor, dtnow=self.dtnow)
+            device.controller = controller
+            try:
+                device.state = "connecting"
+                if not sensor.connect(timeout=self.connect_timeout):
+                    raise ConnectionError("Could not connect to Posey sensor")
+                device.state = "running"
+                if self.steps is not None:
+                    device.result = controller.run_script(self.steps, **self.kwargs)
+                else:
+                    device.result = controller.run(self.command, **self.kwargs)
+                device.state = controller.state
+                device.error = None
+                break
+            except CommandCancelled:
+                device.state = "cancelled"
+                break
+            except Exception as e:
+                device.error = f"{type(e).__name__}: {e}"
+                controller.log.error(
+                    f"Attempt {device.attempts} failed: {device.error}"
+                )
+                if controller.acked or (device.attempts > self.retries):
+                    device.state = "failed"
+                    break
+                device.state = "retrying"
+            finally:
+                sensor.disconnect()
+                sensor.hil.close()
+            time.sleep(1)
+        device.t1 = time.time()
+
+    def table(self):
+        lines = [f"{'Sensor':24s} {'State':20s} {'Try':>3s} {'Progress':>8s}  Error"]
+        for device in self.devices:
+            lines.append(
+                f"{device.name:24s} {device.status():20s} {device.attempts:3d} {device.progress():>8s}  {device.error or ''}"
+            )
+        return lines
+
+    def run(self, report_interval=5):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.work, device) for device in self.devices]
+            try:
+                while True:
+                    done, pending = wait(futures, timeout=report_interval)
+                    for line in self.table():
+                        self.log.info(line)
+                    if len(pending) == 0:
+                        break
+            except KeyboardInterrupt:
+                self.log.warning("Keyboard interrupt, cancelling...")
+                for future in futures:
+                    future.cancel()
+                for device in self.devices:
+                    if device.controller is not None:
+                        device.controller.cancelled = True
+                    if device.state == "pending":
+                        device.state = "cancelled"
+        return [device.summary() for device in self.devices]
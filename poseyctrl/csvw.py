@@ -1,8 +1,18 @@
+import os
 import time
 import queue
 import signal
+from time import perf_counter
+from typing import TYPE_CHECKING
 
-from multiprocess import Queue, Process
+import numpy as np
+
+from poseyctrl import profiling
+from poseyctrl.metrics import StageTimers
+from poseyctrl.quality import TIME_FIELDS
+
+if TYPE_CHECKING:
+    from multiprocess import Queue
 
 
 class CSVWriterLogger:
@@ -17,15 +27,31 @@ class CSVWriterLogger:
 
 
 class CSVWriter:
-    def __init__(self, qin: Queue, prefix: str = ""):
+    def __init__(
+        self, qin: "Queue", prefix: str = "", header: bool = True, append: bool = False
+    ):
         self.log = CSVWriterLogger()
 
         self.process = None
         self.qin = qin
         self.prefix = prefix
+        self.header = header
+        self.append = append
         self.quit = False
 
         self.files = {}
+        self.headers = {}
+        self.timers = StageTimers()
+        # Sizes of outputs carried on from, see ``resume``.
+        self.resumed = {}
+
+    @staticmethod
+    def format_header(data):
+        return "pctime," + ",".join(data.keys()) + "\n"
+
+    @staticmethod
+    def format_row(t, data):
+        return '"' + str(t) + '",' + ",".join([str(x) for x in data.values()]) + "\n"
 
     def exit_gracefully(self, *args):
         self.log.info("Terminating...")
@@ -42,9 +68,62 @@ class CSVWriter:
                 self.files[id].close()
         self.files = {}
 
+    def flush(self):
+        for id in self.files:
+            self.files[id].flush()
+
+    def sizes(self):
+        """Size of every output, including those resumed and not written since."""
+        sizes = dict(self.resumed)
+        sizes.update({id: self.files[id].tell() for id in self.files})
+        return sizes
+
+    def resume(self, sizes):
+        """
+        Carry on appending to outputs of ``sizes``, as returned by ``sizes``
+        when they were checkpointed, dropping anything written after. Other
+        outputs are left alone.
+        """
+        for sig, size in sizes.items():
+            fn = self.filename(sig)
+            if os.path.isfile(fn):
+                os.truncate(fn, size)
+        self.resumed = dict(sizes)
+
+    def filename(self, sig):
+        return f"{self.prefix}data.{sig}.csv"
+
+    def write(self, msg):
+        t0 = perf_counter()
+        sig, t, data = msg
+        if data is None:
+            return
+        if sig not in self.files:
+            self.files[sig] = open(self.filename(sig), "a" if self.append else "w")
+            self.headers[sig] = self.format_header(data)
+            if self.header and (self.files[sig].tell() == 0):
+                self.files[sig].write(self.headers[sig])
+        self.files[sig].write(self.format_row(t, data))
+        self.timers.add("write", perf_counter() - t0)
+
+    def idle(self):
+        # Called when the queue is empty, before sleeping.
+        pass
+
+    def put(self, msg):
+        # Queue-compatible entry point to write rows in the calling process
+        # rather than through the writer process.
+        self.write(msg)
+
     def loop(self):
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        with profiling.worker("csvwriter", self.log):
+            self.handle_messages()
+        self.timers.log_summary(self.log, "Time writing rows:")
+        self.log.info("Finished loop.")
+
+    def handle_messages(self):
         while True:
             # Handle next message.
             try:
@@ -59,23 +138,16 @@ class CSVWriter:
                     break
 
                 else:
-                    sig, t, data = msg
-                    if sig not in self.files:
-                        self.files[sig] = open(f"{self.prefix}data.{sig}.csv", "w")
-                        self.files[sig].write("pctime," + ",".join(data.keys()) + "\n")
-                    self.files[sig].write(
-                        '"'
-                        + str(t)
-                        + '",'
-                        + ",".join([str(x) for x in data.values()])
-                        + "\n"
-                    )
+                    self.write(msg)
 
             except queue.Empty:
+                self.idle()
                 time.sleep(1)
-        self.log.info("Finished loop.")
 
     def start(self):
+        # Only the writer process needs multiprocess, which is slow to import.
+        from multiprocess import Process
+
         self.log.info("Starting process...")
         self.process = Process(target=CSVWriter.loop, args=(self,))
         self.process.start()
@@ -91,3 +163,201 @@ class CSVWriter:
             self.log.info("Shutdown complete")
         else:
             self.process = None
+
+
+# SQLite column type of each field type.
+SQLITE_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT", bytes: "BLOB"}
+
+
+def field_type(value):
+    """Type of a field without a declared one, from its value."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    for t in (int, float, bytes):
+        if isinstance(value, t):
+            return t
+    return str
+
+
+def blank_to_null(value):
+    return None if value == "" else value
+
+
+# Values sqlite3 can store, once adapt_numpy is called.
+SQLITE_STORABLE = (
+    int,
+    float,
+    str,
+    bytes,
+    np.bool_,
+    np.integer,
+    np.floating,
+    type(None),
+)
+
+
+def adapt_numpy():
+    """Have sqlite3 store NumPy scalars as the Python numbers they hold."""
+    import sqlite3
+
+    for t in set(np.sctypeDict.values()):
+        if issubclass(t, (np.bool_, np.integer, np.floating)):
+            sqlite3.register_adapter(t, np.generic.item)
+
+
+class SQLiteWriter(CSVWriter):
+    """
+    Writes each signal to a table of a SQLite database, ``<prefix>data.sqlite``,
+    instead of a CSV. The database is in WAL mode, so it can be queried while
+    it's being written.
+
+    Rows are inserted in one transaction per ``batch_rows`` rows, or per
+    ``batch_seconds`` when they arrive more slowly. Column types are taken
+    from ``types``, the type of each field per signal as in
+    ``hil.FIELD_TYPES``, or from the first row of signals it doesn't cover.
+    Each table is indexed on the sensor and device time.
+    """
+
+    def __init__(
+        self,
+        qin: "Queue",
+        prefix: str = "",
+        append: bool = False,
+        batch_rows: int = 10000,
+        batch_seconds: float = 1.0,
+        types: dict = None,
+    ):
+        super().__init__(qin, prefix=prefix, append=append)
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.types = types if types is not None else {}
+
+        # Connected on the first row, in the writer process.
+        self.db = None
+        self.inserts = {}
+        self.converters = {}
+        self.pending = {}
+        self.npending = 0
+        self.last_commit = time.monotonic()
+
+    def filename(self, sig=None):
+        return f"{self.prefix}data.sqlite"
+
+    def connect(self):
+        import sqlite3
+
+        # Transactions are begun and committed explicitly, per batch.
+        adapt_numpy()
+        self.db = sqlite3.connect(self.filename(), isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Safe from corruption in WAL mode, only the last batches can be lost
+        # if the machine loses power.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+    def create_table(self, sig, data):
+        declared = self.types.get(sig, {})
+        types = {
+            key: declared.get(key) or field_type(value) for key, value in data.items()
+        }
+        columns = [("pctime", "TEXT")] + [
+            (key, SQLITE_TYPES[t]) for key, t in types.items()
+        ]
+        # Numbers left blank until they're known are stored as NULL. Values
+        # sqlite3 can't store, even with adapt_numpy, are written as text,
+        # like in the CSVs.
+        converters = []
+        for i, (key, value) in enumerate(data.items()):
+            if isinstance(value, str) and (types[key] in (int, float)):
+                converters.append((i + 1, blank_to_null))
+            elif not isinstance(value, SQLITE_STORABLE):
+                converters.append((i + 1, str))
+
+        names = [key for key, _ in columns]
+        time_field = TIME_FIELDS.get(sig, "time")
+        if time_field not in names:
+            time_field = "pctime"
+        index = ["sensor", time_field] if "sensor" in names else [time_field]
+
+        table = f'"{sig}"'
+        if not self.append:
+            self.db.execute(f"DROP TABLE IF EXISTS {table}")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            + ", ".join(f'"{key}" {type}' for key, type in columns)
+            + ")"
+        )
+        self.db.execute(
+            f'CREATE INDEX IF NOT EXISTS "{sig}_{"_".join(index)}" ON {table} ('
+            + ", ".join(f'"{key}"' for key in index)
+            + ")"
+        )
+        self.inserts[sig] = (
+            f"INSERT INTO {table} ("
+            + ", ".join(f'"{key}"' for key in names)
+            + f") VALUES ({', '.join('?' * len(names))})"
+        )
+        self.converters[sig] = converters
+        self.pending[sig] = []
+
+    def write(self, msg):
+        t0 = perf_counter()
+        sig, t, data = msg
+        if data is None:
+            return
+        if sig not in self.inserts:
+            if self.db is None:
+                self.connect()
+            self.create_table(sig, data)
+        converters = self.converters[sig]
+        if converters:
+            row = [str(t), *data.values()]
+            for i, convert in converters:
+                row[i] = convert(row[i])
+        else:
+            row = (str(t), *data.values())
+        self.pending[sig].append(row)
+        self.npending += 1
+        self.timers.add("write", perf_counter() - t0)
+        if (self.npending >= self.batch_rows) or (
+            time.monotonic() - self.last_commit >= self.batch_seconds
+        ):
+            self.commit()
+
+    def commit(self):
+        self.last_commit = time.monotonic()
+        if self.npending == 0:
+            return
+        import sqlite3
+
+        t0 = perf_counter()
+        try:
+            self.db.execute("BEGIN")
+            for sig, rows in self.pending.items():
+                if rows:
+                    self.db.executemany(self.inserts[sig], rows)
+            self.db.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            self.log.error(f"Dropped {self.npending} rows, failed to insert: {e}")
+        for rows in self.pending.values():
+            rows.clear()
+        self.timers.add("commit", perf_counter() - t0, self.npending)
+        self.npending = 0
+
+    def idle(self):
+        if time.monotonic() - self.last_commit >= self.batch_seconds:
+            self.commit()
+
+    def flush(self):
+        if self.db is not None:
+            self.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
+        self.inserts = {}
+        self.converters = {}
+        self.pending = {}
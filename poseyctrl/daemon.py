@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import tempfile
+import threading
+import traceback
+import socketserver
+import datetime as dt
+
+import numpy as np
+
+from poseyctrl.control import PoseyController, matches, scan
+from poseyctrl.sensor import PoseySensor
+
+
+DEFAULT_SOCKET = os.environ.get(
+    "POSEY_DAEMON_SOCKET", os.path.join(tempfile.gettempdir(), "posey-daemon.sock")
+)
+
+# Messages buffered per listening client before new ones are dropped, so a
+# slow client can't stall the sensor it's listening to.
+LISTEN_BUFFER = 10000
+
+
+class DaemonError(Exception):
+    pass
+
+
+def to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (dt.datetime, dt.date)):
+        return obj.isoformat()
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.hex()
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
+
+
+def encode(msg):
+    return (json.dumps(msg, default=to_json) + "\n").encode("utf-8")
+
+
+class DaemonSensor:
+    """
+    A sensor connection kept open by the daemon.
+
+    Between commands a pump thread keeps reading the UART so messages are
+    decoded and forwarded to listening clients. Commands take ``lock`` for
+    their whole run, during which the controller reads the UART itself.
+    """
+
+    def __init__(self, name, ble, adv, dtnow, log):
+        self.name = name
+        self.log = log
+        self.dtnow = dtnow
+        self.lock = threading.RLock()
+        self.qout = queue.Queue()
+        # PoseySensor hands its queues to PoseyHIL swapped, decoded messages
+        # come out of the second one.
+        self.sensor = PoseySensor(
+            name,
+            ble,
+            adv,
+            None,
+            self.qout,
+            None,
+            f"{dtnow}-posey-daemon-{name.replace(' ', '')}",
+        )
+        self.sensor.hil.quality.warn = True
+        self.controller = None
+        self.command = None
+        self.listeners = []
+        self.dropped = 0
+        self.quit = False
+        self.last_connect = 0
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+
+    @property
+    def connected(self):
+        return bool(self.sensor.connected)
+
+    def connect(self, timeout=10):
+        with self.lock:
+            if not self.connected:
+                self.log.info(f"Connecting to {self.sensor}")
+                if not self.sensor.connect(timeout=timeout):
+                    raise ConnectionError(f"Could not connect to {self.name}")
+                self.log.info(f" - Connected to {self.name}.")
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def disconnect(self):
+        self.quit = True
+        with self.lock:
+            self.sensor.disconnect()
+            self.sensor.hil.close()
+        self.sensor.hil.timers.log_summary(self.log, f"Time per stage for {self.name}:")
+        self.sensor.hil.quality.log_report(self.log, f"Data quality for {self.name}:")
+
+    def pump(self):
+        while not self.quit:
+            read = 0
+            if self.lock.acquire(blocking=False):
+                try:
+                    if self.connected:
+                        read = self.sensor.hil.process_uart()
+                        self.sensor.hil.decode_pending()
+                        self.sensor.hil.stats.log_stats()
+                    elif self.listeners and (time.time() - self.last_connect > 5):
+                        # Someone wants data, keep trying to get it back.
+                        self.last_connect = time.time()
+                        self.log.warning(
+                            f"Sensor {self.name} disconnected. Reconnecting..."
+                        )
+                        self.sensor.connect()
+                except Exception:
+                    self.log.error(f"Error reading from {self.name}:")
+                    self.log.error(traceback.format_exc())
+                finally:
+                    self.lock.release()
+            forwarded = self.forward()
+            if (read == 0) and (forwarded == 0):
+                time.sleep(0.01)
+
+    def forward(self):
+        forwarded = 0
+        while True:
+            try:
+                msg = self.qout.get_nowait()
+            except queue.Empty:
+                return forwarded
+            forwarded += 1
+            for listener in list(self.listeners):
+                try:
+                    listener.put_nowait(msg)
+                except queue.Full:
+                    self.dropped += 1
+
+    def listen(self):
+        listener = queue.Queue(maxsize=LISTEN_BUFFER)
+        self.listeners.append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def run(self, command, directory=".", steps=None, **kwargs):
+        with self.lock:
+            if not self.connected:
+                self.connect()
+            self.controller = PoseyController(
+                self.sensor, log=self.log, dtnow=self.dtnow, directory=directory
+            )
+            self.command = command
+            try:
+                if steps is not None:
+                    return self.controller.run_script(steps, **kwargs)
+                return self.controller.run(command, **kwargs)
+            finally:
+                self.command = None
+
+    def cancel(self):
+        if self.controller is not None:
+            self.controller.cancelled = True
+
+    def status(self):
+        controller = self.controller
+        return dict(
+            sensor=self.name,
+            address=self.sensor.advertisement.address.string,
+            connected=self.connected,
+            command=self.command,
+            state=controller.state if controller is not None else "idle",
+            progress=controller.progress if controller is not None else None,
+            listeners=len(self.listeners),
+            dropped=self.dropped,
+        )
+
+
+class PoseyDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Local server keeping Posey connections open between client invocations.
+
+    Clients talk newline-delimited JSON over a Unix socket. Each request is
+    an object with an ``op`` and its arguments and gets one response object
+    with ``ok`` set, except ``listen``, which streams decoded messages until
+    the client goes away. Scanning, connecting and service discovery happen
+    once per sensor rather than once per command.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, path=DEFAULT_SOCKET, ble=None, scan_timeout=10, log=None, **kwargs
+    ):
+        self.path = path
+        self.ble = ble
+        self.scan_timeout = scan_timeout
+        self.scan_kwargs = kwargs
+        self.log = log if log is not None else logging.getLogger("daemon")
+        self.dtnow = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.sensors = {}
+        self.sensors_lock = threading.Lock()
+        self.metrics = None
+
+        if os.path.exists(path):
+            # Only remove the socket if nothing is serving on it.
+            try:
+                DaemonClient(path).request("ping")
+                raise DaemonError(f"A daemon is already listening on {path}")
+            except (ConnectionError, FileNotFoundError):
+                os.remove(path)
+        super().__init__(path, DaemonHandler)
+
+    def find(self, name):
+        for complete_name, sensor in self.sensors.items():
+            if (complete_name == name) or matches(complete_name, name):
+                return sensor
+        return None
+
+    def sensor(self, name, connect=True):
+        """
+        Get the connection for sensor ``name``, scanning for it if needed.
+        """
+        with self.sensors_lock:
+            sensor = self.find(name)
+            if sensor is None:
+                self.log.info(f"Scanning for Posey sensor {name}...")
+                advs = scan(
+                    self.ble,
+                    [name],
+                    self.scan_timeout,
+                    self.log,
+                    first=True,
+                    **self.scan_kwargs,
+                )
+                if len(advs) == 0:
+                    raise DaemonError(f"Could not find Posey sensor {name}")
+                complete_name, adv = next(iter(advs.items()))
+                sensor = DaemonSensor(
+                    complete_name,
+                    self.ble,
+                    adv,
+                    self.dtnow,
+                    logging.getLogger(f"cmd.{complete_name}"),
+                )
+                self.sensors[complete_name] = sensor
+        if connect:
+            sensor.connect()
+        return sensor
+
+    def disconnect(self, name):
+        with self.sensors_lock:
+            sensor = self.find(name)
+            if sensor is None:
+                raise DaemonError(f"Not connected to {name}")
+            del self.sensors[sensor.name]
+        self.log.info(f"Disconnecting {sensor.name}...")
+        sensor.disconnect()
+
+    def handle_request_msg(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return dict(ok=True)
+        elif op == "status":
+            return dict(ok=True, sensors=[s.status() for s in self.sensors.values()])
+        elif op == "metrics":
+            return dict(
+                ok=True,
+                sensors=[s.sensor.hil.metrics() for s in self.sensors.values()],
+            )
+        elif op == "connect":
+            return dict(ok=True, status=self.sensor(request["sensor"]).status())
+        elif op == "disconnect":
+            self.disconnect(request["sensor"])
+            return dict(ok=True)
+        elif op == "command":
+            sensor = self.sensor(request["sensor"])
+            result = sensor.run(
+                request["command"],
+                directory=request.get("directory", "."),
+                steps=request.get("steps"),
+                validate=request.get("validate", False),
+                extract=request.get("extract", False),
+            )
+            return dict(ok=True, result=result)
+        elif op == "cancel":
+            sensor = self.find(request["sensor"])
+            if sensor is None:
+                raise DaemonError(f"Not connected to {request['sensor']}")
+            sensor.cancel()
+            return dict(ok=True)
+        elif op == "shutdown":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return dict(ok=True)
+        raise DaemonError(f"Unknown op: {op}")
+
+    def service_actions(self):
+        if self.metrics is not None:
+            self.metrics.maybe_write(
+                lambda: [s.sensor.hil.metrics() for s in list(self.sensors.values())]
+            )
+
+    def server_close(self):
+        super().server_close()
+        for name in list(self.sensors):
+            self.disconnect(name)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.wfile.write(encode(dict(ok=False, error="Invalid request")))
+                continue
+            if request.get("op") == "listen":
+                self.listen(request)
+                return
+
+            try:
+                response = server.handle_request_msg(request)
+            except Exception as e:
+                server.log.error(f"Request {request.get('op')} failed: {e}")
+                server.log.debug(traceback.format_exc())
+                response = dict(ok=False, error=f"{type(e).__name__}: {e}")
+            try:
+                self.wfile.write(encode(response))
+            except OSError:
+                # Client went away (e.g. interrupted), nothing to tell it.
+                return
+
+    def listen(self, request):
+        server = self.server
+        try:
+            sensor = server.sensor(request["sensor"])
+        except Exception as e:
+            self.wfile.write(encode(dict(ok=False, error=f"{type(e).__name__}: {e}")))
+            return
+        self.wfile.write(encode(dict(ok=True, status=sensor.status())))
+
+        listener = sensor.listen()
+        server.log.info(f"Client listening to {sensor.name}")
+        try:
+            while True:
+                try:
+                    sig, t, data = listener.get(timeout=1)
+                except queue.Empty:
+                    if not sensor.connected:
+                        self.wfile.write(encode(dict(sig="disconnected")))
+                    continue
+                self.wfile.write(encode(dict(sig=sig, time=t, data=data)))
+        except OSError:
+            pass
+        finally:
+            sensor.unlisten(listener)
+            server.log.info(f"Client stopped listening to {sensor.name}")
+
+
+class DaemonClient:
+    """Client side of the ``posey-daemon`` socket API."""
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def request(self, op, **kwargs):
+        """
+        Send one request and wait for its response.
+
+        :param return: Response dict.
+        """
+        with self.connect() as sock, sock.makefile("rwb") as f:
+            f.write(encode(dict(op=op, **kwargs)))
+            f.flush()
+            line = f.readline()
+        if not line:
+            raise DaemonError("Daemon closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise DaemonError(response["error"])
+        return response
+
+    def listen(self, sensor):
+        """
+        Stream decoded messages from ``sensor``.
+
+        :param return: Generator of (sig, time, data) tuples.
+        """
+        with self.connect() as sock, sock.makefile("rwb") as f:
+            f.write(encode(dict(op="listen", sensor=sensor)))
+            f.flush()
+            response = json.loads(f.readline())
+            if not response["ok"]:
+                raise DaemonError(response["error"])
+            for line in f:
+                msg = json.loads(line)
+                yield msg["sig"], msg.get("time"), msg.get("data")
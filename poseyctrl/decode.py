@@ -0,0 +1,430 @@
+import os
+import sys
+import glob
+import json
+import mmap
+import logging
+import time
+import queue
+import shutil
+
+from poseyctrl import csvw
+from poseyctrl import hil
+from poseyctrl import profiling
+from poseyctrl.metrics import StageTimers
+from poseyctrl.quality import QualityMonitor, QualityTrace
+
+
+SYNC = b"\xca\xfe"
+BLOCK_SIZE = 1024 * 1024
+
+
+def read_blocks(input, block_size=BLOCK_SIZE):
+    """
+    Yield successive blocks of ``input`` as memoryviews without copying.
+
+    Files are memory mapped and pages that have already been handed out are
+    released back to the kernel, so resident memory stays bounded by roughly
+    one block regardless of file size. Use ``"-"`` to read from stdin (or a
+    pipe), in which case a single buffer is reused for every block. Blocks are
+    only valid until the next one is requested.
+    """
+    if input == "-":
+        buffer = bytearray(block_size)
+        with memoryview(buffer) as view:
+            while True:
+                n = sys.stdin.buffer.readinto(buffer)
+                if not n:
+                    break
+                block = view[:n]
+                try:
+                    yield block
+                finally:
+                    block.release()
+        return
+
+    with open(input, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                for si in range(0, size, block_size):
+                    block = view[si : si + block_size]
+                    try:
+                        yield block
+                    finally:
+                        block.release()
+                    if hasattr(mmap, "MADV_DONTNEED") and (si % mmap.PAGESIZE) == 0:
+                        mm.madvise(mmap.MADV_DONTNEED, si, min(block_size, size - si))
+
+
+def frame_sizes(messages: hil.PoseyHILReceiveMessages):
+    return {mid: len(msg.buffer.buffer) for mid, msg in messages.by_id().items()}
+
+
+def valid_frame(data, pos, messages, sizes):
+    """
+    Check whether a complete message with a valid checksum starts at ``pos``.
+
+    :param return: Frame size in bytes, or 0 if there is no valid frame.
+    """
+    if data[pos : pos + 2] != SYNC or (pos + 2) >= len(data):
+        return 0
+    mid = data[pos + 2]
+    if mid not in sizes:
+        return 0
+    size = sizes[mid]
+    if pos + size > len(data):
+        return 0
+    msg = messages[mid]
+    msg.buffer.write(bytes(data[pos : pos + size]))
+    msg.deserialize()
+    return size if msg.valid_checksum else 0
+
+
+def find_boundary(data, start, end, messages, sizes):
+    """
+    Find the first verified message boundary in ``data[start:end]``.
+
+    A boundary is a sync word followed by a message with a valid checksum,
+    which is in turn followed by another sync word (or the end of the data).
+    Requiring two consecutive frames makes it very unlikely we split on a sync
+    word that happens to appear inside a payload.
+    """
+    pos = data.find(SYNC, start, end)
+    while pos >= 0:
+        size = valid_frame(data, pos, messages, sizes)
+        if size > 0:
+            next_pos = pos + size
+            if (next_pos >= len(data)) or (data[next_pos : next_pos + 2] == SYNC):
+                return pos
+        pos = data.find(SYNC, pos + 1, end)
+    return None
+
+
+def split_chunks(data, chunk_bytes):
+    """
+    Split ``data`` into ``(start, end)`` ranges that begin on message boundaries.
+
+    Chunks only ever start on a verified frame, so every message lies entirely
+    within one chunk and each chunk can be decoded by a fresh MessageListener
+    exactly as the serial decoder would have seen it. If no boundary is found
+    within a chunk, it is merged with the following one.
+    """
+    messages = hil.PoseyHILReceiveMessages()
+    sizes = frame_sizes(messages)
+    messages = messages.by_id()
+
+    N = len(data)
+    starts = [0]
+    target = chunk_bytes
+    while target < N:
+        pos = find_boundary(data, max(target, starts[-1] + 1), N, messages, sizes)
+        if pos is None:
+            break
+        starts.append(pos)
+        target = pos + chunk_bytes
+    return list(zip(starts, starts[1:] + [N]))
+
+
+def default_prefix(input):
+    return (
+        os.path.basename(input)
+        .replace(".raw", "")
+        .replace(".in", "")
+        .replace(".out", "")
+        .replace(".bin", "")
+        .replace("*", "")
+    )
+
+
+def decode_range(
+    input, start, end, name, prefix, header=False, timers=None, quality=None
+):
+    """
+    :param timers: Optional StageTimers to add the time spent per stage to.
+    :param quality: Optional stand-in for the sensor's QualityMonitor.
+    :param return: Tuple of (messages decoded, CSV header per signal).
+    """
+    writer = csvw.CSVWriter(None, prefix=prefix, header=header)
+    sensor = hil.PoseyHIL(name, None, writer, queue.Queue(), None, None, None)
+    if quality is not None:
+        sensor.quality = quality
+    decoded = 0
+    if end <= start:
+        return decoded, writer.headers
+    with profiling.worker("decode"):
+        with open(input, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    for si in range(start, end, BLOCK_SIZE):
+                        with view[si : min(si + BLOCK_SIZE, end)] as block:
+                            decoded += sensor.feed(block)
+    writer.close()
+    if timers is not None:
+        timers.merge(sensor.timers.stages)
+        timers.merge(writer.timers.stages)
+    return decoded, writer.headers
+
+
+def decode_chunk(input, start, end, name, prefix):
+    # Pool entry point, returning the stage times and quality trace with the
+    # results.
+    timers = StageTimers()
+    trace = QualityTrace()
+    decoded, headers = decode_range(
+        input, start, end, name, prefix, timers=timers, quality=trace
+    )
+    return decoded, headers, timers.stages, trace
+
+
+def decode_file(input, name, prefix, timers=None):
+    """Decode a whole file in this process without a separate writer process."""
+    size = os.path.getsize(input)
+    decoded, _ = decode_range(input, 0, size, name, prefix, True, timers)
+    return decoded
+
+
+def decode_parallel(
+    input, name, prefix, jobs, chunk_bytes, log=print, timers=None, quality=None
+):
+    """
+    Decode ``input`` in chunks across ``jobs`` worker processes.
+
+    Each worker writes headerless CSV fragments which are stitched back
+    together in order, producing the same files as a serial decode. The
+    quality signal depends on everything before it, so the workers only
+    trace it and it's computed once over the stitched stream.
+
+    :param quality: Optional QualityMonitor to compute the quality with,
+        for its report.
+    """
+    input = os.path.abspath(input)
+    with open(input, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = split_chunks(mm, chunk_bytes)
+    log(f"Decoding {len(chunks)} chunks with {jobs} workers...")
+
+    from multiprocess import Pool
+
+    parts = [f"{prefix}part{i:04d}." for i in range(len(chunks))]
+    with Pool(jobs) as pool:
+        results = pool.starmap(
+            decode_chunk,
+            [(input, si, ei, name, part) for (si, ei), part in zip(chunks, parts)],
+        )
+
+    # Stitch the fragments back together in chunk order, writing each header
+    # from the first chunk that produced the signal.
+    writer = csvw.CSVWriter(None, prefix=prefix)
+    decoded = 0
+    outputs = {}
+    for part, (part_decoded, headers, stages, _) in zip(parts, results):
+        decoded += part_decoded
+        if timers is not None:
+            timers.merge(stages)
+        for sig, header in headers.items():
+            if sig not in outputs:
+                outputs[sig] = open(writer.filename(sig), "w")
+                outputs[sig].write(header)
+            fragment = f"{part}data.{sig}.csv"
+            with open(fragment, "r") as f:
+                shutil.copyfileobj(f, outputs[sig])
+            os.remove(fragment)
+    for f in outputs.values():
+        f.close()
+
+    t0 = time.perf_counter()
+    if quality is None:
+        quality = QualityMonitor(logging.getLogger(f"posey.{name}"))
+    for *_, trace in results:
+        trace.replay(quality, writer.put)
+    writer.close()
+    if timers is not None:
+        timers.add("quality", time.perf_counter() - t0)
+        timers.merge(writer.timers.stages)
+
+    return decoded
+
+
+class FollowDecoder:
+    """
+    Incrementally decode a raw capture while it is still being written.
+
+    ``pattern`` is either a single file or a glob matching a set of rotating
+    segments, which are treated as one continuous stream in sorted order. The
+    position in the stream is checkpointed together with the size of every
+    output file and the quality monitor's state, so a restart resumes exactly
+    where the last checkpoint left off, without re-decoding or duplicating
+    rows.
+
+    The MessageListener itself can't be serialized, so instead the checkpoint
+    points at the first byte the listener has not yet consumed. Re-feeding
+    from there rebuilds any partial message it was holding.
+    """
+
+    def __init__(
+        self,
+        pattern,
+        name,
+        prefix,
+        checkpoint,
+        poll=1.0,
+        checkpoint_interval=5.0,
+        log=print,
+    ):
+        self.pattern = pattern
+        self.prefix = prefix
+        self.checkpoint = checkpoint
+        self.poll = poll
+        self.checkpoint_interval = checkpoint_interval
+        self.log = log
+
+        self.segments = []
+        self.segment = 0
+        self.offset = 0
+        self.last_checkpoint = 0
+        # Outputs in the last checkpoint.
+        self.saved = set()
+
+        state = self.load()
+        self.writer = csvw.CSVWriter(None, prefix=prefix, append=state is not None)
+        self.sensor = hil.PoseyHIL(
+            name, None, self.writer, queue.Queue(), None, None, None
+        )
+        self.capacity = self.sensor.ml.free
+        self.buffer = bytearray(BLOCK_SIZE)
+
+        if state is not None:
+            self.resume(state)
+
+    def load(self):
+        if not os.path.isfile(self.checkpoint):
+            return None
+        with open(self.checkpoint, "r") as f:
+            return json.load(f)
+
+    def resume(self, state):
+        self.scan()
+        if state["segment"] in self.segments:
+            # Drop anything written after the checkpoint so rows aren't
+            # duplicated.
+            self.writer.resume(state["outputs"])
+            self.segment = self.segments.index(state["segment"])
+            self.offset = state["offset"]
+            self.log(f"Resuming {state['segment']} from byte {self.offset}.")
+            if "quality" in state:
+                self.sensor.quality.restore(state["quality"])
+        else:
+            # Everything is decoded again, so the outputs are written again.
+            self.log(f"Checkpoint segment {state['segment']} is gone, starting over.")
+            for sig in state["outputs"]:
+                fn = self.writer.filename(sig)
+                if os.path.isfile(fn):
+                    os.remove(fn)
+
+    def scan(self):
+        self.segments = sorted(glob.glob(self.pattern))
+
+    def position(self):
+        """
+        Stream position of the first byte not yet consumed by the listener,
+        None until there's a segment to follow.
+        """
+        if len(self.segments) == 0:
+            return None
+        pending = self.capacity - self.sensor.ml.free
+        segment = self.segment
+        offset = self.offset
+        while pending > offset and segment > 0:
+            pending -= offset
+            segment -= 1
+            offset = os.path.getsize(self.segments[segment])
+        return self.segments[segment], max(offset - pending, 0)
+
+    def save(self):
+        self.last_checkpoint = time.time()
+        position = self.position()
+        if position is None:
+            return
+        self.writer.flush()
+        segment, offset = position
+        state = dict(
+            segment=segment,
+            offset=offset,
+            outputs=self.writer.sizes(),
+            quality=self.sensor.quality.state(),
+        )
+        tmp = f"{self.checkpoint}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint)
+        self.saved = set(state["outputs"])
+
+    def step(self):
+        """
+        Decode any newly available bytes.
+
+        :param return: Number of messages decoded.
+        """
+        self.scan()
+        if self.segment >= len(self.segments):
+            return 0
+
+        fn = self.segments[self.segment]
+        size = os.path.getsize(fn)
+        if size < self.offset:
+            self.log(f"{fn} shrank, assuming it was replaced and starting over.")
+            self.offset = 0
+
+        decoded = 0
+        if size > self.offset:
+            with open(fn, "rb") as f, memoryview(self.buffer) as view:
+                f.seek(self.offset)
+                while self.offset < size:
+                    n = f.readinto(self.buffer)
+                    if not n:
+                        break
+                    with view[:n] as block:
+                        decoded += self.sensor.feed(block)
+                    self.offset += n
+        elif self.segment + 1 < len(self.segments):
+            # The current segment stopped growing and a newer one exists, so
+            # the writer has rotated.
+            self.segment += 1
+            self.offset = 0
+            self.log(f"Following {self.segments[self.segment]}...")
+        return decoded
+
+    def follow(self, idle_timeout=None):
+        decoded = 0
+        last_data = time.time()
+        try:
+            while True:
+                n = self.step()
+                decoded += n
+                now = time.time()
+                if n > 0:
+                    last_data = now
+                # Checkpoint new outputs straight away, a restart leaves
+                # outputs the checkpoint doesn't know about alone.
+                new_outputs = self.writer.files.keys() - self.saved
+                if new_outputs or (
+                    (now - self.last_checkpoint) > self.checkpoint_interval
+                ):
+                    self.save()
+                if (idle_timeout is not None) and ((now - last_data) > idle_timeout):
+                    self.log(f"No new data for {idle_timeout:.0f} s, stopping.")
+                    break
+                if n == 0:
+                    time.sleep(self.poll)
+        except KeyboardInterrupt:
+            self.log("Keyboard interrupt, stopping...")
+        self.save()
+        self.writer.close()
+        return decoded
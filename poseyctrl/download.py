@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import time
+
+import numpy as np
+
+
+def container_files(fn):
+    stem = os.path.splitext(fn)[0]
+    return f"{stem}.json", f"{stem}.bin"
+
+
+def is_container(fn):
+    meta_fn, data_fn = container_files(fn)
+    return os.path.isfile(meta_fn) and os.path.isfile(data_fn)
+
+
+class DownloadFile:
+    """
+    On-disk container a flash download is streamed into as it arrives.
+
+    Two files share a stem: ``<stem>.json`` holds the DataSummary along with
+    how many bytes have been received, and ``<stem>.bin`` holds the raw data.
+    The data file is memory mapped so received bytes land directly in the
+    page cache and there is no final copy. The summary is written before any
+    data arrives and progress is synced periodically, so an interrupted
+    download is still readable up to the last sync.
+    """
+
+    def __init__(self, stem, summary, sync_interval=5.0):
+        self.summary = summary
+        self.size = summary["bytes"]
+        self.received = 0
+        self.complete = False
+        self.sync_interval = sync_interval
+        self.last_sync = 0
+
+        self.meta_fn = f"{stem}.json"
+        self.data_fn = f"{stem}.bin"
+        self.file = open(self.data_fn, "w+b")
+        self.file.truncate(self.size)
+        if self.size > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), self.size)
+            self.buffer = memoryview(self.mmap)
+        else:
+            self.mmap = None
+            self.buffer = memoryview(bytearray())
+        self.save()
+
+    @property
+    def remaining(self):
+        return self.size - self.received
+
+    def save(self):
+        tmp = f"{self.meta_fn}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                dict(
+                    summary=self.summary,
+                    received=self.received,
+                    complete=self.complete,
+                ),
+                f,
+                indent=4,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.meta_fn)
+        self.last_sync = time.time()
+
+    def sync(self):
+        # Data has to hit the disk before the metadata claims it's there.
+        if self.mmap is not None:
+            self.mmap.flush()
+        self.save()
+
+    def view(self):
+        """Writable view of the space not yet received, for ``readinto``."""
+        return self.buffer[self.received :]
+
+    def write(self, data):
+        """
+        Append ``data``, dropping anything beyond the expected size.
+
+        :param return: Number of bytes stored.
+        """
+        n = min(len(data), self.remaining)
+        self.buffer[self.received : self.received + n] = data[:n]
+        self.commit(n)
+        return n
+
+    def commit(self, n):
+        self.received += n
+        if (time.time() - self.last_sync) > self.sync_interval:
+            self.sync()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.complete = self.received >= self.size
+        self.buffer.release()
+        if self.mmap is not None:
+            self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+        self.file.truncate(self.received)
+        self.file.close()
+        self.file = None
+        self.save()
+
+
+def load(fn):
+    """
+    Load a downloaded data file, either a legacy ``.npz`` or a container.
+
+    :param return: Tuple of (summary, data as a uint8 array, data as bytes).
+    """
+    if fn.endswith(".npz"):
+        f = np.load(fn, allow_pickle=True)
+        summary = f["summary"].item()
+        data = f["data"]
+        datab = data.tobytes()
+        f.close()
+        return summary, data, datab
+
+    meta_fn, data_fn = container_files(fn)
+    with open(meta_fn, "r") as f:
+        meta = json.load(f)
+    received = meta["received"]
+    if received == 0:
+        return meta["summary"], np.empty(0, "u1"), b""
+    with open(data_fn, "rb") as f:
+        datab = mmap.mmap(f.fileno(), received, access=mmap.ACCESS_READ)
+    return meta["summary"], np.frombuffer(datab, "u1"), datab
@@ -0,0 +1,160 @@
+import logging
+
+import numpy as np
+from hexdump import hexdump
+
+import pyposey as pyp
+
+
+FBM_SYNC = b"\xca\xfe"
+FBM_BYTES = 18
+
+# Keys of the dicts returned by ``FlashBlockParser.summarize``, in order.
+BLOCK_SUMMARY_FIELDS = ["slot", "time", "mac", "rssi", "block_bytes"]
+
+
+def mac2str(mac):
+    return "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*mac)
+
+
+class FlashBlockParser:
+    """
+    Incremental parser for the FlashBlockMessage framed data in a download.
+
+    ``feed`` can be called repeatedly as more of the download arrives; it
+    only consumes complete headers and blocks until ``final`` is set, at which
+    point whatever is left is handled the same way ``posey-extract`` always
+    has. Each valid block is passed to ``on_block(summary, block)``.
+    """
+
+    def __init__(self, start_ms=0, log=None, on_block=None):
+        self.log = log if log is not None else logging.getLogger("flash")
+        self.start_ms = start_ms
+        self.on_block = on_block
+        self.fbm = pyp.platform.sensors.FlashBlockMessage()
+
+        self.pos = 0
+        self.skipped = 0
+        self.checksum_failures = 0
+        # A bad frame whose skip ran to the end of the data fed so far, only
+        # counted once its skip ends, so it's counted once however the data
+        # is split between feeds.
+        self.resyncing = False
+        self.fbm_bytes = 0
+        self.data_bytes = 0
+        self.slot_blocks = {}
+        self.slot_bytes = {}
+
+    def summarize(self, print_fbm=True):
+        time = self.fbm.message.time - self.start_ms
+        slot = self.fbm.message.slot
+        mac = mac2str(self.fbm.message.mac)
+        rssi = self.fbm.message.rssi
+        block_bytes = self.fbm.message.block_bytes
+
+        if print_fbm:
+            self.log.debug(
+                f"Block of {block_bytes} bytes from MAC {mac}, slot {slot} at time {time}, RSSI {rssi}"
+            )
+
+        return dict(slot=slot, time=time, mac=mac, rssi=rssi, block_bytes=block_bytes)
+
+    def feed(self, data, datab, end, final=False):
+        """
+        Parse blocks in ``data[self.pos:end]``.
+
+        :param data: Data to slice headers and blocks from.
+        :param datab: The same data as an object supporting ``find``.
+        :param end: Number of valid bytes in ``data``.
+        :param final: No more data will arrive, so consume everything.
+        :param return: Number of blocks parsed.
+        """
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        parsed = 0
+        di = self.pos
+        while di < end:
+            if (not final) and (end - di < FBM_BYTES):
+                break
+            if self.resyncing and (datab[di : di + 2] == FBM_SYNC):
+                self.resyncing = False
+                self.checksum_failures += 1
+
+            self.fbm.buffer.write(np.frombuffer(data[di : di + FBM_BYTES], "u1"))
+            self.fbm.deserialize()
+            if (not self.fbm.valid_checksum) or (datab[di : di + 2] != FBM_SYNC):
+                next_sync = datab.find(FBM_SYNC, di + 1, end)
+                if (next_sync < 0) and not final:
+                    # Hold on to the last byte, it might be the start of a
+                    # sync word that hasn't fully arrived yet.
+                    next_sync = end - 1
+                    self.resyncing = True
+                else:
+                    if next_sync < 0:
+                        next_sync = end
+                    self.resyncing = False
+                    self.checksum_failures += 1
+                skip = next_sync - di
+                self.skipped += skip
+                if debug:
+                    self.log.debug(f"Invalid FBM checksum! Skipping {skip} bytes!")
+                    skip = min(skip + 20, 100)
+                    self.log.debug(hexdump(data[di : di + skip], result="return"))
+                di = next_sync
+                continue
+
+            block_summary = self.summarize(print_fbm=False)
+            block_si = di + FBM_BYTES
+            block_ei = block_si + block_summary["block_bytes"]
+            if (not final) and (block_ei > end):
+                break
+            block = data[block_si:block_ei]
+            self.fbm_bytes += FBM_BYTES
+            self.data_bytes += block_summary["block_bytes"]
+
+            slot = block_summary["slot"]
+            if slot not in self.slot_blocks:
+                if debug:
+                    self.log.debug("-----------")
+                    self.log.debug(hexdump(data[di:block_si], result="return"))
+                    self.log.debug(f"Added new slot: {slot} {block_summary['mac']}")
+                    self.summarize()
+                    self.log.debug(hexdump(block, result="return"))
+                    self.log.debug("-----------")
+                self.slot_blocks[slot] = 0
+                self.slot_bytes[slot] = 0
+            self.slot_blocks[slot] += 1
+            self.slot_bytes[slot] += len(block)
+
+            if self.on_block is not None:
+                self.on_block(block_summary, block)
+            parsed += 1
+            di = block_ei
+
+        self.pos = di
+        return parsed
+
+    def stats(self):
+        slots = " ".join(
+            f"{slot}:{self.slot_bytes[slot]/1024.0:.1f}KB"
+            for slot in sorted(self.slot_bytes)
+        )
+        return f"FBM: {sum(self.slot_blocks.values())} blocks, {self.checksum_failures} bad ({self.skipped} B skipped), slots [{slots}]"
+
+
+class SlotWriter:
+    """Block callback writing each slot to ``<prefix><slot>.bin`` as it arrives."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = {}
+
+    def __call__(self, block_summary, block):
+        slot = block_summary["slot"]
+        if slot not in self.files:
+            self.files[slot] = open(f"{self.prefix}{slot}.bin", "wb")
+        self.files[slot].write(block)
+
+    def close(self):
+        for slot in self.files:
+            self.files[slot].close()
+        self.files = {}
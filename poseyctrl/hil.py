@@ -1,17 +1,57 @@
-from inspect import trace
 import traceback
+import struct
 import time
+from time import perf_counter
 import datetime as dt
 import logging
 import math
 import os
 
-from typing import Optional
-from multiprocess import Queue
-import numpy as np
+from typing import Optional, TYPE_CHECKING
+from collections import deque
+from concurrent.futures import Future, TimeoutError
 
 import pyposey as pyp
 
+from poseyctrl.metrics import Histogram, StageTimers
+from poseyctrl.quality import FIELDS as QUALITY_FIELDS, QualityMonitor
+
+if TYPE_CHECKING:
+    from multiprocess import Queue
+
+
+# Record of each read written to ``<output_raw>.in.idx`` alongside the raw
+# capture: seconds since the first read and bytes read, so a replay can
+# reproduce the original chunking and timing. ``replay.RAW_INDEX`` is the
+# matching NumPy dtype.
+RAW_INDEX = struct.Struct("<dI")
+
+# Type of each field of the signals PoseyHIL emits, for writers that need
+# them up front, like the SQLite tables' columns. The message fields may
+# decode as NumPy scalars, which these say how to store.
+TASK_FIELDS = dict(
+    sensor=str,
+    t_start=int,
+    t_end=int,
+    invalid_checksum=int,
+    missed_deadline=int,
+    Vbatt=float,
+)
+FIELD_TYPES = {
+    "taskwaist": dict(TASK_FIELDS, ble_throughput=int),
+    "taskwatch": TASK_FIELDS,
+    "datasummary": dict(sensor=str, datetime=str, start_ms=int, end_ms=int, bytes=int),
+    "imu": dict(
+        sensor=str,
+        time=int,
+        **{field: float for field in ["Ax", "Ay", "Az", "Qi", "Qj", "Qk", "Qr"]},
+    ),
+    "ble": dict(
+        sensor=str, time=int, uuid=str, major=int, minor=int, power=int, rssi=int
+    ),
+    "quality": QUALITY_FIELDS,
+}
+
 
 class PoseyHILStats:
     def __init__(self, log, delay=3):
@@ -29,6 +69,30 @@ class PoseyHILStats:
         self.imu = 0
         self.ble = 0
 
+        # Totals since start, for export rather than the periodic log line.
+        self.messages = {}
+        self.message_bytes = {}
+        self.checksum_errors = {}
+        self.unknown_ids = 0
+        self.decode_latency = Histogram()
+
+    def add_message(self, sig, bytes, valid, latency):
+        """
+        Count a decoded frame.
+
+        :param bytes: Size of the frame.
+        :param valid: Whether its checksum was valid.
+        :param latency: Microseconds taken to decode and queue it.
+        """
+        self.messages[sig] = self.messages.get(sig, 0) + 1
+        self.message_bytes[sig] = self.message_bytes.get(sig, 0) + bytes
+        if not valid:
+            self.checksum_errors[sig] = self.checksum_errors.get(sig, 0) + 1
+        self.decode_latency.add(latency)
+
+    def add_unknown(self):
+        self.unknown_ids += 1
+
     def add_task(self, timestamp, bytes, Vbatt, ble_throughput=0):
         self.bytes += bytes
         self.task += 1
@@ -36,18 +100,32 @@ class PoseyHILStats:
         self.last_Vbatt = Vbatt
         self.ble_throughput = ble_throughput
 
-    def add_datasummary(self):
-        self.bytes += 15 + 3
-        self.task += 1
+    def add_datasummary(self, bytes):
+        self.bytes += bytes
+        self.datasummary += 1
 
-    def add_imu(self):
-        self.bytes += 27 + 3
+    def add_imu(self, bytes):
+        self.bytes += bytes
         self.imu += 1
 
-    def add_ble(self):
-        self.bytes += 12 + 3
+    def add_ble(self, bytes):
+        self.bytes += bytes
         self.ble += 1
 
+    def snapshot(self):
+        # The battery trend comes from the quality monitor.
+        return dict(
+            uptime=time.time() - self.start_time,
+            mcu_time=self.last_timestamp * 1e-6,
+            messages=dict(self.messages),
+            message_bytes=dict(self.message_bytes),
+            checksum_errors=dict(self.checksum_errors),
+            unknown_ids=self.unknown_ids,
+            decode_latency_us=self.decode_latency.snapshot(),
+            battery_volts=self.last_Vbatt if self.last_Vbatt > 0 else None,
+            ble_throughput=self.ble_throughput,
+        )
+
     def stats(self, name, N, dt, postfix="Hz"):
         Hz = N / dt
         return f"{name}: {Hz:5.1f}{postfix}"
@@ -94,14 +172,24 @@ class PoseyHILReceiveMessages:
         ml.add_listener(self.imu)
         ml.add_listener(self.ble)
 
+    def by_id(self):
+        return {
+            pyp.tasks.TaskWaistTelemetry.message_id: self.taskwaist,
+            pyp.tasks.TaskWatchTelemetry.message_id: self.taskwatch,
+            pyp.control.Command.message_id: self.command,
+            pyp.control.DataSummary.message_id: self.datasummary,
+            pyp.platform.sensors.IMUData.message_id: self.imu,
+            pyp.platform.sensors.BLEData.message_id: self.ble,
+        }
+
 
 class PoseyHIL:
     def __init__(
         self,
         name: str,
-        qin: Queue,
-        qout: Queue,
-        pq: Queue,
+        qin: "Queue",
+        qout: "Queue",
+        pq: "Queue",
         adv,
         connection,
         service,
@@ -109,6 +197,8 @@ class PoseyHIL:
     ):
         self.log = logging.getLogger(f"posey.{name}")
         self.stats = PoseyHILStats(self.log)
+        self.timers = StageTimers()
+        self.quality = QualityMonitor(self.log)
         self.last_ping = 0
 
         self.adv = adv
@@ -125,25 +215,76 @@ class PoseyHIL:
 
             self.raw_serial_in_fn = f"{self.output_raw}.in.bin"
             self.raw_serial_in = open(self.raw_serial_in_fn, "wb")
+            self.raw_index_fn = f"{self.output_raw}.in.idx"
+            self.raw_index = open(self.raw_index_fn, "wb")
+            self.raw_t0 = None
 
             self.raw_serial_out_fn = f"{self.output_raw}.out.bin"
             self.raw_serial_out = open(self.raw_serial_out_fn, "wb")
         else:
             self.raw_serial_in = None
+            self.raw_index = None
             self.raw_serial_out = None
 
         self.messages = PoseyHILReceiveMessages()
+        self.messages_by_id = self.messages.by_id()
         self.ml = pyp.platform.io.MessageListener()
         self.messages.register_listeners(self.ml)
+        self.ml_capacity = self.ml.free
+
+        # Outstanding requests, keyed by the response they're waiting for, and
+        # responses that arrived before anyone asked for them.
+        self.pending = {}
+        self.unclaimed = {}
+        self.idle_sleep = 0.001
+
+        self.rx_buffer_full = 0
+        self.decoded = 0
+        self.bytes_in = 0
+        self.frame_bytes = 0
 
     def flush(self):
         pass
 
+    def metrics(self):
+        """
+        Snapshot of this connection's statistics, for ``metrics.write_metrics``.
+        """
+        snapshot = dict(sensor=self.name)
+        snapshot.update(self.stats.snapshot())
+
+        # Anything written to the listener that hasn't come out as a frame,
+        # and isn't still waiting in it, was skipped looking for a sync.
+        pending = self.ml_capacity - self.ml.free
+        snapshot["bytes_received"] = self.bytes_in
+        snapshot["bytes_skipped"] = max(self.bytes_in - self.frame_bytes - pending, 0)
+        try:
+            snapshot["queue_depth"] = self.qout.qsize()
+        except (AttributeError, NotImplementedError):
+            # Not available for multiprocess queues on macOS.
+            snapshot["queue_depth"] = None
+        uart = getattr(self.uart_service, "stats", None)
+        if uart is not None:
+            uart = uart()
+            snapshot["uart_rx_buffer_full"] = uart["rx_buffer_full"]
+            snapshot["uart_high_water"] = uart["high_water"]
+        snapshot.update(self.quality.snapshot())
+        snapshot["stages"] = self.timers.snapshot()
+        return snapshot
+
     @staticmethod
     def Vbatt_counts_to_V(counts):
         return counts / 255.0 * 4.2 + 3.2
 
     def process_message(self, time: dt.datetime, mid: int):
+        self.decoded += 1
+        t0 = perf_counter()
+        message = self.messages_by_id.get(mid)
+        frame_bytes = len(message.buffer.buffer) if message is not None else 0
+        if (message is not None) and message.valid_checksum:
+            message.deserialize()
+        t1 = perf_counter()
+        self.timers.add("decode", t1 - t0)
         sig = None
         data = None
         send_to_pq = False
@@ -153,11 +294,10 @@ class PoseyHIL:
                 Vbatt = self.Vbatt_counts_to_V(self.messages.taskwaist.message.Vbatt)
                 self.stats.add_task(
                     self.messages.taskwaist.message.t_start,
-                    15 + 3,
+                    frame_bytes,
                     Vbatt,
                     self.messages.taskwaist.message.ble_throughput,
                 )
-                self.messages.taskwaist.deserialize()
                 data = {
                     "sensor": self.name,
                     "t_start": self.messages.taskwaist.message.t_start,
@@ -176,10 +316,9 @@ class PoseyHIL:
                 Vbatt = self.Vbatt_counts_to_V(self.messages.taskwatch.message.Vbatt)
                 self.stats.add_task(
                     self.messages.taskwatch.message.t_start,
-                    12 + 3,
+                    frame_bytes,
                     Vbatt,
                 )
-                self.messages.taskwatch.deserialize()
                 data = {
                     "sensor": self.name,
                     "t_start": self.messages.taskwatch.message.t_start,
@@ -197,7 +336,6 @@ class PoseyHIL:
             send_to_pq = True
             sig = "command"
             if self.messages.command.valid_checksum:
-                self.messages.command.deserialize()
                 data = {
                     "sensor": self.name,
                     "command": self.messages.command.message.command,
@@ -213,7 +351,7 @@ class PoseyHIL:
             send_to_pq = True
             sig = "datasummary"
             if self.messages.datasummary.valid_checksum:
-                self.messages.datasummary.deserialize()
+                self.stats.add_datasummary(frame_bytes)
                 data = {
                     "sensor": self.name,
                     "datetime": self.messages.datasummary.message.datetime.tobytes().decode(
@@ -229,8 +367,7 @@ class PoseyHIL:
         elif mid == pyp.platform.sensors.IMUData.message_id:
             sig = "imu"
             if self.messages.imu.valid_checksum:
-                self.stats.add_imu()
-                self.messages.imu.deserialize()
+                self.stats.add_imu(frame_bytes)
                 data = {
                     "sensor": self.name,
                     "time": self.messages.imu.message.time,
@@ -248,8 +385,7 @@ class PoseyHIL:
         elif mid == pyp.platform.sensors.BLEData.message_id:
             sig = "ble"
             if self.messages.ble.valid_checksum:
-                self.stats.add_ble()
-                self.messages.ble.deserialize()
+                self.stats.add_ble(frame_bytes)
                 data = {
                     "sensor": self.name,
                     "time": self.messages.ble.message.time,
@@ -265,11 +401,114 @@ class PoseyHIL:
                 self.log.error("Invalid BLE checkum.")
         else:
             self.log.error(f"Invalid message ID: {mid}")
+            self.stats.add_unknown()
 
+        t2 = perf_counter()
+        self.timers.add("dict", t2 - t1)
         if sig is not None:
+            quality = self.quality.observe(sig, data, time)
+            t3 = perf_counter()
+            self.timers.add("quality", t3 - t2)
             self.qout.put((sig, time, data))
+            if quality is not None:
+                self.qout.put(("quality", time, quality))
             if send_to_pq:
-                self.pq.put((sig, time, data))
+                if self.pq is not None:
+                    self.pq.put((sig, time, data))
+                if data is not None:
+                    self.resolve(self.response_key(sig, data), data)
+            self.timers.add("enqueue", perf_counter() - t3)
+            self.frame_bytes += frame_bytes
+            self.stats.add_message(
+                sig, frame_bytes, data is not None, 1e6 * (perf_counter() - t0)
+            )
+
+    @staticmethod
+    def response_key(sig, data=None, command=None):
+        if sig == "command":
+            return (sig, int(data["command"] if command is None else command))
+        return (sig,)
+
+    def expect(self, key):
+        """
+        Register interest in the next response matching ``key``.
+
+        If a matching response arrived unclaimed since the last ``request``,
+        the returned future is resolved immediately. Call this after sending
+        the request, so responses from before it can't resolve the future.
+
+        :param return: Future resolved with the response data dict.
+        """
+        future = Future()
+        if len(self.unclaimed.get(key, [])) > 0:
+            future.set_result(self.unclaimed[key].popleft())
+        else:
+            self.pending.setdefault(key, deque()).append(future)
+        return future
+
+    def expect_ack(self, command):
+        return self.expect(self.response_key("command", command=command))
+
+    def expect_datasummary(self):
+        return self.expect(self.response_key("datasummary"))
+
+    def resolve(self, key, data):
+        pending = self.pending.get(key)
+        while pending:
+            future = pending.popleft()
+            if future.set_running_or_notify_cancel():
+                future.set_result(data)
+                return
+        self.log.debug(f"Unexpected {key[0]} response: {data}")
+        self.unclaimed.setdefault(key, deque(maxlen=8)).append(data)
+
+    def discard_unclaimed(self):
+        """Forget responses that arrived with nothing waiting for them."""
+        for key, responses in self.unclaimed.items():
+            if len(responses) > 0:
+                self.log.debug(f"Discarding {len(responses)} stale {key[0]} responses")
+        self.unclaimed = {}
+
+    def request(self, cmd):
+        """
+        Send a CommandMessage and return a future for its ack.
+
+        The ack is matched on command type, so replies to other commands can't
+        be mistaken for it. Responses nobody claimed before the request are
+        stale, e.g. late acks to commands that timed out, and are discarded
+        so they can't resolve this or a following ``expect``.
+        """
+        self.discard_unclaimed()
+        future = self.expect_ack(cmd.message.command)
+        if not self.send(cmd):
+            future.set_exception(IOError("Sending failed"))
+        return future
+
+    def wait(self, future, timeout=None, stop=None):
+        """
+        Process incoming data until ``future`` resolves.
+
+        Messages are decoded as soon as they arrive and only sleep briefly when
+        nothing is waiting, so latency is bounded by the link rather than a
+        polling interval.
+
+        :param timeout: Seconds to wait, or None to wait forever.
+        :param stop: Optional callable run every iteration, which may raise to
+            abandon the wait.
+        :param return: The future's result.
+        """
+        t0 = time.time()
+        while not future.done():
+            if stop is not None:
+                stop()
+            if (timeout is not None) and ((time.time() - t0) > timeout):
+                future.cancel()
+                raise TimeoutError("Timeout while waiting for response")
+            read = self.process_uart()
+            decoded = self.decode_pending()
+            if (read == 0) and (decoded == 0):
+                time.sleep(self.idle_sleep)
+        return future.result()
 
     def send(self, cmd):
         try:
@@ -290,7 +529,22 @@ class PoseyHIL:
             self.log.error(traceback.format_exc())
             return False
 
+    def record_raw(self, data):
+        """Append received ``data`` to the raw capture and its index."""
+        if self.raw_serial_in is None:
+            return
+        self.raw_serial_in.write(data)
+        now = perf_counter()
+        if self.raw_t0 is None:
+            self.raw_t0 = now
+        self.raw_index.write(RAW_INDEX.pack(now - self.raw_t0, len(data)))
+
     def close(self):
+        if self.raw_index is not None:
+            self.raw_index.close()
+            self.raw_index = None
+            if os.path.getsize(self.raw_index_fn) == 0:
+                os.remove(self.raw_index_fn)
         if self.raw_serial_in is not None:
             self.raw_serial_in.close()
             self.raw_serial_in = None
@@ -309,13 +563,42 @@ class PoseyHIL:
                 os.remove(self.raw_serial_out_fn)
 
     def read_uart(self, size: int = -1):
+        t0 = perf_counter()
         if size < 0:
             size = self.uart_service.in_waiting
         data = self.uart_service.read(size)
         if data is not None:
             data = bytes(data)
+        self.timers.add("read", perf_counter() - t0)
         return data
 
+    def check_rx_buffer(self):
+        full = getattr(self.uart_service, "rx_buffer_full", 0)
+        if full > self.rx_buffer_full:
+            self.log.warning(
+                f"UART receive buffer full ({self.uart_service.rx_buffer_size} B), "
+                f"data may have been lost! ({full} times so far, consider a "
+                "larger --rx-buffer)"
+            )
+            self.rx_buffer_full = full
+
+    def readinto_uart(self, buffer):
+        """
+        Read straight into ``buffer`` without intermediate copies.
+
+        Reads whatever is waiting, up to ``len(buffer)``. If nothing is waiting
+        this blocks until at least one byte arrives (bounded by the UART
+        timeout), so callers wake on data arrival instead of polling.
+
+        :param return: Number of bytes read.
+        """
+        size = min(len(buffer), max(self.uart_service.in_waiting, 1))
+        self.check_rx_buffer()
+        t0 = perf_counter()
+        n = self.uart_service.readinto(buffer, size)
+        self.timers.add("read", perf_counter() - t0)
+        return n if n is not None else 0
+
     def process_uart(self, decode_messages=True):
         to_read = 0
         data = None
@@ -325,15 +608,19 @@ class PoseyHIL:
             else:
                 to_read = self.uart_service.in_waiting
 
+            self.check_rx_buffer()
             if to_read > 0:
                 data = self.read_uart(to_read)
-                if (data is not None) and (self.raw_serial_in is not None):
-                    self.raw_serial_in.write(data)
+                if data is not None:
+                    self.record_raw(data)
 
             if decode_messages:
+                t0 = perf_counter()
                 if data is not None:
                     self.ml.write(data)
+                    self.bytes_in += len(data)
                 mid = self.ml.process_next()
+                self.timers.add("frame", perf_counter() - t0)
                 if mid >= 0:
                     self.process_message(dt.datetime.now(), mid)
 
@@ -342,25 +629,40 @@ class PoseyHIL:
 
         return to_read
 
+    def decode_pending(self):
+        decoded = 0
+        while True:
+            t0 = perf_counter()
+            mid = self.ml.process_next()
+            self.timers.add("frame", perf_counter() - t0)
+            if mid < 0:
+                break
+            self.process_message(dt.datetime.now(), mid)
+            decoded += 1
+        return decoded
+
+    def feed(self, buffer):
+        view = memoryview(buffer).cast("B")
+        N = len(view)
+        bytes_left = N
+        decoded = 0
+        while bytes_left > 0:
+            to_read = min(bytes_left, self.ml.free)
+            if to_read > 0:
+                si = N - bytes_left
+                ei = si + to_read
+                t0 = perf_counter()
+                self.ml.write(view[si:ei])
+                self.timers.add("frame", perf_counter() - t0)
+                self.bytes_in += to_read
+                bytes_left -= to_read
+
+            decoded += self.decode_pending()
+        return decoded
+
     def decode_buffer(self, buffer):
         try:
-            N = len(buffer)
-            bytes_left = N
-            while bytes_left > 0:
-                to_read = min(bytes_left, self.ml.free)
-                if to_read > 0:
-                    si = N - bytes_left
-                    ei = si + to_read
-                    data = bytes(buffer[si:ei])
-                    self.ml.write(data)
-                    bytes_left -= to_read
-
-                while True:
-                    mid = self.ml.process_next()
-                    if mid >= 0:
-                        self.process_message(dt.datetime.now(), mid)
-                    else:
-                        break
+            self.feed(buffer)
             self.log.info("Dumping to CSV, this may take a while...")
             iter = 0
             while not self.qin.empty():
@@ -0,0 +1,290 @@
+import time
+
+import numpy as np
+
+from poseyctrl.metrics import StageTimers
+
+
+# Standard gravity (m/s^2), removed from the world frame Z axis.
+GRAVITY = 9.80665
+
+# Input columns, as written by CSVWriter for the imu signal.
+ACCEL = ["Ax", "Ay", "Az"]
+QUAT = ["Qi", "Qj", "Qk", "Qr"]
+
+# Columns written by ``ImuProcessor``. Angles are in degrees and the linear
+# (gravity removed) acceleration is in the world frame.
+COLUMNS = (
+    ["time"]
+    + ACCEL
+    + QUAT
+    + ["roll", "pitch", "yaw", "Lx", "Ly", "Lz", "A_mag", "L_mag"]
+)
+
+# Rows handled at a time when processing a stream.
+CHUNK_ROWS = 65536
+
+
+def euler(Q):
+    """
+    Roll, pitch and yaw (degrees) of unit quaternions.
+
+    :param Q: (N, 4) array of (i, j, k, r).
+    :param return: (N, 3) array.
+    """
+    x, y, z, w = Q.T
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1, 1))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return np.degrees(np.stack([roll, pitch, yaw], axis=1))
+
+
+def rotate(Q, V):
+    """
+    Rotate vectors from the sensor frame to the world frame.
+
+    :param Q: (N, 4) array of unit quaternions (i, j, k, r).
+    :param V: (N, 3) array of vectors.
+    :param return: (N, 3) array.
+    """
+    u = Q[:, :3]
+    w = Q[:, 3:]
+    uv = np.cross(u, V)
+    return V + 2 * w * uv + 2 * np.cross(u, uv)
+
+
+def linear_acceleration(Q, A, gravity=GRAVITY):
+    """:param return: World frame acceleration with gravity removed."""
+    L = rotate(Q, A)
+    L[:, 2] -= gravity
+    return L
+
+
+def unflip(Q, previous=None):
+    """
+    Flip quaternions where needed so each is in the same hemisphere as the
+    one before (q and -q are the same rotation), so they can be interpolated.
+
+    :param previous: Last quaternion of the previous chunk, if any.
+    """
+    if len(Q) == 0:
+        return Q
+    if previous is not None:
+        Q = np.vstack([previous, Q])
+    dots = np.einsum("ij,ij->i", Q[1:], Q[:-1])
+    signs = np.cumprod(np.where(dots < 0, -1.0, 1.0))
+    Q[1:] *= signs[:, None]
+    return Q[1:] if previous is not None else Q
+
+
+class Resampler:
+    """
+    Linear interpolation of irregularly timed samples onto a uniform grid,
+    one chunk at a time. The grid is aligned to multiples of the period, and
+    the last sample of each chunk is kept to interpolate into the next.
+
+    Device time going back more than ``reset_gap`` is taken as an MCU reset
+    and starts a new segment with its own grid. Samples going back less are
+    out of order and dropped. Both are counted, in ``resets`` and
+    ``dropped``.
+    """
+
+    def __init__(self, rate, max_gap=None, reset_gap=1e5):
+        """
+        :param rate: Output rate (Hz), for times in microseconds.
+        :param max_gap: Don't interpolate between samples further apart than
+            this (microseconds), leaving a gap in the output.
+        :param reset_gap: Device time going back further than this
+            (microseconds) is a reset.
+        """
+        self.period = 1e6 / rate
+        self.max_gap = max_gap
+        self.reset_gap = reset_gap
+        self.next = None
+        self.last_t = None
+        self.last_X = None
+        self.resets = 0
+        self.dropped = 0
+
+    def __call__(self, t, X):
+        """
+        :param t: (N,) times, which should be increasing apart from resets.
+        :param X: (N, M) values.
+        :param return: Tuple of grid times and interpolated (K, M) values.
+        """
+        t = np.asarray(t, dtype=float)
+        if self.last_t is not None:
+            t = np.concatenate([[self.last_t], t])
+            X = np.vstack([self.last_X, X])
+        grids = []
+        outs = []
+        si = 0
+        while True:
+            # Latest time before each sample of the segment, which it has to
+            # be later than, unless it's far enough back to be a reset.
+            latest = np.maximum.accumulate(np.concatenate([[-np.inf], t[si:-1]]))
+            resets = np.flatnonzero(t[si:] < latest - self.reset_gap)
+            ei = si + resets[0] if len(resets) > 0 else len(t)
+            keep = t[si:ei] > latest[: ei - si]
+            self.dropped += int(np.count_nonzero(~keep))
+            grid, out = self.resample(t[si:ei][keep], X[si:ei][keep])
+            grids.append(grid)
+            outs.append(out)
+            if ei == len(t):
+                break
+            self.resets += 1
+            self.next = None
+            si = ei
+        if len(grids) == 1:
+            return grids[0], outs[0]
+        return np.concatenate(grids), np.vstack(outs)
+
+    def resample(self, t, X):
+        # One segment of increasing times.
+        if len(t) == 0:
+            return t, X
+        self.last_t, self.last_X = t[-1], X[-1]
+        if len(t) < 2:
+            return t[:0], X[:0]
+
+        if self.next is None:
+            self.next = np.ceil(t[0] / self.period) * self.period
+        grid = np.arange(self.next, t[-1] + 1e-9, self.period)
+        if len(grid) == 0:
+            return grid, X[:0]
+        self.next = grid[-1] + self.period
+
+        i = np.clip(np.searchsorted(t, grid, side="right") - 1, 0, len(t) - 2)
+        dt = t[i + 1] - t[i]
+        frac = ((grid - t[i]) / dt)[:, None]
+        out = X[i] + frac * (X[i + 1] - X[i])
+        if self.max_gap is not None:
+            valid = dt <= self.max_gap
+            grid, out = grid[valid], out[valid]
+        return grid, out
+
+
+class ImuProcessor:
+    """
+    Optionally resamples IMU samples to a uniform rate, then derives Euler
+    angles, gravity removed acceleration and magnitudes, all vectorized over
+    chunks of samples. State is carried between chunks, so a stream of any
+    length can be processed in bounded memory.
+    """
+
+    def __init__(self, rate=None, max_gap=None):
+        self.resampler = Resampler(rate, max_gap) if rate else None
+        self.last_Q = None
+
+    def process(self, t, A, Q):
+        """
+        :param t: (N,) device times (microseconds).
+        :param A: (N, 3) acceleration.
+        :param Q: (N, 4) orientation quaternions (i, j, k, r).
+        :param return: (K, len(COLUMNS)) array.
+        """
+        Q = unflip(np.array(Q, dtype=float), self.last_Q)
+        if len(Q) > 0:
+            self.last_Q = Q[-1].copy()
+        if self.resampler is not None:
+            t, X = self.resampler(t, np.hstack([A, Q]))
+            A, Q = X[:, :3], X[:, 3:]
+        norm = np.linalg.norm(Q, axis=1, keepdims=True)
+        Q = Q / np.where(norm > 0, norm, 1)
+        L = linear_acceleration(Q, A)
+        return np.column_stack(
+            [
+                t,
+                A,
+                Q,
+                euler(Q),
+                L,
+                np.linalg.norm(A, axis=1),
+                np.linalg.norm(L, axis=1),
+            ]
+        )
+
+
+def chunks(stream, chunk_rows=CHUNK_ROWS):
+    """
+    Group the IMU rows of a ``merge`` stream into arrays.
+
+    :param return: Generator of (t, A, Q) arrays.
+    """
+    idx = [stream.columns.index(c) for c in ACCEL + QUAT]
+    rows = []
+    times = []
+    for t, _, values in stream:
+        times.append(t)
+        rows.append([values[i] for i in idx])
+        if len(rows) >= chunk_rows:
+            X = np.array(rows, dtype=float)
+            yield np.array(times, dtype=float), X[:, :3], X[:, 3:]
+            rows, times = [], []
+    if len(rows) > 0:
+        X = np.array(rows, dtype=float)
+        yield np.array(times, dtype=float), X[:, :3], X[:, 3:]
+
+
+def process_stream(
+    stream,
+    output,
+    rate=None,
+    max_gap=None,
+    chunk_rows=CHUNK_ROWS,
+    timers=None,
+    processor=None,
+):
+    """
+    Process the IMU rows of a ``merge`` stream into the CSV file ``output``.
+
+    :param timers: Optional StageTimers to add the time spent per stage to.
+    :param processor: Optional ImuProcessor to use instead of one for
+        ``rate`` and ``max_gap``, e.g. to read its resampler's counts after.
+    :param return: Number of rows written.
+    """
+    timers = timers if timers is not None else StageTimers()
+    if processor is None:
+        processor = ImuProcessor(rate, max_gap)
+    # Formatting a whole chunk at once is several times faster than savetxt.
+    fmt = ",".join(["%.3f"] + ["%.9g"] * (len(COLUMNS) - 1)) + "\n"
+    rows = 0
+    with open(output, "w") as f:
+        f.write(",".join(COLUMNS) + "\n")
+        it = chunks(stream, chunk_rows)
+        while True:
+            t0 = time.perf_counter()
+            chunk = next(it, None)
+            if chunk is None:
+                break
+            t1 = time.perf_counter()
+            out = processor.process(*chunk)
+            t2 = time.perf_counter()
+            f.write((fmt * len(out)) % tuple(out.ravel().tolist()))
+            t3 = time.perf_counter()
+            timers.add("read", t1 - t0, len(chunk[0]))
+            timers.add("derive", t2 - t1, len(out))
+            timers.add("write", t3 - t2, len(out))
+            rows += len(out)
+    return rows
+
+
+def process_file(input, output, rate=None, max_gap=None, timers=None):
+    """
+    Process a ``data.imu.csv`` file, or the IMU data in a binary capture or
+    slot, into ``output``.
+
+    :param return: Number of rows written.
+    """
+    # Imported here as merge pulls in the decoder.
+    from poseyctrl import merge
+
+    stream = merge.open_stream(input, ["imu"])[0]
+    try:
+        return process_stream(stream, output, rate, max_gap, timers=timers)
+    finally:
+        stream.close()
+
+
+def derived_filename(prefix):
+    return f"{prefix}data.imu_derived.csv"
@@ -0,0 +1,242 @@
+import os
+import csv
+import heapq
+import queue
+import itertools
+import datetime as dt
+from operator import itemgetter
+
+from poseyctrl import decode
+from poseyctrl import hil
+
+
+# Columns tried, in order, for a stream's time when none is given. Device
+# times are in microseconds, except ``rssi.csv`` from posey-extract (seconds).
+TIME_COLUMNS = ["time", "t_start"]
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        # CSVWriter's pctime column.
+        return dt.datetime.fromisoformat(value).timestamp()
+
+
+def find_time_column(columns, time_column=None):
+    candidates = [time_column] if time_column is not None else TIME_COLUMNS
+    for column in candidates:
+        if column in columns:
+            return column
+    raise ValueError(f"No time column ({', '.join(candidates)}) in {columns}")
+
+
+class CSVStream:
+    """
+    Rows of a CSV file with a header, such as the ``data.<sig>.csv`` files
+    written by CSVWriter, read one at a time.
+
+    Iterating yields ``(time, time as written, values)``, where ``values``
+    are the other columns in ``columns`` order.
+    """
+
+    def __init__(self, fn, label=None, time_column=None):
+        self.fn = fn
+        self.label = label if label is not None else default_label(fn)
+        self.file = open(fn, "r", newline="")
+        self.reader = csv.reader(self.file)
+        header = next(self.reader, None)
+        if header is None:
+            raise ValueError(f"{fn} is empty")
+        self.time_column = find_time_column(header, time_column)
+        self.time_index = header.index(self.time_column)
+        self.columns = [c for c in header if c != self.time_column]
+        self.width = len(header)
+        self.out_of_order = 0
+        self.malformed = 0
+
+    def __iter__(self):
+        ti = self.time_index
+        last = None
+        for row in self.reader:
+            if len(row) != self.width:
+                self.malformed += 1
+                continue
+            t = parse_time(row[ti])
+            if (last is not None) and (t < last):
+                self.out_of_order += 1
+            last = t
+            yield t, row[ti], row[:ti] + row[ti + 1 :]
+
+    def close(self):
+        self.file.close()
+
+
+class SignalCollector:
+    """Queue stand-in that keeps decoded rows of one signal."""
+
+    def __init__(self, sig):
+        self.sig = sig
+        self.rows = []
+
+    def put(self, item):
+        sig, _, data = item
+        if (sig == self.sig) and (data is not None):
+            self.rows.append(data)
+
+    def qsize(self):
+        return len(self.rows)
+
+
+class BinStream:
+    """
+    Rows of one signal decoded on the fly from a raw capture or an extracted
+    slot, a block at a time, so only one block's worth of rows is held.
+
+    The first row is decoded up front to learn the columns.
+    """
+
+    def __init__(self, fn, signal="imu", label=None, time_column=None):
+        self.fn = fn
+        self.signal = signal
+        if label is None:
+            label = f"{decode.default_prefix(fn)}.{signal}"
+        self.label = label
+        self.collector = SignalCollector(signal)
+        self.sensor = hil.PoseyHIL(
+            self.label, None, self.collector, queue.Queue(), None, None, None
+        )
+        self.rows = self.decode()
+        self.first = next(self.rows, None)
+        if self.first is None:
+            raise ValueError(f"No {signal} messages in {fn}")
+        self.time_column = find_time_column(list(self.first), time_column)
+        self.columns = [c for c in self.first if c != self.time_column]
+        self.out_of_order = 0
+        self.malformed = 0
+
+    def decode(self):
+        for block in decode.read_blocks(self.fn):
+            self.sensor.feed(block)
+            rows, self.collector.rows = self.collector.rows, []
+            yield from rows
+
+    def __iter__(self):
+        last = None
+        for data in itertools.chain([self.first], self.rows):
+            t = data[self.time_column]
+            if (last is not None) and (t < last):
+                self.out_of_order += 1
+            last = t
+            yield t, t, [data[c] for c in self.columns]
+
+    def close(self):
+        self.rows.close()
+
+
+def default_label(fn):
+    # hub1.data.imu.csv -> hub1.imu
+    base = os.path.basename(fn)
+    if base.endswith(".csv"):
+        base = base[: -len(".csv")]
+    return base.replace("data.", "")
+
+
+def open_stream(spec, signals=("imu",), time_column=None):
+    """
+    Open ``[LABEL=]PATH`` as streams: one for a CSV, and one per signal in
+    ``signals`` for a binary capture.
+
+    :param return: List of streams.
+    """
+    label = None
+    if ("=" in spec) and not os.path.exists(spec):
+        label, spec = spec.split("=", 1)
+    if spec.endswith(".csv"):
+        return [CSVStream(spec, label, time_column)]
+    if len(signals) > 1:
+        return [
+            BinStream(spec, sig, f"{label}.{sig}" if label else None, time_column)
+            for sig in signals
+        ]
+    return [BinStream(spec, signals[0], label, time_column)]
+
+
+def tagged(stream, i):
+    for t, raw, values in stream:
+        yield t, i, raw, values
+
+
+def merge(streams):
+    """
+    k-way merge of time sorted streams.
+
+    Only the next row of each stream is held, in a heap, so memory doesn't
+    grow with the inputs. Rows with equal times come out in stream order.
+
+    :param return: Generator of (time, stream index, time as written, values).
+    """
+    return heapq.merge(
+        *[tagged(stream, i) for i, stream in enumerate(streams)], key=itemgetter(0)
+    )
+
+
+def interleave(streams, writer):
+    """
+    Write every row of every stream in time order, as ``time,source`` and
+    the union of the streams' columns.
+
+    :param return: Number of rows written.
+    """
+    columns = []
+    for stream in streams:
+        columns += [c for c in stream.columns if c not in columns]
+    positions = [[columns.index(c) for c in stream.columns] for stream in streams]
+    labels = [stream.label for stream in streams]
+    writer.writerow(["time", "source"] + columns)
+
+    rows = 0
+    for _, i, raw, values in merge(streams):
+        out = [""] * len(columns)
+        for pos, value in zip(positions[i], values):
+            out[pos] = value
+        writer.writerow([raw, labels[i]] + out)
+        rows += 1
+    return rows
+
+
+def asof(streams, on, writer, tolerance=None):
+    """
+    Write one row per row of ``streams[on]``, joined with the latest row at
+    or before it from each other stream (an as-of join). Rows older than
+    ``tolerance`` are left out, leaving those columns empty.
+
+    :param return: Number of rows written.
+    """
+    # Put the reference stream last so rows at the same time are seen first.
+    others = [s for i, s in enumerate(streams) if i != on]
+    ordered = others + [streams[on]]
+    ref = len(others)
+    header = ["time"]
+    for stream in [streams[on]] + others:
+        header += [f"{stream.label}.{c}" for c in stream.columns]
+    writer.writerow(header)
+
+    last = [None] * len(others)
+    blanks = [[""] * len(stream.columns) for stream in others]
+    rows = 0
+    for t, i, raw, values in merge(ordered):
+        if i != ref:
+            last[i] = (t, values)
+            continue
+        out = [raw] + values
+        for j, latest in enumerate(last):
+            if (latest is None) or (
+                (tolerance is not None) and (t - latest[0] > tolerance)
+            ):
+                out += blanks[j]
+            else:
+                out += latest[1]
+        writer.writerow(out)
+        rows += 1
+    return rows
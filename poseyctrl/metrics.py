@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import bisect
+from collections import deque
+
+
+# Upper bounds (microseconds) of the decode latency histogram buckets.
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket upper bounds."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return dict(
+            buckets=self.buckets,
+            counts=list(self.counts),
+            count=self.count,
+            sum=self.sum,
+        )
+
+
+class Trend:
+    """
+    Least-squares slope of a value over the last ``window`` seconds, once
+    the samples span at least ``min_span`` seconds.
+    """
+
+    def __init__(self, window=600, min_span=0):
+        self.window = window
+        self.min_span = min_span
+        self.samples = deque()
+        # Running sums over the samples, with times relative to the first
+        # one, so the slope takes constant work however many there are.
+        self.t0 = None
+        self.sums = [0.0] * 5
+
+    def update(self, t, value, sign):
+        x = t - self.t0
+        n, sx, sxx, sv, sxv = self.sums
+        self.sums = [
+            n + sign,
+            sx + sign * x,
+            sxx + sign * x * x,
+            sv + sign * value,
+            sxv + sign * x * value,
+        ]
+
+    def add(self, t, value):
+        if self.t0 is None:
+            self.t0 = t
+        self.samples.append((t, value))
+        self.update(t, value, 1)
+        while self.samples and (t - self.samples[0][0] > self.window):
+            self.update(*self.samples.popleft(), -1)
+
+    def slope(self):
+        if len(self.samples) < 2:
+            return None
+        if self.samples[-1][0] - self.samples[0][0] < max(self.min_span, 1e-9):
+            return None
+        n, sx, sxx, sv, sxv = self.sums
+        denominator = n * sxx - sx * sx
+        if denominator <= 0:
+            return None
+        return (n * sxv - sx * sv) / denominator
+
+
+class StageTimers:
+    """
+    Time spent and number of calls per processing stage, cheap enough to
+    leave on. Callers time a stage with ``perf_counter`` and ``add`` it.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds, count=1):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0]
+        entry[0] += count
+        entry[1] += seconds
+
+    def merge(self, stages):
+        """Add the ``stages`` of another StageTimers, e.g. from a worker."""
+        for stage, (count, seconds) in stages.items():
+            self.add(stage, seconds, count)
+
+    def snapshot(self):
+        return {
+            stage: dict(count=count, seconds=seconds)
+            for stage, (count, seconds) in self.stages.items()
+        }
+
+    @classmethod
+    def load(cls, snapshot):
+        timers = cls()
+        for stage, entry in snapshot.items():
+            timers.add(stage, entry["seconds"], entry["count"])
+        return timers
+
+    def summary(self):
+        """:param return: List of lines tabulating the stages."""
+        total = sum(seconds for _, seconds in self.stages.values())
+        header = "{:<10} {:>10} {:>9} {:>9} {:>6}"
+        row = "{:<10} {:>10} {:>9.3f} {:>9.1f} {:>5.1f}%"
+        lines = [header.format("Stage", "Count", "Total s", "us each", "Share")]
+        for stage, (count, seconds) in sorted(
+            self.stages.items(), key=lambda item: -item[1][1]
+        ):
+            each = 1e6 * seconds / max(count, 1)
+            share = 100 * seconds / total if total > 0 else 0
+            lines.append(row.format(stage, count, seconds, each, share))
+        return lines
+
+    def log_summary(self, log, title="Time per stage:"):
+        if len(self.stages) == 0:
+            return
+        log.info(title)
+        for line in self.summary():
+            log.info(line)
+
+
+# Prometheus metric name, type, help and snapshot key for per-sensor values.
+SCALARS = [
+    ("posey_uptime_seconds", "gauge", "Seconds since connecting.", "uptime"),
+    ("posey_received_bytes_total", "counter", "Bytes received.", "bytes_received"),
+    (
+        "posey_skipped_bytes_total",
+        "counter",
+        "Bytes skipped while resyncing to a frame.",
+        "bytes_skipped",
+    ),
+    (
+        "posey_unknown_ids_total",
+        "counter",
+        "Frames with an unknown message id.",
+        "unknown_ids",
+    ),
+    (
+        "posey_queue_depth",
+        "gauge",
+        "Decoded messages waiting to be written.",
+        "queue_depth",
+    ),
+    ("posey_battery_volts", "gauge", "Last reported battery voltage.", "battery_volts"),
+    (
+        "posey_battery_volts_per_hour",
+        "gauge",
+        "Battery voltage trend.",
+        "battery_volts_per_hour",
+    ),
+    (
+        "posey_ble_throughput",
+        "gauge",
+        "BLE throughput reported by the hub.",
+        "ble_throughput",
+    ),
+    (
+        "posey_uart_rx_buffer_full_total",
+        "counter",
+        "Times the UART receive buffer was seen full when polled.",
+        "uart_rx_buffer_full",
+    ),
+    (
+        "posey_uart_high_water_bytes",
+        "gauge",
+        "Most bytes seen waiting in the UART receive buffer.",
+        "uart_high_water",
+    ),
+    (
+        "posey_missed_deadlines_total",
+        "counter",
+        "Missed deadlines reported by the task telemetry.",
+        "missed_deadlines",
+    ),
+    (
+        "posey_device_invalid_checksums_total",
+        "counter",
+        "Invalid checksums reported by the task telemetry.",
+        "device_invalid_checksums",
+    ),
+]
+
+# As above, for values kept per message type.
+PER_TYPE = [
+    ("posey_messages_total", "counter", "Messages decoded.", "messages"),
+    (
+        "posey_message_bytes_total",
+        "counter",
+        "Bytes of decoded frames.",
+        "message_bytes",
+    ),
+    (
+        "posey_checksum_errors_total",
+        "counter",
+        "Frames with a bad checksum.",
+        "checksum_errors",
+    ),
+    (
+        "posey_longest_checksum_error_run",
+        "gauge",
+        "Most frames in a row with a bad checksum.",
+        "longest_checksum_run",
+    ),
+    (
+        "posey_sample_gaps_total",
+        "counter",
+        "Gaps in the device times of periodic messages.",
+        "sample_gaps",
+    ),
+    (
+        "posey_missing_samples_total",
+        "counter",
+        "Samples estimated missing from those gaps.",
+        "missing_samples",
+    ),
+    (
+        "posey_clock_resets_total",
+        "counter",
+        "Times the device time went backwards.",
+        "clock_resets",
+    ),
+]
+
+
+def escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**kwargs):
+    return ",".join(f'{k}="{escape(v)}"' for k, v in kwargs.items())
+
+
+def to_prometheus(snapshots):
+    """
+    Format PoseyHIL metrics snapshots in the Prometheus text format.
+
+    :param return: The text.
+    """
+    lines = []
+    for name, kind, help, key in SCALARS:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for snap in snapshots:
+            if snap.get(key) is not None:
+                lines.append(f"{name}{{{labels(sensor=snap['sensor'])}}} {snap[key]}")
+
+    for name, kind, help, key in PER_TYPE:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for snap in snapshots:
+            for sig, value in sorted(snap[key].items()):
+                lines.append(
+                    f"{name}{{{labels(sensor=snap['sensor'], type=sig)}}} {value}"
+                )
+
+    name = "posey_decode_seconds"
+    lines += [
+        f"# HELP {name} Time to decode and queue a message.",
+        f"# TYPE {name} histogram",
+    ]
+    for snap in snapshots:
+        sensor = snap["sensor"]
+        hist = snap["decode_latency_us"]
+        cumulative = 0
+        for le, n in zip(hist["buckets"] + [None], hist["counts"]):
+            cumulative += n
+            le = "+Inf" if le is None else f"{le * 1e-6:g}"
+            bucket = labels(sensor=sensor, le=le)
+            lines.append(f"{name}_bucket{{{bucket}}} {cumulative}")
+        lines.append(f"{name}_sum{{{labels(sensor=sensor)}}} {hist['sum'] * 1e-6}")
+        lines.append(f"{name}_count{{{labels(sensor=sensor)}}} {hist['count']}")
+
+    name = "posey_stage_seconds_total"
+    lines += [
+        f"# HELP {name} Time spent in each processing stage.",
+        f"# TYPE {name} counter",
+    ]
+    for snap in snapshots:
+        for stage, entry in sorted(snap.get("stages", {}).items()):
+            stage = labels(sensor=snap["sensor"], stage=stage)
+            lines.append(f"{name}{{{stage}}} {entry['seconds']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(fn, snapshots):
+    """
+    Atomically rewrite ``fn`` with metrics snapshots, as Prometheus text if
+    it ends in ``.prom`` and JSON otherwise.
+    """
+    tmp = f"{fn}.tmp"
+    with open(tmp, "w") as f:
+        if fn.endswith(".prom"):
+            f.write(to_prometheus(snapshots))
+        else:
+            json.dump(dict(time=time.time(), sensors=snapshots), f, indent=4)
+    os.replace(tmp, fn)
+
+
+class MetricsWriter:
+    """Calls ``write_metrics`` at most every ``interval`` seconds."""
+
+    def __init__(self, fn, interval=5):
+        self.fn = fn
+        self.interval = interval
+        self.last_write = 0
+
+    def maybe_write(self, snapshots):
+        """
+        :param snapshots: List of snapshots, or a callable returning one so
+            they're only built when it's time to write.
+        """
+        now = time.time()
+        if now - self.last_write < self.interval:
+            return False
+        if callable(snapshots):
+            snapshots = snapshots()
+        write_metrics(self.fn, snapshots)
+        self.last_write = now
+        return True
@@ -11,11 +11,22 @@ This module provides Services used by Nordic Semiconductors.
 
 """
 
+import time
+
 from adafruit_ble.services import Service
 from adafruit_ble.uuid import VendorUUID
 from adafruit_ble.characteristics.stream import StreamOut, StreamIn
 
 
+DEFAULT_BUFFER_SIZE = 10 * 1024
+
+# Payload of the smallest ATT MTU, used when the connection can't tell us.
+DEFAULT_PACKET_SIZE = 20
+
+# Seconds between chunks of a write, so the peripheral isn't flooded.
+WRITE_INTERVAL = 0.005
+
+
 class UARTService(Service):
     """
     Provide UART-like functionality via the Nordic NUS service.
@@ -30,25 +41,56 @@ class UARTService(Service):
         uuid=VendorUUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
         timeout=1.0,
         # buffer_size=64,
-        buffer_size=10 * 1024,
+        buffer_size=DEFAULT_BUFFER_SIZE,
     )
     _server_rx = StreamIn(
         uuid=VendorUUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
         timeout=1.0,
         # buffer_size=64,
-        buffer_size=10 * 1024,
+        buffer_size=DEFAULT_BUFFER_SIZE,
     )
 
+    @classmethod
+    def set_buffer_sizes(cls, rx=None):
+        """
+        Set the receive buffer size (bytes) used by a client.
+
+        Buffers are created when a connection binds the service, so this
+        applies to connections made afterwards. A client's writes go straight
+        to the characteristic, so there's no transmit buffer to size.
+        """
+        # As a client, we receive on the server's TX.
+        if rx is not None:
+            cls._server_tx._buffer_size = int(rx)
+
+    @classmethod
+    def buffer_sizes(cls):
+        return dict(rx=cls._server_tx._buffer_size)
+
     def __init__(self, service=None):
         super().__init__(service=service)
         self.connectable = True
         if not service:
             self._rx = self._server_rx
             self._tx = self._server_tx
+            self.rx_buffer_size = UARTService._server_rx._buffer_size
         else:
             # If we're a client then swap the characteristics we use.
             self._tx = self._server_rx
             self._rx = self._server_tx
+            self.rx_buffer_size = UARTService._server_tx._buffer_size
+
+        # Writes are split into packets of at most this many bytes, paced by
+        # write_interval, once the connection's packet size is known.
+        self.packet_size = None
+        self.write_interval = WRITE_INTERVAL
+        self.tx_packets = 0
+
+        # The receive buffer drops anything arriving while it's full, so
+        # track how close it gets and how often it's seen full.
+        self.high_water = 0
+        self.rx_buffer_full = 0
+        self._full = False
 
     def read(self, nbytes=None):
         """
@@ -82,8 +124,32 @@ class UARTService(Service):
 
     @property
     def in_waiting(self):
-        """The number of bytes in the input buffer, available to be read."""
-        return self._rx.in_waiting
+        """
+        The number of bytes in the input buffer, available to be read.
+
+        Each time the buffer is found (within a packet of) full when this is
+        sampled, after not being full last time, ``rx_buffer_full`` is
+        counted. This is a heuristic, the buffer doesn't report drops: it
+        misses the buffer overflowing and draining between samples, and counts
+        a full buffer that didn't drop anything.
+        """
+        n = self._rx.in_waiting
+        if n > self.high_water:
+            self.high_water = n
+        full = n > self.rx_buffer_size - (self.packet_size or DEFAULT_PACKET_SIZE)
+        if full and not self._full:
+            self.rx_buffer_full += 1
+        self._full = full
+        return n
+
+    def stats(self):
+        return dict(
+            rx_buffer=self.rx_buffer_size,
+            high_water=self.high_water,
+            rx_buffer_full=self.rx_buffer_full,
+            packet_size=self.packet_size,
+            tx_packets=self.tx_packets,
+        )
 
     def reset_input_buffer(self):
         """Discard any unread characters in the input buffer."""
@@ -91,4 +157,23 @@ class UARTService(Service):
 
     def write(self, buf):
         """Write a buffer of bytes."""
-        self._tx.write(buf)
+        if (self.packet_size is None) or (len(buf) <= self.packet_size):
+            self._tx.write(buf)
+            self.tx_packets += 1
+            return
+        for i in range(0, len(buf), self.packet_size):
+            if i > 0:
+                time.sleep(self.write_interval)
+            self._tx.write(buf[i : i + self.packet_size])
+            self.tx_packets += 1
+
+
+def packet_size(connection, default=DEFAULT_PACKET_SIZE):
+    """
+    Largest write payload the negotiated MTU allows on ``connection``.
+    """
+    try:
+        size = connection._bleio_connection.max_packet_length
+    except AttributeError:
+        size = None
+    return size if size else default
@@ -0,0 +1,125 @@
+import time
+import logging
+
+from poseyctrl.patch.nordic import DEFAULT_BUFFER_SIZE
+
+
+class AdaptivePoller:
+    """
+    Paces reads from a live sensor so the host isn't spinning a core.
+
+    After draining everything waiting, the poller sleeps for as long as it
+    would take data arriving at the recently observed rate to fill ``target``
+    of the UART receive buffer, within ``[min_sleep, max_sleep]``. A backlog
+    means we're behind, so there is no sleep at all until it's cleared, and
+    each time the receive buffer is seen full halves ``target`` for the rest
+    of the session.
+    """
+
+    def __init__(
+        self,
+        hil,
+        target=0.25,
+        min_sleep=0.001,
+        max_sleep=0.05,
+        alpha=0.2,
+        delay=3,
+        log=None,
+    ):
+        self.hil = hil
+        self.target = target
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.alpha = alpha
+        self.delay = delay
+        self.log = log if log is not None else logging.getLogger("poller")
+
+        self.rate = 0
+        self.rx_buffer_full = 0
+        self.last_step = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.last_update = time.perf_counter()
+        self.last_cpu = time.process_time()
+        self.last_decoded = self.hil.decoded
+        self.wakeups = 0
+        self.slept = 0
+
+    @property
+    def capacity(self):
+        return getattr(self.hil.uart_service, "rx_buffer_size", DEFAULT_BUFFER_SIZE)
+
+    def step(self):
+        """
+        Read and decode whatever has arrived, then sleep as appropriate.
+
+        :param return: Number of bytes read.
+        """
+        self.wakeups += 1
+        read = 0
+        while True:
+            n = self.hil.process_uart()
+            self.hil.decode_pending()
+            read += n
+            # The decoder only takes what it has room for, so keep going
+            # until the UART is empty.
+            if (n == 0) or (self.hil.uart_service.in_waiting == 0):
+                break
+
+        now = time.perf_counter()
+        dt = max(now - self.last_step, 1e-6)
+        self.last_step = now
+        # Speed up straight away, slow down gradually.
+        rate = read / dt
+        if rate > self.rate:
+            self.rate = rate
+        else:
+            self.rate += self.alpha * (rate - self.rate)
+
+        full = getattr(self.hil.uart_service, "rx_buffer_full", 0)
+        if full > self.rx_buffer_full:
+            self.rx_buffer_full = full
+            self.target = max(self.target / 2, 0.01)
+            self.log.warning(
+                f"Polling faster, target buffer fill now {self.target:.0%}"
+            )
+
+        sleep = self.sleep_time(read)
+        if sleep > 0:
+            time.sleep(sleep)
+            self.slept += sleep
+        return read
+
+    def sleep_time(self, read):
+        if read > self.target * self.capacity:
+            return 0
+        if self.rate <= 0:
+            return self.max_sleep
+        sleep = self.target * self.capacity / self.rate
+        return min(max(sleep, self.min_sleep), self.max_sleep)
+
+    def stats(self):
+        now = time.perf_counter()
+        dt = max(now - self.last_update, 1e-6)
+        cpu = time.process_time() - self.last_cpu
+        decoded = self.hil.decoded - self.last_decoded
+        return dict(
+            cpu_percent=100.0 * cpu / dt,
+            cpu_us_per_message=1e6 * cpu / decoded if decoded > 0 else None,
+            messages_per_second=decoded / dt,
+            wakeups_per_second=self.wakeups / dt,
+            sleep_percent=100.0 * self.slept / dt,
+            rate_kbps=self.rate / 1024.0,
+        )
+
+    def log_stats(self):
+        if time.perf_counter() - self.last_update < self.delay:
+            return
+        stats = self.stats()
+        per_message = stats["cpu_us_per_message"]
+        per_message = f"{per_message:.0f}us/msg" if per_message is not None else "-"
+        self.log.info(
+            f"CPU: {stats['cpu_percent']:4.1f}% ({per_message}) Wakeups: {stats['wakeups_per_second']:5.1f}Hz Sleeping: {stats['sleep_percent']:4.1f}% In: {stats['rate_kbps']:.2f}KBps"
+        )
+        self.reset()
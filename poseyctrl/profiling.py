@@ -0,0 +1,143 @@
+import os
+import atexit
+import logging
+import itertools
+from contextlib import contextmanager
+
+
+# Set for child processes by ``start``, as ``<mode>:<prefix>``.
+ENV = "POSEY_PROFILE"
+
+MODES = ["cprofile", "sample"]
+
+_runs = itertools.count()
+
+# Profiler running in this process, or inherited from a fork.
+_main = None
+
+
+def add_argument(parser):
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="cprofile",
+        default=None,
+        choices=MODES,
+        help="Profile this run and its worker processes, with cProfile (default) or by sampling (requires pyinstrument).",
+    )
+
+
+class Profiler:
+    """
+    Profiles the calling thread from ``start`` to ``stop`` and writes the
+    result to ``<prefix>-<name>-<pid>...``, a pstats ``.prof`` file for
+    cProfile or an ``.html`` report when sampling.
+    """
+
+    def __init__(self, mode, prefix, name, log=None):
+        self.mode = mode
+        self.prefix = prefix
+        self.name = name
+        self.log = log if log is not None else logging.getLogger("profile")
+        self.profiler = None
+        self.pid = None
+        self.fn = None
+
+    def start(self):
+        self.pid = os.getpid()
+        if self.mode == "sample":
+            try:
+                from pyinstrument import Profiler as SamplingProfiler
+            except ImportError:
+                raise RuntimeError("Sampling profiles need pyinstrument installed")
+            self.profiler = SamplingProfiler(interval=0.001)
+            self.profiler.start()
+        else:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def discard(self):
+        """Stop without writing anything, e.g. in a forked child."""
+        if self.profiler is None:
+            return
+        if self.mode == "sample":
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+        self.profiler = None
+
+    def stop(self, top=15):
+        """:param return: The file written, None if not running."""
+        if (self.profiler is None) or (self.pid != os.getpid()):
+            return None
+        run = next(_runs)
+        stem = f"{self.prefix}-{self.name}-{os.getpid()}"
+        stem = f"{stem}-{run}" if run > 0 else stem
+        if self.mode == "sample":
+            self.profiler.stop()
+            self.fn = f"{stem}.html"
+            with open(self.fn, "w") as f:
+                f.write(self.profiler.output_html())
+        else:
+            self.profiler.disable()
+            self.fn = f"{stem}.prof"
+            self.profiler.dump_stats(self.fn)
+            if top > 0:
+                import io
+                import pstats
+
+                out = io.StringIO()
+                stats = pstats.Stats(self.profiler, stream=out)
+                stats.sort_stats("cumulative").print_stats(top)
+                self.log.info(f"Top {top} functions by cumulative time:")
+                for line in out.getvalue().strip().splitlines()[4:]:
+                    if line.strip():
+                        self.log.info(line)
+        self.profiler = None
+        self.log.info(f"Profile written to {self.fn}")
+        return self.fn
+
+
+def start(mode, prefix, name="main", log=None):
+    """
+    Profile this process until it exits, and have ``worker`` profile
+    processes started from it, if ``mode`` is set.
+
+    :param return: The Profiler, or None.
+    """
+    global _main
+    if mode is None:
+        return None
+    prefix = os.path.abspath(prefix)
+    os.environ[ENV] = f"{mode}:{prefix}"
+    profiler = Profiler(mode, prefix, name, log)
+    profiler.start()
+    atexit.register(profiler.stop)
+    _main = profiler
+    return profiler
+
+
+@contextmanager
+def worker(name, log=None):
+    """Profile the enclosed code if the process that started us is profiled."""
+    global _main
+    mode, _, prefix = os.environ.get(ENV, "").partition(":")
+    if _main is not None:
+        if _main.pid == os.getpid():
+            # Already covered by an enclosing profile.
+            yield None
+            return
+        _main.discard()
+    if not mode:
+        yield None
+        return
+    profiler = Profiler(mode, prefix, name, log)
+    profiler.start()
+    _main = profiler
+    try:
+        yield profiler
+    finally:
+        _main = None
+        profiler.stop(top=0)
@@ -0,0 +1,407 @@
+import time
+from array import array
+from collections import deque
+
+from poseyctrl.metrics import Trend
+
+
+# Device time (microseconds) of each signal. Gaps are only looked for in the
+# periodic ones, BLE sightings come whenever a beacon is seen.
+TIME_FIELDS = {
+    "imu": "time",
+    "ble": "time",
+    "taskwaist": "t_start",
+    "taskwatch": "t_start",
+}
+PERIODIC = {"imu", "taskwaist", "taskwatch"}
+
+# Task telemetry carries these device counters, which are assumed to count up
+# from boot.
+DEVICE_COUNTERS = ["missed_deadline", "invalid_checksum"]
+
+# Fields of the quality signal's rows. Vbatt_per_hour is blank until the
+# battery trend is known.
+FIELDS = dict(
+    sensor=str,
+    time=int,
+    gaps=int,
+    missing=int,
+    resets=int,
+    checksum_failures=int,
+    **{c: int for c in DEVICE_COUNTERS},
+    Vbatt=float,
+    Vbatt_per_hour=float,
+)
+
+# Device times are 32 bit microsecond counters, wrapping every 71.6 minutes.
+TIME_WRAP = 1 << 32
+
+# QualityTrace times of messages that failed their checksum, and of those
+# without a device time.
+FAILED = -1
+UNTIMED = -2
+
+
+class StreamQuality:
+    """Sample gaps, clock resets and checksum failure runs of one signal."""
+
+    __slots__ = [
+        "periodic",
+        "messages",
+        "last_time",
+        "period",
+        "gaps",
+        "missing",
+        "longest_gap",
+        "resets",
+        "failures",
+        "run",
+        "longest_run",
+    ]
+
+    def __init__(self, periodic):
+        self.periodic = periodic
+        self.messages = 0
+        self.last_time = None
+        self.period = None
+        self.gaps = 0
+        self.missing = 0
+        self.longest_gap = 0
+        self.resets = 0
+        self.failures = 0
+        self.run = 0
+        self.longest_run = 0
+
+
+class QualityMonitor:
+    """
+    Tracks the quality of a sensor's data as it's decoded, with constant
+    state per signal and constant work per message: sample gaps and clock
+    resets from the device times, runs of frames failing their checksum,
+    missed deadlines and invalid checksums reported by the task telemetry,
+    and the battery trend.
+
+    With ``warn`` set, problems are logged as they're seen, at most once per
+    ``warn_interval`` seconds for each kind.
+    """
+
+    def __init__(
+        self,
+        log,
+        warn=False,
+        warn_interval=10,
+        gap_factor=1.5,
+        run_warning=3,
+        deadline_burst=5,
+        low_volts=3.5,
+        drop_volts=0.2,
+        collapse_volts_per_hour=-0.5,
+    ):
+        self.log = log
+        self.warn = warn
+        self.warn_interval = warn_interval
+        self.gap_factor = gap_factor
+        self.run_warning = run_warning
+        self.deadline_burst = deadline_burst
+        self.low_volts = low_volts
+        self.drop_volts = drop_volts
+        self.collapse_volts_per_hour = collapse_volts_per_hour
+
+        self.streams = {}
+        self.device = {c: 0 for c in DEVICE_COUNTERS}
+        self.device_last = {}
+        # Battery voltage over device time.
+        self.battery = Trend(min_span=60)
+        self.battery_slope = None
+
+        # Totals at the last quality row, which reports the change since.
+        self.reported = self.totals()
+
+        # Last time each kind of warning was logged, and how many were held
+        # back since.
+        self.warned = {}
+        self.held = {}
+
+    def stream(self, sig):
+        st = self.streams.get(sig)
+        if st is None:
+            st = self.streams[sig] = StreamQuality(sig in PERIODIC)
+        return st
+
+    def observe(self, sig, data, time=None):
+        """
+        Account for a decoded message.
+
+        :param data: The message's data dict, None if it failed its checksum.
+        :param time: Host time the message was decoded at, only used by
+            ``QualityTrace``.
+        :param return: A quality data dict to emit, on task telemetry.
+        """
+        st = self.stream(sig)
+        st.messages += 1
+        if data is None:
+            st.failures += 1
+            st.run += 1
+            if st.run > st.longest_run:
+                st.longest_run = st.run
+            if st.run == self.run_warning:
+                self.warning(
+                    (sig, "checksum"),
+                    f"{sig}: {st.run} frames in a row failed their checksum.",
+                )
+            return None
+        st.run = 0
+
+        field = TIME_FIELDS.get(sig)
+        if field is not None:
+            self.observe_time(sig, st, int(data[field]))
+        if "missed_deadline" in data:
+            self.observe_task(sig, data)
+            return self.row(data)
+        return None
+
+    def observe_time(self, sig, st, t):
+        last = st.last_time
+        st.last_time = t
+        if last is None:
+            return
+        delta = t - last
+        if delta < 0:
+            if (delta + TIME_WRAP) < max(10 * (st.period or 0), 1e6):
+                delta += TIME_WRAP
+            else:
+                st.resets += 1
+                st.period = None
+                self.warning(
+                    (sig, "reset"),
+                    f"{sig}: device time went back {-delta * 1e-6:.3f} s, MCU reset?",
+                )
+                return
+        if (delta == 0) or not st.periodic:
+            return
+        period = st.period
+        if period is None:
+            st.period = delta
+            return
+        if delta < self.gap_factor * period:
+            st.period = period + 0.05 * (delta - period)
+            return
+        missing = round(delta / period) - 1
+        st.gaps += 1
+        st.missing += missing
+        if delta > st.longest_gap:
+            st.longest_gap = delta
+        self.warning(
+            (sig, "gap"),
+            f"{sig}: {delta * 1e-6:.3f} s gap, about {missing} samples missing.",
+        )
+
+    def observe_task(self, sig, data):
+        for counter in DEVICE_COUNTERS:
+            value = int(data[counter])
+            last = self.device_last.get(counter)
+            self.device_last[counter] = value
+            # Counted from boot, so a drop means the device restarted.
+            if last is None:
+                increase = 0
+            else:
+                increase = value - last if value >= last else value
+            self.device[counter] += increase
+            if (counter == "missed_deadline") and (increase >= self.deadline_burst):
+                self.warning(
+                    (sig, counter), f"{sig}: {increase} deadlines missed in a second."
+                )
+
+        volts = float(data["Vbatt"])
+        t = int(data["t_start"]) * 1e-6
+        samples = self.battery.samples
+        previous = samples[-1][1] if samples else None
+        if samples and (t < samples[-1][0]):
+            # Device clock reset, start over.
+            self.battery = Trend(min_span=60)
+        self.battery.add(t, volts)
+        self.battery_slope = slope = self.battery.slope()
+        if (previous is not None) and (previous - volts >= self.drop_volts):
+            self.warning(
+                "battery-drop",
+                f"Battery dropped {previous - volts:.2f} V to {volts:.2f} V.",
+            )
+        if volts < self.low_volts:
+            self.warning("battery-low", f"Battery low, {volts:.2f} V.")
+        if (slope is not None) and (3600 * slope < self.collapse_volts_per_hour):
+            self.warning(
+                "battery-trend",
+                f"Battery falling at {3600 * slope:.2f} V/h, now {volts:.2f} V.",
+            )
+
+    def totals(self):
+        totals = dict(gaps=0, missing=0, resets=0, checksum_failures=0, **self.device)
+        for st in self.streams.values():
+            totals["gaps"] += st.gaps
+            totals["missing"] += st.missing
+            totals["resets"] += st.resets
+            totals["checksum_failures"] += st.failures
+        return totals
+
+    def row(self, data):
+        """The quality signal: what went wrong since the last row."""
+        totals = self.totals()
+        row = {"sensor": data["sensor"], "time": data["t_start"]}
+        for key, value in totals.items():
+            row[key] = value - self.reported[key]
+        self.reported = totals
+        slope = self.battery_slope
+        row["Vbatt"] = data["Vbatt"]
+        row["Vbatt_per_hour"] = 3600 * slope if slope is not None else ""
+        return row
+
+    def warning(self, kind, message):
+        if not self.warn:
+            return
+        now = time.monotonic()
+        if now - self.warned.get(kind, -self.warn_interval) < self.warn_interval:
+            self.held[kind] = self.held.get(kind, 0) + 1
+            return
+        held = self.held.pop(kind, 0)
+        if held > 0:
+            message = f"{message} ({held} more since the last warning)"
+        self.warned[kind] = now
+        self.log.warning(message)
+
+    def snapshot(self):
+        """Counters for ``PoseyHIL.metrics``."""
+        return dict(
+            sample_gaps={sig: st.gaps for sig, st in self.streams.items()},
+            missing_samples={sig: st.missing for sig, st in self.streams.items()},
+            clock_resets={sig: st.resets for sig, st in self.streams.items()},
+            longest_checksum_run={
+                sig: st.longest_run for sig, st in self.streams.items()
+            },
+            missed_deadlines=self.device["missed_deadline"],
+            device_invalid_checksums=self.device["invalid_checksum"],
+            battery_volts_per_hour=(
+                3600 * self.battery_slope if self.battery_slope is not None else None
+            ),
+        )
+
+    def report(self):
+        """:param return: List of lines summarizing the session."""
+        lines = []
+        for sig, st in sorted(self.streams.items()):
+            line = f"{sig:<10} {st.messages:>9} msgs"
+            if st.periodic:
+                line += f", {st.gaps} gaps ({st.missing} samples missing"
+                line += f", longest {st.longest_gap * 1e-6:.3f} s)"
+            line += f", {st.resets} clock resets, {st.failures} checksum failures"
+            line += f" (longest run {st.longest_run})"
+            lines.append(line)
+        if len(self.device_last) > 0:
+            lines.append(
+                f"Device: {self.device['missed_deadline']} missed deadlines, "
+                f"{self.device['invalid_checksum']} invalid checksums"
+            )
+        if self.battery.samples:
+            slope = self.battery_slope
+            trend = f", {3600 * slope:+.3f} V/h" if slope is not None else ""
+            lines.append(f"Battery: {self.battery.samples[-1][1]:.2f} V{trend}")
+        return lines
+
+    def state(self):
+        """JSON serializable state, for ``restore`` to carry on from."""
+        return dict(
+            streams={
+                sig: {k: getattr(st, k) for k in StreamQuality.__slots__}
+                for sig, st in self.streams.items()
+            },
+            device=dict(self.device),
+            device_last=dict(self.device_last),
+            battery=dict(
+                samples=list(self.battery.samples),
+                t0=self.battery.t0,
+                sums=list(self.battery.sums),
+            ),
+            battery_slope=self.battery_slope,
+            reported=dict(self.reported),
+        )
+
+    def restore(self, state):
+        self.streams = {}
+        for sig, values in state["streams"].items():
+            st = self.streams[sig] = StreamQuality(values["periodic"])
+            for k, v in values.items():
+                setattr(st, k, v)
+        self.device = dict(state["device"])
+        self.device_last = dict(state["device_last"])
+        self.battery = Trend(min_span=60)
+        self.battery.samples = deque(tuple(s) for s in state["battery"]["samples"])
+        self.battery.t0 = state["battery"]["t0"]
+        self.battery.sums = list(state["battery"]["sums"])
+        self.battery_slope = state["battery_slope"]
+        self.reported = dict(state["reported"])
+
+    def log_report(self, log, title="Data quality:"):
+        if len(self.streams) == 0:
+            return
+        log.info(title)
+        for line in self.report():
+            log.info(line)
+
+
+class QualityTrace:
+    """
+    Stands in for a QualityMonitor where messages are decoded out of stream
+    order, as by the parallel decode's workers. Quality depends on everything
+    before it, so each chunk's trace records what a monitor needs from every
+    message, compactly, and the traces are then replayed through one
+    monitor in order.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.codes = {}
+        self.signals = array("B")
+        self.times = array("q")
+        # Position, host time and data of each task telemetry message.
+        self.tasks = []
+
+    def observe(self, sig, data, time=None):
+        code = self.codes.get(sig)
+        if code is None:
+            code = self.codes[sig] = len(self.names)
+            self.names.append(sig)
+        if data is None:
+            t = FAILED
+        elif "missed_deadline" in data:
+            self.tasks.append((len(self.signals), time, data))
+            t = UNTIMED
+        else:
+            field = TIME_FIELDS.get(sig)
+            t = int(data[field]) if field is not None else UNTIMED
+        self.signals.append(code)
+        self.times.append(t)
+        return None
+
+    def replay(self, monitor, put):
+        """
+        Feed the trace through ``monitor``.
+
+        :param put: Called with a ``("quality", time, row)`` message for each
+            quality row, as PoseyHIL would queue it.
+        """
+        tasks = iter(self.tasks)
+        task = next(tasks, None)
+        fields = [TIME_FIELDS.get(sig) for sig in self.names]
+        for i, (code, t) in enumerate(zip(self.signals, self.times)):
+            sig = self.names[code]
+            if (task is not None) and (task[0] == i):
+                _, time, data = task
+                task = next(tasks, None)
+                row = monitor.observe(sig, data)
+                if row is not None:
+                    put(("quality", time, row))
+            elif t == FAILED:
+                monitor.observe(sig, None)
+            elif t == UNTIMED:
+                monitor.observe(sig, {})
+            else:
+                monitor.observe(sig, {fields[code]: t})
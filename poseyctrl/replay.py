@@ -0,0 +1,181 @@
+import os
+import mmap
+import time
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+
+from poseyctrl.sim import BufferedUART
+
+
+# Layout of the ``.in.idx`` records written by ``PoseyHIL.record_raw``.
+RAW_INDEX = np.dtype([("time", "<f8"), ("bytes", "<u4")])
+
+# Used to pace captures recorded without an index, bytes/s.
+DEFAULT_RATE = 4096
+
+# Chunk size when there's no index, about one BLE notification.
+DEFAULT_CHUNK = 244
+
+
+def index_filename(fn):
+    return fn[: -len(".bin")] + ".idx" if fn.endswith(".bin") else f"{fn}.idx"
+
+
+def load_index(fn, size=None, log=None):
+    """
+    Load the chunk index recorded alongside the raw capture ``fn``.
+
+    :param return: RAW_INDEX array, or None if there isn't a usable index.
+    """
+    log = log if log is not None else logging.getLogger("replay")
+    idx_fn = index_filename(fn)
+    if not os.path.exists(idx_fn):
+        return None
+    index = np.fromfile(idx_fn, dtype=RAW_INDEX)
+    size = os.path.getsize(fn) if size is None else size
+    total = int(index["bytes"].sum())
+    if total > size:
+        log.warning(f"Index {idx_fn} covers {total} B but {fn} is {size} B, ignoring")
+        return None
+    if total < size:
+        # The capture outlived the last index write, pace the rest the same.
+        log.warning(f"Index {idx_fn} only covers {total} of {size} B")
+    return index
+
+
+def schedule(fn, rate=DEFAULT_RATE, chunk_bytes=DEFAULT_CHUNK, log=None):
+    """
+    When each chunk of a capture arrived, from its index if there is one,
+    otherwise evenly spaced at ``rate``.
+
+    :param return: Tuple of (seconds since start, chunk end offsets).
+    """
+    size = os.path.getsize(fn)
+    index = load_index(fn, size, log)
+    if index is None:
+        ends = np.append(np.arange(chunk_bytes, size, chunk_bytes), size)
+        return ends / float(rate), ends
+    times = index["time"].astype(float)
+    ends = np.cumsum(index["bytes"].astype(np.int64))
+    covered = ends[-1] if len(ends) > 0 else 0
+    if covered < size:
+        t = times[-1] if len(times) > 0 else 0
+        rest = np.append(np.arange(covered + chunk_bytes, size, chunk_bytes), size)
+        times = np.append(times, t + (rest - covered) / float(rate))
+        ends = np.append(ends, rest)
+    return times, ends
+
+
+class ReplayUART(BufferedUART):
+    """
+    Stand-in for the patched ``UARTService`` that plays back a raw capture.
+
+    Chunks are released into the receive buffer at their original times
+    scaled by ``1 / speed``, so a reader that can't keep up overruns the
+    buffer just as it would have live. With ``speed`` 0 the replay is
+    unthrottled: the buffer is refilled whenever the reader finds it empty.
+    """
+
+    def __init__(self, fn, speed=1.0, rate=DEFAULT_RATE, chunk_bytes=DEFAULT_CHUNK):
+        super().__init__(DEFAULT_CHUNK)
+        self.fn = fn
+        self.speed = speed
+        self.times, self.ends = schedule(fn, rate, chunk_bytes)
+        self.file = open(fn, "rb")
+        if self.ends[-1] > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mmap = b""
+        self.next = 0
+        self.position = 0
+        self.t0 = None
+        self.drained = False
+
+    @property
+    def finished(self):
+        return (self.next >= len(self.ends)) and (len(self.rx) == 0)
+
+    @property
+    def progress(self):
+        return self.position / self.ends[-1] if self.ends[-1] > 0 else 1.0
+
+    def release(self):
+        end = self.ends[self.next]
+        self.deliver(self.mmap[self.position : end])
+        self.position = end
+        self.next += 1
+
+    def pump(self):
+        if self.t0 is None:
+            self.t0 = time.perf_counter()
+        if self.speed <= 0:
+            # Report empty once so readers notice they've caught up, then
+            # fill with as much as fits.
+            if len(self.rx) > 0:
+                return
+            if not self.drained:
+                self.drained = True
+                return
+            self.drained = False
+            while self.next < len(self.ends):
+                size = self.ends[self.next] - self.position
+                if (len(self.rx) > 0) and (len(self.rx) + size > self.rx_buffer_size):
+                    break
+                self.release()
+            return
+
+        elapsed = (time.perf_counter() - self.t0) * self.speed
+        while (self.next < len(self.ends)) and (self.times[self.next] <= elapsed):
+            self.release()
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+
+class ReplayConnection:
+    def __init__(self, uart):
+        self.uart = uart
+        self._bleio_connection = SimpleNamespace(max_packet_length=DEFAULT_CHUNK)
+
+    @property
+    def connected(self):
+        return not self.uart.finished
+
+    def disconnect(self):
+        pass
+
+    def __getitem__(self, service):
+        return self.uart
+
+
+class ReplayRadio:
+    """
+    Drop-in for ``adafruit_ble.BLERadio`` whose only device plays back the
+    raw capture ``fn`` through a ``ReplayUART``. The connection drops once
+    the whole capture has been read.
+    """
+
+    def __init__(self, fn, name="Posey Replay", **kwargs):
+        self.uart = ReplayUART(fn, **kwargs)
+        self.advertisement = SimpleNamespace(
+            complete_name=name,
+            rssi=0,
+            address=SimpleNamespace(string="5e:5e:ff:ff:ff:ff"),
+        )
+
+    @property
+    def finished(self):
+        return self.uart.finished
+
+    def start_scan(self, *advertisement_types, timeout=10, **kwargs):
+        yield self.advertisement
+
+    def stop_scan(self):
+        pass
+
+    def connect(self, advertisement, timeout=10):
+        return ReplayConnection(self.uart)
@@ -4,7 +4,7 @@
 # ATW: The Adafruit library has egregiously small buffers that, because of how
 # the class is instantiated, can't be enlarged after the fact, so we need this
 # patch.
-from poseyctrl.patch.nordic import UARTService
+from poseyctrl.patch.nordic import UARTService, packet_size
 from poseyctrl import hil
 
 
@@ -32,6 +32,7 @@ class PoseySensor:
         self.connection = self.ble.connect(self.advertisement, timeout=timeout)
         if self.connection.connected:
             self.service = self.connection[UARTService]
+            self.service.packet_size = packet_size(self.connection)
             self.hil.uart_conn = self.connection
             self.hil.uart_service = self.service
             return True
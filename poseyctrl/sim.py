@@ -0,0 +1,450 @@
+import heapq
+import time
+import itertools
+import datetime as dt
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+
+import pyposey as pyp
+from pyposey import MessageAck
+from pyposey.control import CommandType
+
+from poseyctrl import synth
+from poseyctrl.patch.nordic import UARTService
+
+
+# Defaults for the link model; throughput in bytes/s, latency in seconds.
+LINK = dict(throughput=12000.0, latency=0.02, drop=0.0, packet_size=244)
+
+# Defaults for the hub model. Rates are in Hz, erase_time stands in for the
+# ~2m30s a real flash erase takes.
+HUB = dict(
+    task_rate=1.0,
+    imu_rate=0.0,
+    ble_rate=0.0,
+    flash_seconds=60.0,
+    slots=4,
+    erase_time=2.0,
+    response_delay=0.005,
+)
+
+# Simulated devices, named like the real ones so name matching still applies.
+DEVICES = dict(hubs=1, peripherals=0, seed=0)
+
+
+def add_argument(parser):
+    parser.add_argument(
+        "--sim",
+        type=parse_spec,
+        nargs="?",
+        const={},
+        default=None,
+        metavar="SPEC",
+        help="Talk to simulated devices instead of BLE, optionally configured with comma-separated key=value pairs (e.g. hubs=4,throughput=20000,drop=0.01).",
+    )
+
+
+def parse_spec(spec):
+    """
+    Parse a ``--sim`` spec, comma-separated ``key=value`` pairs overriding
+    ``DEVICES``, ``LINK`` and ``HUB``, e.g. ``throughput=20000,drop=0.01``.
+
+    :param return: Dict of ``SimRadio`` keyword arguments.
+    """
+    defaults = dict(DEVICES, **LINK, **HUB)
+    kwargs = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if (key not in defaults) or not value:
+            raise ValueError(f"Invalid simulator option {item}")
+        kwargs[key] = type(defaults[key])(value)
+    return kwargs
+
+
+class SimHub:
+    """
+    Model of a Posey device's side of the UART.
+
+    Commands are acknowledged as the firmware does, with DataSummary and
+    download responses built from a synthetic flash dump, and telemetry
+    (plus IMU and BLE data for a peripheral) is generated at the configured
+    rates. Output is queued with the time it's ready and pulled by the link
+    as simulated time passes, so nothing runs in the background.
+    """
+
+    def __init__(self, name, task="waist", seed=0, **kwargs):
+        config = dict(HUB, **kwargs)
+        self.name = name
+        self.task = task
+        self.seed = seed
+        self.response_delay = config["response_delay"]
+        self.erase_time = config["erase_time"]
+        self.slots = config["slots"]
+        self.rates = dict(
+            task=config["task_rate"],
+            imu=config["imu_rate"],
+            ble=config["ble_rate"],
+        )
+        # Battery drains over a working day.
+        self.generator = synth.StreamGenerator(8 * 3600, task=task, seed=seed)
+
+        self.ml = pyp.platform.io.MessageListener()
+        self.command = pyp.control.CommandMessage()
+        self.ml.add_listener(self.command)
+        self.response = pyp.control.CommandMessage()
+        self.datasummary = pyp.control.DataSummaryMessage()
+
+        self.t0 = time.perf_counter()
+        self.connection = None
+        self.recording = False
+        self.record_start = self.t0
+        self.record_datetime = dt.datetime.now().astimezone()
+        self.fill_flash(config["flash_seconds"])
+
+        self.inbox = []
+        self.events = []
+        self.order = itertools.count()
+        self.outgoing = deque()
+        self.download_left = 0
+        self.next_frame = {}
+        self.commands = 0
+
+    def fill_flash(self, seconds):
+        self.flash_seconds = seconds
+        if seconds <= 0:
+            self.flash = b""
+            return
+        streams = {}
+        for slot in range(self.slots):
+            data, _ = synth.StreamGenerator(
+                seconds, task="watch", seed=self.seed + slot + 1
+            ).generate()
+            streams[slot] = (bytes([0xC0, 0xFF, 0xEE, 0x00, 0x00, slot]), data)
+        self.flash = synth.flash_dump(
+            streams, start_ms=0, duration=seconds, seed=self.seed
+        )
+
+    def connect(self, connection, now):
+        self.connection = connection
+        self.inbox = []
+        self.events = []
+        self.outgoing.clear()
+        self.download_left = 0
+        self.ml = pyp.platform.io.MessageListener()
+        self.ml.add_listener(self.command)
+        self.next_frame = {kind: now for kind, rate in self.rates.items() if rate > 0}
+
+    def receive(self, t, data):
+        heapq.heappush(self.inbox, (t, next(self.order), data))
+
+    def schedule(self, t, data):
+        heapq.heappush(self.events, (t, next(self.order), data))
+
+    def ack(self, t, command, ack, payload):
+        self.response.message.command = command
+        self.response.message.ack = ack
+        self.response.message.payload = payload
+        self.response.serialize()
+        self.schedule(t, self.response.buffer.buffer.tobytes())
+
+    def summary(self, t):
+        m = self.datasummary.message
+        m.datetime = np.frombuffer(
+            self.record_datetime.strftime("%Y-%m-%d %H:%M:%S %z")
+            .encode("UTF-8")
+            .ljust(32, b"\0")[:32],
+            dtype="u1",
+        )
+        m.start_ms = 0
+        m.end_ms = int(1e3 * self.flash_seconds)
+        m.bytes = len(self.flash)
+        self.datasummary.serialize()
+        self.schedule(t, self.datasummary.buffer.buffer.tobytes())
+
+    def handle(self, t):
+        """Act on a command received at ``t``."""
+        self.commands += 1
+        self.command.deserialize()
+        command = int(self.command.message.command)
+        payload = np.array(self.command.message.payload, dtype="u1")
+        t = t + self.response_delay
+        if command == CommandType.NoOp:
+            self.ack(t, command, MessageAck.OK, payload)
+        elif command == CommandType.Reboot:
+            self.ack(t, command, MessageAck.OK, payload)
+            self.schedule(t + 0.1, "disconnect")
+        elif command == CommandType.StartCollecting:
+            self.ack(t, command, MessageAck.Working, payload)
+            self.ack(t + self.erase_time, command, MessageAck.OK, payload)
+            self.fill_flash(0)
+            self.recording = True
+            self.record_start = t + self.erase_time
+            self.record_datetime = dt.datetime.now().astimezone()
+        elif command == CommandType.StopCollecting:
+            self.ack(t, command, MessageAck.OK, payload)
+            if self.recording:
+                self.recording = False
+                self.fill_flash(max(t - self.record_start, 1))
+        elif command == CommandType.GetDataSummary:
+            self.ack(t, command, MessageAck.OK, payload)
+            self.summary(t)
+        elif command == CommandType.DownloadData:
+            self.ack(t, command, MessageAck.Working, payload)
+            self.schedule(t, "download")
+        elif command == CommandType.FullFlashErase:
+            self.ack(t, command, MessageAck.Working, payload)
+            self.ack(t + self.erase_time, command, MessageAck.OK, payload)
+            self.fill_flash(0)
+        else:
+            self.ack(t, command, MessageAck.Failed, payload)
+
+    def advance(self, now):
+        """Queue everything the device would have sent by ``now``."""
+        while self.inbox and self.inbox[0][0] <= now:
+            t, _, data = heapq.heappop(self.inbox)
+            view = memoryview(data)
+            while len(view) > 0:
+                n = min(len(view), self.ml.free)
+                self.ml.write(view[:n])
+                view = view[n:]
+                while self.ml.process_next() >= 0:
+                    self.handle(t)
+
+        due = []
+        while self.events and self.events[0][0] <= now:
+            t, _, data = heapq.heappop(self.events)
+            due.append((t, data))
+
+        # Telemetry pauses while the flash is streaming out, the frames it
+        # would have sent meanwhile are skipped rather than sent after.
+        for kind, t in self.next_frame.items():
+            while t <= now:
+                if self.download_left == 0:
+                    us = int(1e6 * (t - self.t0))
+                    due.append((t, self.generator.frame(us, kind)))
+                t += 1.0 / self.rates[kind]
+            self.next_frame[kind] = t
+
+        for t, data in sorted(due, key=lambda item: item[0]):
+            if data == "disconnect":
+                self.connection = None
+            elif data == "download":
+                self.outgoing.append((t, memoryview(self.flash), True))
+                self.download_left += len(self.flash)
+            else:
+                self.outgoing.append((t, memoryview(data), False))
+
+    def take(self, n):
+        """
+        Take up to ``n`` bytes of the next output.
+
+        :param return: Tuple of (ready time, bytes), or None if there's nothing.
+        """
+        if not self.outgoing:
+            return None
+        t, view, download = self.outgoing[0]
+        data = view[:n]
+        if len(view) > n:
+            self.outgoing[0] = (t, view[n:], download)
+        else:
+            self.outgoing.popleft()
+        if download:
+            self.download_left -= len(data)
+        return t, bytes(data)
+
+
+class BufferedUART:
+    """
+    Receive side shared by the stand-ins for the patched ``UARTService``.
+
+    Subclasses ``pump`` data in with ``deliver``, which, like the real
+    receive buffer, drops packets that don't fit. It counts how often the
+    buffer fills up, exactly, and how many packets were dropped. The buffer
+    is pumped whenever it's looked at.
+    """
+
+    def __init__(self, packet_size):
+        self.timeout = 1.0
+        self.rx = bytearray()
+        self.dropped = 0
+
+        self.rx_buffer_size = UARTService.buffer_sizes()["rx"]
+        self.packet_size = packet_size
+        self.write_interval = 0
+        self.tx_packets = 0
+        self.high_water = 0
+        self.rx_buffer_full = 0
+        self._full = False
+
+    def pump(self):
+        pass
+
+    def deliver(self, packet):
+        full = len(self.rx) + len(packet) > self.rx_buffer_size
+        if full and not self._full:
+            self.rx_buffer_full += 1
+        self._full = full
+        if full:
+            self.dropped += 1
+        else:
+            self.rx += packet
+        self.high_water = max(self.high_water, len(self.rx))
+        return not full
+
+    @property
+    def in_waiting(self):
+        self.pump()
+        return len(self.rx)
+
+    def read(self, nbytes=None):
+        self.pump()
+        nbytes = len(self.rx) if nbytes is None else min(nbytes, len(self.rx))
+        data = bytes(self.rx[:nbytes])
+        del self.rx[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        # Like the real stream, wait for data up to the timeout.
+        t0 = time.perf_counter()
+        while (self.in_waiting == 0) and (time.perf_counter() - t0 < self.timeout):
+            time.sleep(0.001)
+        nbytes = len(buf) if nbytes is None else min(nbytes, len(buf))
+        n = min(nbytes, len(self.rx))
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def reset_input_buffer(self):
+        self.pump()
+        self.rx.clear()
+
+    def write(self, buf):
+        self.tx_packets += -(-len(buf) // self.packet_size)
+
+    def stats(self):
+        return dict(
+            rx_buffer=self.rx_buffer_size,
+            high_water=self.high_water,
+            rx_buffer_full=self.rx_buffer_full,
+            packet_size=self.packet_size,
+            tx_packets=self.tx_packets,
+            dropped=self.dropped,
+        )
+
+
+class SimUART(BufferedUART):
+    """
+    Stand-in for the patched ``UARTService`` of a simulated connection.
+
+    Data from the hub crosses a link with limited ``throughput``, one-way
+    ``latency`` and a ``drop`` probability per packet, in both directions,
+    before landing in the receive buffer.
+    """
+
+    def __init__(self, hub, throughput, latency, drop, packet_size, seed=0):
+        super().__init__(packet_size)
+        self.hub = hub
+        self.throughput = throughput if throughput > 0 else float("inf")
+        self.latency = latency
+        self.drop = drop
+        self.rng = np.random.default_rng(seed)
+        self.in_flight = deque()
+        self.link_time = 0
+
+    def pump(self):
+        now = time.perf_counter()
+        self.hub.advance(now)
+        while self.hub.outgoing:
+            start = max(self.link_time, self.hub.outgoing[0][0])
+            if start > now:
+                break
+            _, packet = self.hub.take(self.packet_size)
+            self.link_time = start + len(packet) / self.throughput
+            if self.rng.random() < self.drop:
+                self.dropped += 1
+                continue
+            self.in_flight.append((self.link_time + self.latency, packet))
+
+        while self.in_flight and (self.in_flight[0][0] <= now):
+            _, packet = self.in_flight.popleft()
+            self.deliver(packet)
+
+    def write(self, buf):
+        now = time.perf_counter()
+        for i in range(0, len(buf), self.packet_size):
+            self.tx_packets += 1
+            if self.rng.random() < self.drop:
+                self.dropped += 1
+                continue
+            self.hub.receive(now + self.latency, bytes(buf[i : i + self.packet_size]))
+
+
+class SimConnection:
+    def __init__(self, hub, link, seed=0):
+        self.hub = hub
+        self.uart = SimUART(hub, seed=seed, **link)
+        # Lets patch.nordic.packet_size read the packet size as it would from
+        # a real connection.
+        self._bleio_connection = SimpleNamespace(max_packet_length=link["packet_size"])
+        hub.connect(self, time.perf_counter())
+
+    @property
+    def connected(self):
+        return self.hub.connection is self
+
+    def disconnect(self):
+        if self.connected:
+            self.hub.connection = None
+
+    def __getitem__(self, service):
+        return self.uart
+
+
+class SimRadio:
+    """
+    Drop-in for ``adafruit_ble.BLERadio`` backed by simulated devices.
+
+    ``hubs`` waist hubs named ``Posey Sim Hub <n>`` and ``peripherals``
+    watches named ``Posey Sim Watch <n>`` (which also stream IMU data) are
+    advertised. Each keeps its state, such as what's in flash, across
+    connections. Keyword arguments override ``LINK`` and ``HUB``.
+    """
+
+    def __init__(self, hubs=1, peripherals=0, seed=0, **kwargs):
+        self.link = {k: kwargs.pop(k, v) for k, v in LINK.items()}
+        hub = dict(HUB, **kwargs)
+        self.seed = seed
+        self.devices = {}
+        for i in range(hubs):
+            self.add(f"Posey Sim Hub {i}", "waist", **hub)
+        for i in range(peripherals):
+            watch = dict(hub)
+            watch["imu_rate"] = watch["imu_rate"] or 100.0
+            self.add(f"Posey Sim Watch {i}", "watch", **watch)
+
+    def add(self, name, task, **kwargs):
+        i = len(self.devices)
+        adv = SimpleNamespace(
+            complete_name=name,
+            rssi=-50 - 5 * i,
+            address=SimpleNamespace(string=f"5e:5e:00:00:00:{i:02x}"),
+        )
+        hub = SimHub(name, task, seed=self.seed + 100 * i, **kwargs)
+        self.devices[name] = (adv, hub)
+
+    def start_scan(self, *advertisement_types, timeout=10, minimum_rssi=-80, **kwargs):
+        for adv, _ in self.devices.values():
+            if adv.rssi >= minimum_rssi:
+                yield adv
+
+    def stop_scan(self):
+        pass
+
+    def connect(self, advertisement, timeout=10):
+        _, hub = self.devices[advertisement.complete_name]
+        return SimConnection(hub, self.link, seed=self.seed)
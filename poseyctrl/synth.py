@@ -0,0 +1,231 @@
+import heapq
+import datetime as dt
+
+import numpy as np
+
+import pyposey as pyp
+
+from poseyctrl import download
+from poseyctrl.flash import FBM_BYTES
+
+
+def Vbatt_V_to_counts(V):
+    # Inverse of PoseyHIL.Vbatt_counts_to_V.
+    return int(np.clip(round((V - 3.2) / 4.2 * 255.0), 0, 255))
+
+
+class StreamGenerator:
+    """
+    Generates the byte stream a Posey device would send, from the real
+    pyposey message classes.
+
+    Each message type is emitted periodically at its own rate (Hz, 0 to
+    disable) with a little timing jitter, interleaved in time order, over
+    ``duration`` seconds. IMU data follows a slow rotation plus noise and the
+    battery drains linearly, so the output decodes to plausible values.
+    Times are in microseconds from ``start_us``.
+    """
+
+    def __init__(
+        self,
+        duration=60,
+        imu_rate=50,
+        ble_rate=2,
+        task_rate=1,
+        task="waist",
+        start_us=0,
+        seed=0,
+    ):
+        self.duration = duration
+        self.rates = dict(imu=imu_rate, ble=ble_rate, task=task_rate)
+        self.task = task
+        self.start_us = start_us
+        self.rng = np.random.default_rng(seed)
+
+        self.imu = pyp.platform.sensors.IMUMessage()
+        self.ble = pyp.platform.sensors.BLEMessage()
+        if task == "waist":
+            self.taskmsg = pyp.tasks.TaskWaistTelemetryMessage()
+        else:
+            self.taskmsg = pyp.tasks.TaskWatchTelemetryMessage()
+
+    def schedule(self):
+        """
+        :param return: Generator of (time_us, kind) in time order.
+        """
+        end_us = self.start_us + int(self.duration * 1e6)
+        heap = [
+            (self.start_us + int(self.rng.uniform(0, 1e6 / rate)), kind)
+            for kind, rate in self.rates.items()
+            if rate > 0
+        ]
+        heapq.heapify(heap)
+        while heap:
+            t, kind = heapq.heappop(heap)
+            if t >= end_us:
+                continue
+            yield t, kind
+            period = 1e6 / self.rates[kind]
+            jitter = self.rng.normal(0, 0.01 * period)
+            heapq.heappush(heap, (t + max(int(period + jitter), 1), kind))
+
+    def frame(self, t, kind):
+        s = (t - self.start_us) * 1e-6
+        if kind == "imu":
+            m = self.imu.message
+            m.time = t
+            m.Ax, m.Ay, m.Az = self.rng.normal(0, 0.05, 3) + [0, 0, 9.81]
+            angle = 0.1 * s
+            m.Qi, m.Qj, m.Qk, m.Qr = 0.0, 0.0, np.sin(angle / 2), np.cos(angle / 2)
+            msg = self.imu
+        elif kind == "ble":
+            m = self.ble.message
+            m.time = t
+            m.uuid = self.rng.integers(0, 256, 16, dtype="u1")
+            m.major = int(self.rng.integers(0, 4))
+            m.minor = int(self.rng.integers(0, 16))
+            m.power = -59
+            m.rssi = int(self.rng.integers(-95, -40))
+            msg = self.ble
+        else:
+            m = self.taskmsg.message
+            m.t_start = t
+            m.t_end = t + int(self.rng.integers(200, 2000))
+            m.invalid_checksum = 0
+            m.missed_deadline = 0
+            m.Vbatt = Vbatt_V_to_counts(4.1 - 0.5 * s / max(self.duration, 1))
+            if self.task == "waist":
+                m.ble_throughput = int(self.rng.integers(0, 10))
+            msg = self.taskmsg
+        msg.serialize()
+        return msg.buffer.buffer.tobytes()
+
+    def frames(self):
+        """:param return: Generator of (time_us, kind, frame bytes)."""
+        for t, kind in self.schedule():
+            yield t, kind, self.frame(t, kind)
+
+    def generate(self, corrupt=0.0):
+        """
+        :param corrupt: Fraction of frames to damage, see ``Corruptor``.
+        :param return: Tuple of (stream bytes, Corruptor or None).
+        """
+        corruptor = Corruptor(corrupt, self.rng) if corrupt > 0 else None
+        out = bytearray()
+        for _, _, frame in self.frames():
+            out += corruptor(frame) if corruptor is not None else frame
+        return bytes(out), corruptor
+
+
+class Corruptor:
+    """
+    Damages a fraction ``rate`` of frames the way a bad link does: flipped
+    bits (checksum failures), truncation, dropped frames and inserted
+    garbage, which may contain sync words. ``counts`` tallies each kind.
+    """
+
+    KINDS = ["flip", "truncate", "drop", "garbage"]
+
+    def __init__(self, rate, rng=None):
+        self.rate = rate
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.counts = {kind: 0 for kind in self.KINDS}
+
+    def __call__(self, frame):
+        if self.rng.random() >= self.rate:
+            return frame
+        kind = self.KINDS[self.rng.integers(len(self.KINDS))]
+        self.counts[kind] += 1
+        if kind == "flip":
+            frame = bytearray(frame)
+            i = int(self.rng.integers(3, len(frame)))
+            frame[i] ^= 1 << int(self.rng.integers(8))
+            return bytes(frame)
+        elif kind == "truncate":
+            return frame[: int(self.rng.integers(1, len(frame)))]
+        elif kind == "drop":
+            return b""
+        garbage = self.rng.integers(0, 256, int(self.rng.integers(2, 32)), dtype="u1")
+        if self.rng.random() < 0.5:
+            garbage[0:2] = [0xCA, 0xFE]
+        return garbage.tobytes() + frame
+
+
+def flash_dump(streams, block_bytes=512, start_ms=0, duration=60, seed=0):
+    """
+    Wrap per-slot streams in FlashBlockMessages the way a hub stores them.
+
+    Each stream is cut into blocks of up to ``block_bytes``, spread evenly
+    over ``duration`` seconds, and blocks from all slots are interleaved in
+    time order.
+
+    :param streams: Dict of slot to (MAC bytes, stream bytes).
+    :param return: The flash contents as bytes.
+    """
+    rng = np.random.default_rng(seed)
+    fbm = pyp.platform.sensors.FlashBlockMessage()
+    blocks = []
+    for slot, (mac, stream) in streams.items():
+        n = max(1, -(-len(stream) // block_bytes))
+        for i in range(n):
+            t = start_ms + int(duration * 1e3 * i / n)
+            block = stream[i * block_bytes : (i + 1) * block_bytes]
+            blocks.append((t, slot, mac, block))
+    blocks.sort(key=lambda block: (block[0], block[1]))
+
+    out = bytearray()
+    for t, slot, mac, block in blocks:
+        fbm.message.time = t
+        fbm.message.slot = slot
+        fbm.message.mac = np.frombuffer(mac, "u1")
+        fbm.message.rssi = int(rng.integers(-90, -40))
+        fbm.message.block_bytes = len(block)
+        fbm.serialize()
+        header = fbm.buffer.buffer.tobytes()
+        assert len(header) == FBM_BYTES
+        out += header
+        out += block
+    return bytes(out)
+
+
+def write_capture(fn, duration=60, corrupt=0.0, seed=0, **kwargs):
+    """
+    Write a synthetic raw serial capture, like ``posey-listen`` records.
+
+    :param return: Corruptor or None.
+    """
+    data, corruptor = StreamGenerator(duration, seed=seed, **kwargs).generate(corrupt)
+    with open(fn, "wb") as f:
+        f.write(data)
+    return corruptor
+
+
+def write_download(stem, slots=4, duration=60, corrupt=0.0, seed=0, **kwargs):
+    """
+    Write a synthetic streamed download container (``<stem>.json`` and
+    ``<stem>.bin``) holding ``slots`` peripherals' data.
+
+    :param return: The DataSummary dict.
+    """
+    streams = {}
+    for slot in range(slots):
+        generator = StreamGenerator(
+            duration, task="watch", seed=seed + slot + 1, **kwargs
+        )
+        data, _ = generator.generate(corrupt)
+        mac = bytes([0xC0, 0xFF, 0xEE, 0x00, 0x00, slot])
+        streams[slot] = (mac, data)
+
+    start_ms = 1000
+    data = flash_dump(streams, start_ms=start_ms, duration=duration, seed=seed)
+    summary = dict(
+        sensor="Posey Synth",
+        datetime=dt.datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S %z"),
+        start_ms=start_ms,
+        end_ms=start_ms + int(duration * 1e3),
+        bytes=len(data),
+    )
+    f = download.DownloadFile(stem, summary)
+    f.write(data)
+    f.close()
+    return summary
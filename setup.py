@@ -44,6 +44,13 @@ setup(
             "posey-cmd=poseyctrl.apps.posey_cmd:posey_cmd",
             "posey-extract=poseyctrl.apps.posey_extract:posey_extract",
             "posey-sniffer=poseyctrl.apps.posey_sniffer:posey_sniffer",
+            "posey-batch=poseyctrl.apps.posey_batch:posey_batch",
+            "posey-daemon=poseyctrl.apps.posey_daemon:posey_daemon",
+            "posey-bench=poseyctrl.apps.posey_bench:posey_bench",
+            "posey-merge=poseyctrl.apps.posey_merge:posey_merge",
+            "posey-imu=poseyctrl.apps.posey_imu:posey_imu",
+            "posey-catalog=poseyctrl.apps.posey_catalog:posey_catalog",
+            "posey=poseyctrl.apps.posey:posey",
         ]
     },
 )
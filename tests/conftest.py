@@ -0,0 +1,28 @@
+import queue
+
+import pytest
+
+
+@pytest.fixture
+def sim_sensor():
+    """Connect to a simulated hub over a link with the given one way latency."""
+    pytest.importorskip("pyposey")
+    pytest.importorskip("adafruit_ble")
+    from poseyctrl import sim
+    from poseyctrl.sensor import PoseySensor
+
+    sensors = []
+
+    def connect(latency=sim.LINK["latency"]):
+        radio = sim.SimRadio(latency=latency)
+        adv = next(iter(radio.start_scan()))
+        sensor = PoseySensor(
+            adv.complete_name, radio, adv, None, queue.Queue(), None, None
+        )
+        assert sensor.connect()
+        sensors.append(sensor)
+        return sensor
+
+    yield connect
+    for sensor in sensors:
+        sensor.disconnect()
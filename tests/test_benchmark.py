@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("pyposey")
+
+from poseyctrl.benchmark import LinkBenchmark
+
+# One way latency of the simulated link.
+LATENCY = 0.05
+
+
+@pytest.mark.parametrize("window", [1, 4])
+def test_latency_all_acked(sim_sensor, window):
+    result = LinkBenchmark(sim_sensor(LATENCY)).latency(
+        count=10, window=window, timeout=1.0
+    )
+    assert (result["acked"], result["lost"], result["late"]) == (10, 0, 0)
+    assert result["rtt_ms"]["p50"] >= 2 * LATENCY * 1e3
+
+
+def test_latency_late_acks_not_attributed(sim_sensor):
+    # Every ack comes back after its command timed out, while later commands
+    # are waiting, and none can count as theirs.
+    result = LinkBenchmark(sim_sensor(LATENCY)).latency(
+        count=10, window=1, timeout=0.02
+    )
+    assert result["acked"] == 0
+    assert result["lost"] == 10
+    assert result["late"] > 0
+    assert result["bad_acks"] == 0
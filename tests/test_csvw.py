@@ -0,0 +1,133 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from poseyctrl import csvw
+
+IMU = dict(sensor=str, time=int, Ax=float, Ay=float, Az=float)
+
+
+def columns(db, table):
+    return {row[1]: row[2] for row in db.execute(f'PRAGMA table_info("{table}")')}
+
+
+def write(tmp_path, messages, types=None):
+    writer = csvw.SQLiteWriter(None, prefix=f"{tmp_path}/", types=types)
+    for msg in messages:
+        writer.put(msg)
+    writer.close()
+    return sqlite3.connect(writer.filename())
+
+
+def imu(**kwargs):
+    data = dict(sensor="Posey Sim Hub 0", time=1000, Ax=0.5, Ay=1.0, Az=9.8)
+    data.update(kwargs)
+    return ("imu", "2026-01-01 00:00:00", data)
+
+
+def test_numpy_scalars(tmp_path):
+    db = write(
+        tmp_path,
+        [
+            imu(time=np.uint32(1000), Ax=np.float32(0.5), Ay=np.float64(1.0)),
+            imu(time=2000, Ax=np.float64(0.25), Az=np.int16(9)),
+            (
+                "other",
+                "2026-01-01 00:00:00",
+                dict(flag=np.bool_(True), n=np.longlong(7), payload=np.arange(3)),
+            ),
+        ],
+    )
+    assert columns(db, "imu") == dict(
+        pctime="TEXT",
+        sensor="TEXT",
+        time="INTEGER",
+        Ax="REAL",
+        Ay="REAL",
+        Az="REAL",
+    )
+    assert db.execute("SELECT time, Ax, Ay, Az FROM imu").fetchall() == [
+        (1000, 0.5, 1.0, 9.8),
+        (2000, 0.25, 1.0, 9),
+    ]
+    assert columns(db, "other") == dict(
+        pctime="TEXT", flag="INTEGER", n="INTEGER", payload="TEXT"
+    )
+    assert db.execute("SELECT flag, n, payload FROM other").fetchall() == [
+        (1, 7, "[0 1 2]")
+    ]
+
+
+def test_declared_types(tmp_path):
+    # A column blank in the first row is typed from its declaration, and its
+    # blanks stored as NULL.
+    types = dict(imu=IMU, quality=dict(sensor=str, Vbatt_per_hour=float))
+    db = write(
+        tmp_path,
+        [
+            ("quality", "t0", dict(sensor="a", Vbatt_per_hour="")),
+            ("quality", "t1", dict(sensor="a", Vbatt_per_hour=np.float64(-0.5))),
+            imu(time=np.int64(5), Ax=1),
+        ],
+        types,
+    )
+    assert columns(db, "quality")["Vbatt_per_hour"] == "REAL"
+    assert db.execute(
+        "SELECT typeof(Vbatt_per_hour), Vbatt_per_hour FROM quality"
+    ).fetchall() == [("null", None), ("real", -0.5)]
+    assert columns(db, "imu")["Ax"] == "REAL"
+    assert db.execute("SELECT typeof(time), typeof(Ax) FROM imu").fetchall() == [
+        ("integer", "real")
+    ]
+
+
+@pytest.mark.parametrize("writer", [csvw.CSVWriter, csvw.SQLiteWriter])
+def test_checksum_failures_skipped(tmp_path, writer):
+    # PoseyHIL queues frames failing their checksum with no data.
+    w = writer(None, prefix=f"{tmp_path}/")
+    for msg in [("imu", "t0", None), imu(), ("imu", "t1", None), ("ble", "t2", None)]:
+        w.put(msg)
+    w.close()
+    if writer is csvw.SQLiteWriter:
+        db = sqlite3.connect(w.filename())
+        assert db.execute("SELECT count(*) FROM imu").fetchone() == (1,)
+        assert columns(db, "ble") == {}
+    else:
+        with open(w.filename("imu")) as f:
+            assert f.read().splitlines() == [
+                "pctime,sensor,time,Ax,Ay,Az",
+                '"2026-01-01 00:00:00",Posey Sim Hub 0,1000,0.5,1.0,9.8',
+            ]
+        assert not (tmp_path / "data.ble.csv").exists()
+
+
+def test_resume_keeps_outputs_not_written_since(tmp_path):
+    prefix = f"{tmp_path}/"
+    ble = ("ble", "t", dict(sensor="Posey Sim Hub 0", time=1, rssi=-60))
+    w = csvw.CSVWriter(None, prefix=prefix)
+    w.put(imu())
+    w.put(ble)
+    w.flush()
+    checkpoint = w.sizes()
+    w.put(imu(time=2000))
+    w.close()
+
+    # Restarted from the checkpoint, ble doesn't come back before the next.
+    w = csvw.CSVWriter(None, prefix=prefix, append=True)
+    w.resume(checkpoint)
+    w.put(imu(time=3000))
+    w.flush()
+    checkpoint = w.sizes()
+    assert set(checkpoint) == {"imu", "ble"}
+    w.close()
+
+    open(f"{prefix}data.other.csv", "w").close()
+    w = csvw.CSVWriter(None, prefix=prefix, append=True)
+    w.resume(checkpoint)
+    w.close()
+    with open(w.filename("imu")) as f:
+        assert [line.split(",")[2] for line in f][1:] == ["1000", "3000"]
+    with open(w.filename("ble")) as f:
+        assert len(f.readlines()) == 2
+    assert (tmp_path / "data.other.csv").exists()
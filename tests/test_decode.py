@@ -0,0 +1,120 @@
+import glob
+import os
+
+import pytest
+
+pytest.importorskip("pyposey")
+
+from poseyctrl import decode, synth
+
+NAME = "Posey Sim Hub 0"
+
+
+def rows(fn):
+    """Lines of a decoded CSV without the pctime column, the host decode time."""
+    with open(fn) as f:
+        return [line.split(",", 1)[1] for line in f]
+
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    # Two captures back to back, so the device clock resets part way, with
+    # some corruption for checksum failures and resyncing.
+    monkeypatch.chdir(tmp_path)
+    synth.write_capture("a.bin", 300, 0.01, seed=1)
+    synth.write_capture("b.bin", 120, 0.01, seed=2)
+    with open("capture.bin", "wb") as f:
+        for fn in ["a.bin", "b.bin"]:
+            with open(fn, "rb") as part:
+                f.write(part.read())
+    return "capture.bin"
+
+
+def test_parallel_matches_serial(capture):
+    serial = decode.decode_file(capture, NAME, "serial.")
+    parallel = decode.decode_parallel(
+        capture, NAME, "parallel.", 3, 50000, log=lambda s: None
+    )
+    assert parallel == serial
+
+    outputs = sorted(glob.glob("serial.data.*.csv"))
+    signals = [fn[len("serial.data.") : -len(".csv")] for fn in outputs]
+    assert {"imu", "ble", "taskwaist", "quality"} <= set(signals)
+    assert sorted(glob.glob("parallel.data.*.csv")) == [
+        f"parallel.data.{sig}.csv" for sig in signals
+    ]
+    for sig in signals:
+        assert rows(f"parallel.data.{sig}.csv") == rows(f"serial.data.{sig}.csv"), sig
+    assert glob.glob("*part*") == []
+
+
+def follow(checkpoint, steps=2):
+    # Decode what's there and checkpoint, as FollowDecoder.follow does
+    # before it's interrupted.
+    follower = decode.FollowDecoder(
+        "segment.bin", NAME, "follow.", checkpoint, log=lambda s: None
+    )
+    for _ in range(steps):
+        follower.step()
+    follower.save()
+    return follower
+
+
+def test_follow_resume_matches_serial(capture):
+    with open(capture, "rb") as f:
+        data = f.read()
+    open("segment.bin", "wb").close()
+    # Cut mid-message, so each resume re-feeds a partial one.
+    cuts = [0, 100001, 300003, 600007, len(data)]
+    for start, end in zip(cuts, cuts[1:]):
+        with open("segment.bin", "ab") as f:
+            f.write(data[start:end])
+        follower = follow("follow.checkpoint.json")
+        # Rows written after the checkpoint, before the restart, are dropped.
+        follower.sensor.feed(memoryview(data)[:5000])
+        follower.writer.flush()
+    follower = follow("follow.checkpoint.json", steps=1)
+    follower.writer.close()
+
+    decode.decode_file(capture, NAME, "serial.")
+    for fn in sorted(glob.glob("serial.data.*.csv")):
+        sig = fn[len("serial.data.") : -len(".csv")]
+        assert rows(f"follow.data.{sig}.csv") == rows(fn), sig
+
+
+def test_follow_before_input_exists(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    follower = decode.FollowDecoder(
+        "segment*.bin",
+        NAME,
+        "follow.",
+        "follow.checkpoint.json",
+        poll=0.01,
+        log=lambda s: None,
+    )
+    assert follower.follow(idle_timeout=0.05) == 0
+    assert not os.path.exists("follow.checkpoint.json")
+
+
+def test_follow_checkpoint_segment_gone(capture):
+    os.rename(capture, "segment0.bin")
+    follower = decode.FollowDecoder(
+        "segment*.bin", NAME, "follow.", "follow.checkpoint.json", log=lambda s: None
+    )
+    follower.step()
+    follower.save()
+    follower.writer.close()
+
+    # The segment was rotated away, so everything is decoded again.
+    os.rename("segment0.bin", "segment1.bin")
+    follower = decode.FollowDecoder(
+        "segment*.bin", NAME, "follow.", "follow.checkpoint.json", log=lambda s: None
+    )
+    follower.step()
+    follower.save()
+    follower.writer.close()
+
+    decode.decode_file("segment1.bin", NAME, "serial.")
+    for fn in sorted(glob.glob("serial.data.*.csv")):
+        sig = fn[len("serial.data.") : -len(".csv")]
+        assert rows(f"follow.data.{sig}.csv") == rows(fn), sig
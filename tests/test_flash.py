@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+pytest.importorskip("pyposey")
+
+from poseyctrl import flash, synth
+
+
+@pytest.fixture(scope="module")
+def download():
+    streams = {}
+    for slot in range(3):
+        data, _ = synth.StreamGenerator(30, task="watch", seed=slot).generate()
+        streams[slot] = (bytes([0xC0, 0xFF, 0xEE, 0, 0, slot]), data)
+    data = bytearray(synth.flash_dump(streams, duration=30))
+    # Overwrite runs of bytes, breaking headers and blocks.
+    rng = random.Random(0)
+    for _ in range(100):
+        i = rng.randrange(len(data))
+        n = rng.randrange(1, 40)
+        data[i : i + n] = rng.randbytes(n)
+    return bytes(data)
+
+
+def parse(data, sizes=()):
+    parser = flash.FlashBlockParser()
+    end = 0
+    for n in sizes:
+        end = min(end + n, len(data))
+        parser.feed(data, data, end)
+    parser.feed(data, data, len(data), final=True)
+    return dict(
+        blocks=parser.slot_blocks,
+        bytes=parser.slot_bytes,
+        checksum_failures=parser.checksum_failures,
+        skipped=parser.skipped,
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_feed_split_independent(download, seed):
+    whole = parse(download)
+    assert whole["checksum_failures"] > 0
+    rng = random.Random(seed)
+    sizes = []
+    while sum(sizes) < len(download):
+        sizes.append(rng.choice([1, 2, 17, 18, 19, 244, 4096]))
+    assert parse(download, sizes) == whole
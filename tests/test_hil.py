@@ -0,0 +1,54 @@
+import time
+from concurrent.futures import TimeoutError
+
+import pytest
+
+pyp = pytest.importorskip("pyposey")
+
+from poseyctrl.benchmark import ack_seq, noop
+
+# One way latency of the simulated link, and a timeout shorter than the
+# round trip it makes.
+LATENCY = 0.05
+SHORT_TIMEOUT = 0.02
+
+
+def drain(hil, seconds):
+    # Keep decoding for a while, so late responses turn up unclaimed.
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        hil.process_uart()
+        hil.decode_pending()
+        time.sleep(0.001)
+
+
+def test_late_ack_does_not_resolve_next_request(sim_sensor):
+    hil = sim_sensor(LATENCY).hil
+    future = hil.request(noop(1))
+    with pytest.raises(TimeoutError):
+        hil.wait(future, timeout=SHORT_TIMEOUT)
+    drain(hil, 4 * LATENCY)
+
+    future = hil.request(noop(2))
+    assert not future.done()
+    assert ack_seq(hil.wait(future, timeout=1)) == 2
+
+
+def test_expect_after_request(sim_sensor):
+    hil = sim_sensor(LATENCY).hil
+    cmd = pyp.control.CommandMessage()
+    cmd.message.command = pyp.control.CommandType.GetDataSummary
+    cmd.message.ack = pyp.MessageAck.Expected
+    cmd.serialize()
+
+    # A summary nobody asked for, from before the request, is stale.
+    stale = hil.request(cmd)
+    with pytest.raises(TimeoutError):
+        hil.wait(stale, timeout=SHORT_TIMEOUT)
+    drain(hil, 4 * LATENCY)
+
+    ack = hil.request(cmd)
+    summary = hil.expect_datasummary()
+    assert not summary.done()
+    hil.wait(ack, timeout=1)
+    assert "bytes" in hil.wait(summary, timeout=1)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from poseyctrl import imu
+
+
+def resample(t, X, chunk):
+    resampler = imu.Resampler(100)
+    grids, outs = [], []
+    for i in range(0, len(t), chunk):
+        grid, out = resampler(t[i : i + chunk], X[i : i + chunk])
+        grids.append(grid)
+        outs.append(out)
+    return resampler, np.concatenate(grids), np.vstack(outs)
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 150])
+def test_resampler_clock_reset(chunk):
+    # 1 s of samples, then the MCU resets and another 0.5 s from 0.
+    t = np.concatenate([np.arange(100) * 1e4 + 5e3, np.arange(50) * 1e4 + 5e3])
+    X = np.arange(len(t), dtype=float)[:, None]
+    resampler, grid, out = resample(t, X, chunk)
+    assert (resampler.resets, resampler.dropped) == (1, 0)
+    assert len(grid) == 99 + 49
+    assert np.allclose(grid[99:], np.arange(49) * 1e4 + 1e4)
+    assert np.allclose(out[99:, 0], np.arange(49) + 100.5)
+
+
+def test_resampler_out_of_order():
+    t = np.array([5e3, 15e3, 12e3, 25e3, 35e3])
+    X = np.arange(len(t), dtype=float)[:, None]
+    resampler, grid, out = resample(t, X, 2)
+    assert (resampler.resets, resampler.dropped) == (0, 1)
+    assert np.allclose(grid, [1e4, 2e4, 3e4])
+    assert np.allclose(out[:, 0], [0.5, 2, 3.5])
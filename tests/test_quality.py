@@ -0,0 +1,87 @@
+import json
+import logging
+
+from poseyctrl.quality import QualityMonitor, QualityTrace
+
+SENSOR = "Posey Sim Hub 0"
+
+
+def messages():
+    """
+    Ten minutes of IMU samples at 10 Hz with task telemetry each second,
+    with a gap, a run of checksum failures and an MCU reset part way.
+    """
+    msgs = []
+    boot = 0
+    for i in range(6000):
+        if i == 4000:
+            boot = i
+        t = (i - boot) * 100000
+        if i % 1000 == 500:
+            # A second of samples lost.
+            continue
+        if 2000 <= i % 3000 < 2003:
+            msgs.append(("imu", None, i))
+        else:
+            msgs.append(("imu", dict(sensor=SENSOR, time=t), i))
+        if i % 10 == 0:
+            task = dict(
+                sensor=SENSOR,
+                t_start=t,
+                t_end=t + 500,
+                invalid_checksum=(i - boot) // 700,
+                missed_deadline=(i - boot) // 300,
+                Vbatt=4.1 - i * 1e-5,
+            )
+            msgs.append(("taskwaist", task, i))
+    return msgs
+
+
+def observe(monitor, msgs):
+    rows = []
+    for sig, data, time in msgs:
+        row = monitor.observe(sig, data, time)
+        if row is not None:
+            rows.append(("quality", time, row))
+    return rows
+
+
+def test_state_round_trip():
+    log = logging.getLogger("quality")
+    msgs = messages()
+    direct = QualityMonitor(log)
+    expected = observe(direct, msgs)
+
+    first = QualityMonitor(log)
+    rows = observe(first, msgs[:3000])
+    restored = QualityMonitor(log)
+    restored.restore(json.loads(json.dumps(first.state())))
+    rows += observe(restored, msgs[3000:])
+
+    assert rows == expected
+    assert restored.snapshot() == direct.snapshot()
+    assert restored.report() == direct.report()
+    assert direct.snapshot()["clock_resets"] == dict(imu=1, taskwaist=1)
+
+
+def test_trace_replay():
+    log = logging.getLogger("quality")
+    msgs = messages()
+    direct = QualityMonitor(log)
+    expected = observe(direct, msgs)
+
+    # As the parallel decode's workers would trace their chunks.
+    traces = []
+    for start in range(0, len(msgs), 2500):
+        trace = QualityTrace()
+        for sig, data, time in msgs[start : start + 2500]:
+            trace.observe(sig, data, time)
+        traces.append(trace)
+    replayed = QualityMonitor(log)
+    rows = []
+    for trace in traces:
+        trace.replay(replayed, rows.append)
+
+    assert rows == expected
+    assert replayed.snapshot() == direct.snapshot()
+    assert replayed.report() == direct.report()
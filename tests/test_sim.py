@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("pyposey")
+
+from poseyctrl import sim
+
+
+def frames(hub):
+    n = 0
+    while hub.outgoing:
+        _, view, download = hub.outgoing.popleft()
+        hub.download_left -= len(view) if download else 0
+        n += not download
+    return n
+
+
+def test_telemetry_skipped_during_download():
+    hub = sim.SimHub("Posey Sim Hub 0", task_rate=10.0, flash_seconds=1.0)
+    t0 = hub.t0
+    hub.connect(None, t0)
+    hub.schedule(t0, "download")
+    hub.advance(t0)
+    assert hub.download_left > 0
+    hub.advance(t0 + 4.97)
+    assert frames(hub) == 1
+
+    # Once it's streamed out, telemetry carries on from now, not 0.1 s.
+    hub.advance(t0 + 4.99)
+    assert frames(hub) == 0
+    hub.advance(t0 + 5.25)
+    assert frames(hub) == 3